@@ -1,7 +1,9 @@
 import time
 import argparse
+import shutil
+import tempfile
 
-from chorus_upload.local_ops import update_journal, list_files_with_info, _get_modality_pattern
+from chorus_upload.local_ops import list_files_with_info, _get_modality_pattern, PathPattern
 # from chorus_upload.generate_journal import restore_journal, list_uploads, list_journals
 # from chorus_upload.upload_ops_builtin import upload_files, verify_files, list_files
 from chorus_upload import history_ops 
@@ -10,6 +12,7 @@ from pathlib import Path
 from chorus_upload import config_helper
 from chorus_upload import upload_ops
 from chorus_upload import local_ops
+from chorus_upload import watch_ops
 import chorus_upload.storage_helper as storage_helper
 
 from chorus_upload.journaldb_ops import JournalDispatcher
@@ -17,8 +20,6 @@ import chorus_upload.journaldb_ops as journaldb_ops
 
 from chorus_upload.remote_file_ops import _list_remote_files, _upload_remote_files, _download_remote_files, _delete_remote_files
 
-import parse
-
 from chorus_upload.script_generators import _write_files
 
 
@@ -115,6 +116,7 @@ def _print_usage(args, config, journal_fn):
     print("generating journal")
     print("  journal update:    python chorus_upload --config ./config.toml journal update")
     print("             python chorus_upload journal update --modalities Waveforms,Images,Metadata")
+    print("  journal watch:    python chorus_upload journal watch --modalities Waveforms --interval 30")
     print("generating upload file list")
     print("  file list:    python chorus_upload file list")
     print("             python chorus_upload file list --version 20210901120000 -f filelist.txt")
@@ -129,14 +131,8 @@ def _print_usage(args, config, journal_fn):
     # print("  revert:    python chorus_upload revert-version --version 20210901120000")
     
         
-# helper to call update journal
-def _update_journal(args, config, journal_fn):
-    
-    default_modalities = config_helper.get_modalities(config)
-    mods = args.modalities.split(',') if ("modalities" in vars(args)) and (args.modalities is not None) else default_modalities
-    mods_known = list(set(default_modalities).intersection(set(mods)))  # only keep valid modalities
-    if len(set(mods).difference(set(mods_known))) > 0:
-        log.warning(f"Warning: the modalities are not known, but will be processed: {set(mods).difference(set(mods_known))}")
+# helper to choose the journal version to create or amend.  returns (version, amend)
+def _select_journal_version(args, journal_fn):
     journal_version = args.version if ("version" in vars(args)) and (args.version is not None) else None
     
     table_exists = JournalDispatcher.table_exists(database_name = journal_fn) if Path(journal_fn).exists() else False
@@ -178,6 +174,30 @@ def _update_journal(args, config, journal_fn):
                 amend = False
             else:
                 raise ValueError(f"Invalid input for version selection: {target_version}")
+    return journal_version, amend
+
+# helper to get the modalities to process
+def _get_modalities(args, config):
+    default_modalities = config_helper.get_modalities(config)
+    mods = args.modalities.split(',') if ("modalities" in vars(args)) and (args.modalities is not None) else default_modalities
+    mods_known = list(set(default_modalities).intersection(set(mods)))  # only keep valid modalities
+    if len(set(mods).difference(set(mods_known))) > 0:
+        log.warning(f"Warning: the modalities are not known, but will be processed: {set(mods).difference(set(mods_known))}")
+    return mods
+
+# helper to call update journal
+def _update_journal(args, config, journal_fn):
+    
+    mods = _get_modalities(args, config)
+    if args.resume and (args.version is None) and Path(journal_fn).exists():
+        # continue with the version of the interrupted update
+        cp_versions = journaldb_ops.ScanCheckpoint.get_versions(journal_fn)
+        if len(cp_versions) > 1:
+            raise ValueError(f"Interrupted updates found for versions {cp_versions}.  Please specify one with --version")
+        elif len(cp_versions) == 1:
+            log.info(f"Resuming interrupted update of version {cp_versions[0]}")
+            args.version = cp_versions[0]
+    journal_version, amend = _select_journal_version(args, journal_fn)
         
     # get the config path for each modality.  if not matched, use default.
     mod_configs = { mod: config_helper.get_site_config(config, mod) for mod in mods }
@@ -185,23 +205,163 @@ def _update_journal(args, config, journal_fn):
 
     nthreads = config_helper.get_config(config).get('nthreads', 1)
     page_size = config_helper.get_config(config).get('page_size', 100)
-
-    # for each modality, create the file system help and process
-    first = True
+    hash_engine = config_helper.get_config(config).get('hash_engine', 'auto')
+    hash_cache = config_helper.get_config(config).get('hash_cache', None)
+    prehash_mb = config_helper.get_config(config).get('prehash_mb', None)
+    digests = config_helper.get_config(config).get('digests', None)
+    digest_block_mb = config_helper.get_config(config).get('digest_block_mb', 8)
+
+    # for each modality, create the file system helper.  the modalities are then scanned concurrently.
+    roots = {}
     for mod, mod_config in mod_configs.items():        
         # create the file system helper    
         client, internal_host =storage_helper._make_client(mod_config)
-        datafs = FileSystemHelper(config_helper.get_path_str(mod_config), client = client, internal_host = internal_host)
-
-        log.info(f"Update journal {journal_fn} version {journal_version} for {mod}")
-        update_journal(datafs, modalities = [mod], 
-                       databasename = journal_fn, 
-                       journaling_mode = journaling_mode,
-                       version = journal_version, amend = (amend if first else True), 
-                       verbose = args.verbose, num_threads = nthreads, page_size = page_size,
-                       modality_configs = {mod: mod_config})
-        first = False
+        roots[mod] = FileSystemHelper(config_helper.get_path_str(mod_config), client = client, internal_host = internal_host)
+
+    log.info(f"Update journal {journal_fn} version {journal_version} for {', '.join(roots.keys())}")
+    local_ops.update_journal_modalities(roots, 
+                                        databasename = journal_fn, 
+                                        journaling_mode = journaling_mode,
+                                        version = journal_version, amend = amend, 
+                                        verbose = args.verbose, num_threads = nthreads, page_size = page_size,
+                                        hash_engine = hash_engine, hash_cache = hash_cache, prehash_mb = prehash_mb,
+                                        digests = digests, digest_block_mb = digest_block_mb,
+                                        trust_dir_mtime = args.trust_dir_mtime, resume = args.resume,
+                                        defer_hash = args.defer_hash,
+                                        modality_configs = mod_configs)
             
+# helper to keep the journal updated from file system events
+def _watch_journal(args, config, journal_fn):
+    
+    mods = _get_modalities(args, config)
+    journal_version, amend = _select_journal_version(args, journal_fn)
+
+    mod_configs = { mod: config_helper.get_site_config(config, mod) for mod in mods }
+    journaling_mode = config_helper.get_journaling_mode(config)
+
+    nthreads = config_helper.get_config(config).get('nthreads', 1)
+    page_size = config_helper.get_config(config).get('page_size', 100)
+    hash_engine = config_helper.get_config(config).get('hash_engine', 'auto')
+    hash_cache = config_helper.get_config(config).get('hash_cache', None)
+    prehash_mb = config_helper.get_config(config).get('prehash_mb', None)
+    digests = config_helper.get_config(config).get('digests', None)
+    digest_block_mb = config_helper.get_config(config).get('digest_block_mb', 8)
+
+    roots = {}
+    for mod, mod_config in mod_configs.items():
+        client, internal_host =storage_helper._make_client(mod_config)
+        roots[mod] = FileSystemHelper(config_helper.get_path_str(mod_config), client = client, internal_host = internal_host)
+
+    log.info(f"Watch journal {journal_fn} version {journal_version} for {', '.join(mods)}")
+    watch_ops.watch_journal(roots, databasename = journal_fn,
+                            journaling_mode = journaling_mode,
+                            version = journal_version, amend = amend,
+                            interval = float(args.interval), rescan_interval = float(args.rescan_interval),
+                            verbose = args.verbose, num_threads = nthreads, page_size = page_size,
+                            hash_engine = hash_engine, hash_cache = hash_cache, prehash_mb = prehash_mb,
+                            digests = digests, digest_block_mb = digest_block_mb,
+                            modality_configs = mod_configs)
+
+# helper to compare the local hash readers on large files of each modality, per device class
+def _benchmark_hash(args, config, journal_fn):
+
+    mods = _get_modalities(args, config)
+    min_mb = int(args.min_mb) if args.min_mb is not None else config_helper.get_config(config).get('hash_mmap_mb', 256)
+    count = int(args.count)
+
+    # up to count files of at least min_mb from each modality, grouped by device class.
+    samples = {}
+    for mod in mods:
+        mod_config = config_helper.get_site_config(config, mod)
+        client, internal_host = storage_helper._make_client(mod_config)
+        root = FileSystemHelper(config_helper.get_path_str(mod_config), client = client, internal_host = internal_host)
+        if root.is_cloud:
+            log.info(f"skipping {mod}: {str(root.root)} is not local")
+            continue
+        pattern = _get_modality_pattern(mod, {mod: mod_config})
+        found = 0
+        for page in root.get_files_meta_iter(pattern = pattern, name_filter = storage_helper.NameFilter.from_config(mod_config)):
+            for (relpath, size, _) in page:
+                if (size is None) or (size < min_mb * 1024 * 1024) or (found >= count):
+                    continue
+                fullpath = str(root.root.joinpath(relpath))
+                samples.setdefault(storage_helper._device_class(Path(fullpath).stat().st_dev), []).append(fullpath)
+                found += 1
+            if found >= count:
+                break
+
+    if len(samples) == 0:
+        log.warning(f"no local files of at least {min_mb} MB found.  try a smaller --min-mb")
+        return
+
+    results = storage_helper.benchmark_hashing([p for paths in samples.values() for p in paths], repeat = int(args.repeat))
+    faster = []
+    for (device_class, readers) in sorted(results.items()):
+        rates = {}
+        for (reader, (files, nbytes, seconds)) in sorted(readers.items()):
+            rates[reader] = nbytes / seconds / 1e6 if seconds > 0 else 0.0
+            print(f"{device_class:6s} {reader:5s} {files:4d} files {nbytes / 1e6:10.1f} MB {rates[reader]:8.1f} MB/s")
+        if rates.get("mmap", 0.0) > rates.get("read", 0.0):
+            faster.append(device_class)
+    print(f"suggested setting:  hash_mmap = \"{','.join(faster)}\"")
+
+# helper to compare the scan backends on the local roots of each modality
+def _benchmark_scan(args, config, journal_fn):
+
+    mods = _get_modalities(args, config)
+    repeat = int(args.repeat)
+
+    faster = []
+    for mod in mods:
+        mod_config = config_helper.get_site_config(config, mod)
+        client, internal_host = storage_helper._make_client(mod_config)
+        root = FileSystemHelper(config_helper.get_path_str(mod_config), client = client, internal_host = internal_host)
+        if not root.walk_is_sorted:
+            log.info(f"skipping {mod}: {str(root.root)} is not local")
+            continue
+        workers = int(args.workers) if args.workers is not None else local_ops._get_scan_backend(mod, {mod: mod_config})[1]
+        results = storage_helper.benchmark_walk(root, _get_modality_pattern(mod, {mod: mod_config}), workers = workers, repeat = repeat,
+                                                name_filter = storage_helper.NameFilter.from_config(mod_config))
+        rates = {}
+        for (backend, (files, seconds)) in results.items():
+            rates[backend] = files / seconds if seconds > 0 else 0.0
+            print(f"{mod:10s} {backend:6s} {files:9d} files {seconds:9.2f} s {rates[backend]:10.0f} files/s")
+        if rates.get("async", 0.0) > rates.get("thread", 0.0):
+            faster.append(mod)
+    for mod in faster:
+        print(f"suggested setting for [site_path.{mod}]:  scan_backend = \"async\"")
+
+def _check_indexes(args, config, journal_fn):
+
+    tmpdir = None
+    if args.synthetic is not None:
+        tmpdir = tempfile.mkdtemp(prefix = "chorus_journal_")
+        journal_fn = str(Path(tmpdir) / "synthetic.db")
+        log.info(f"creating synthetic journal with {int(args.synthetic)} entries at {journal_fn}")
+        journaldb_ops._make_synthetic_journal(journal_fn, int(args.synthetic))
+    else:
+        # adds any missing indexes.
+        JournalDispatcher.create_journal_table(journal_fn)
+
+    try:
+        results = JournalDispatcher.explain_queries(journal_fn)
+    finally:
+        if tmpdir is not None:
+            journaldb_ops.SQLiteDB.close(journal_fn)
+            shutil.rmtree(tmpdir, ignore_errors = True)
+
+    failed = []
+    for (name, stmt, plan, scans) in results:
+        print(f"{name:26s} {('FULL SCAN of ' + ', '.join(scans)) if len(scans) > 0 else 'ok'}")
+        if args.verbose or (len(scans) > 0):
+            print(f"    {stmt}")
+            for detail in plan:
+                print(f"      {detail}")
+        if len(scans) > 0:
+            failed.append(name)
+    if len(failed) > 0:
+        raise ValueError(f"queries reading journal tables in full: {', '.join(failed)}")
+
 # helper to revert to a previous journal
 # def _revert_journal(args, config, journal_fn):
 #     revert_time = args.version
@@ -285,7 +445,7 @@ def _mark_as_uploaded(args, config, journal_fn):
     mods = config_helper.get_modalities(config)
     # get the config path for each modality.  if not matched, use default.
     mod_configs = { mod: config_helper.get_site_config(config, mod) for mod in mods }    
-    compiled_patterns = { mod: parse.compile(_get_modality_pattern(mod, mod_configs))  for mod in mods }
+    compiled_patterns = { mod: PathPattern(_get_modality_pattern(mod, mod_configs))  for mod in mods }
 
     if (filelist is not None):
         with open(filelist, 'r') as f:
@@ -351,7 +511,7 @@ def _verify_files(args, config, journal_fn):
         log.warning(f"Warning: the modalities are not known, but will be processed: {set(mods).difference(set(mods_known))}")
     # get the config path for each modality.  if not matched, use default.
     mod_configs = { mod: config_helper.get_site_config(config, mod) for mod in mods }  
-    compiled_patterns = { mod: parse.compile(_get_modality_pattern(mod, mod_configs)) for mod in mods }      
+    compiled_patterns = { mod: PathPattern(_get_modality_pattern(mod, mod_configs)) for mod in mods }      
 
     central_config = config_helper.get_central_config(config)
     client, internal_host =storage_helper._make_client(central_config)
@@ -394,7 +554,7 @@ if __name__ == "__main__":
     
     #------ create subparsers
     #------ create the parser for the "journal" command
-    parser_journal = subparsers.add_parser("journal", help = "journal operations (update, list, checkout, checkin, unlock)")
+    parser_journal = subparsers.add_parser("journal", help = "journal operations (update, watch, list, checkout, checkin, unlock)")
     journal_subparsers = parser_journal.add_subparsers(help="sub-command help", dest="journal_command")
     
     
@@ -406,11 +566,56 @@ if __name__ == "__main__":
     parser_update.add_argument("--version", 
                                help="version string for the upcoming upload.  If not specified, the current datetime in YYYYMMDDHHMMSS format is used.", 
                                required=False)
+    parser_update.add_argument("--trust-dir-mtime", 
+                               help="skip the per-file stat in directories whose mtime and entry count are unchanged since the last update.  misses files modified in place.", 
+                               action="store_true", required=False)
+    parser_update.add_argument("--resume", 
+                               help="continue an interrupted update of local directories from its last checkpoint, with the same version.", 
+                               action="store_true", required=False)
+    parser_update.add_argument("--defer-hash", 
+                               help="do not compute MD5s of new local files.  'file upload' computes them while uploading, and records them in the journal.", 
+                               action="store_true", required=False)
     # parser_update.add_argument("--amend", 
     #                            help="amend the last journal update.  If this flag is set but the version is not provided, then the last version is used.", 
     #                            action="store_true")
     parser_update.set_defaults(func = _update_journal)
     
+    # create the parser for the "watch" command
+    parser_watch = journal_subparsers.add_parser("watch", help = "update the journal, then keep it updated from file system events (Linux, local directories).  Ctrl-C to stop")
+    parser_watch.add_argument("--modalities", 
+                               help="list of modalities to include in the journal update. defaults to 'Waveforms,Images,OMOP,Metadata'.  case sensitive.", 
+                               required=False)
+    parser_watch.add_argument("--version", 
+                               help="version string for the upcoming upload.  If not specified, the current datetime in YYYYMMDDHHMMSS format is used.", 
+                               required=False)
+    parser_watch.add_argument("--interval", help="seconds between applying collected changes to the journal. defaults to 10", default=10, required=False)
+    parser_watch.add_argument("--rescan-interval", help="seconds between full journal updates, as a safety net.  0 to disable.  defaults to 86400", default=86400, required=False)
+    parser_watch.set_defaults(func = _watch_journal)
+
+    # create the parser for the "benchmark-hash" command
+    parser_bench = journal_subparsers.add_parser("benchmark-hash", help = "compare the buffered and memory mapped MD5 readers on large local files, per device class")
+    parser_bench.add_argument("--modalities", 
+                               help="list of modalities to take sample files from. defaults to 'Waveforms,Images,OMOP,Metadata'.  case sensitive.", 
+                               required=False)
+    parser_bench.add_argument("--min-mb", help="minimum size of the sample files in MB.  defaults to the hash_mmap_mb setting, or 256", required=False)
+    parser_bench.add_argument("--count", help="number of sample files per device class.  defaults to 3", default=3, required=False)
+    parser_bench.add_argument("--repeat", help="passes over the sample files.  defaults to 1", default=1, required=False)
+    parser_bench.set_defaults(func = _benchmark_hash)
+
+    # create the parser for the "benchmark-scan" command
+    parser_bench_scan = journal_subparsers.add_parser("benchmark-scan", help = "compare the thread and async scan backends, listing and stat'ing the local files of each modality")
+    parser_bench_scan.add_argument("--modalities", 
+                               help="list of modalities to scan. defaults to 'Waveforms,Images,OMOP,Metadata'.  case sensitive.", 
+                               required=False)
+    parser_bench_scan.add_argument("--workers", help="listings and stats in flight for the async backend.  defaults to the scan_workers setting, or 256", required=False)
+    parser_bench_scan.add_argument("--repeat", help="passes over the files.  defaults to 1", default=1, required=False)
+    parser_bench_scan.set_defaults(func = _benchmark_scan)
+
+    # create the parser for the "check-indexes" command
+    parser_check_idx = journal_subparsers.add_parser("check-indexes", help = "add missing journal indexes, and check that no journal query reads a whole table")
+    parser_check_idx.add_argument("--synthetic", help="check a generated journal with this many entries instead of the local journal, e.g. 1000000", required=False)
+    parser_check_idx.set_defaults(func = _check_indexes)
+
     # create the parser for the "list" command
     parser_list = journal_subparsers.add_parser("list", help = "list the versions in a journal database")
     parser_list.add_argument("--modalities", 
@@ -571,6 +776,10 @@ if __name__ == "__main__":
         
         # get the configuration for profiling
         JournalDispatcher.profiling = config["configuration"].get("profiling", False)
+
+        # optional memory mapped hashing of large local files
+        storage_helper.configure_hashing(config["configuration"].get("hash_mmap", None),
+                                         config["configuration"].get("hash_mmap_mb", 256))
         
         # set a default client for central storage
         central_config = config_helper.get_central_config(config)
@@ -592,6 +801,11 @@ if __name__ == "__main__":
         elif ((args.command in ["journal"]) and (args.journal_command in ["checkin"])):
             # for checkout and checkin, the argfunc handles the checkin and checkout.
             upload_ops.checkin_journal(journal_path, lock_path, local_path)
+
+        elif ((args.command in ["journal"]) and ((args.journal_command in ["benchmark-hash", "benchmark-scan"]) or
+                                                  ((args.journal_command in ["check-indexes"]) and (args.synthetic is not None)))):
+            # reads local files or a generated journal only.  does not use the journal.
+            args.func(args, config, None)
         
         elif ((args.command in ["journal"]) and (args.journal_command in ["upgrade"])):                            
             
@@ -657,6 +871,7 @@ if __name__ == "__main__":
 
             # save history runtime
             history_ops.update_command_completion(command_id, elapsed, local_journal_fn)
+            journaldb_ops.SQLiteDB.close(local_journal_fn)
                 
             # and check in.
             # if not skip_checkin:
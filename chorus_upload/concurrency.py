@@ -0,0 +1,153 @@
+import time
+import math
+import concurrent.futures
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Adaptive concurrency for I/O-bound pools (journal hashing, uploads, verification).
+#
+# AIMDController adjusts a thread count from the throughput of each completed window of work:
+#
+# throughput vs baseline        action
+# ----------------------------  ---------------------------------------------------------------
+# no worse (within tolerance)   additive increase: +increase threads, unless cooling down
+# worse, < patience windows     hold.  a single noisy window (burst of tiny files, NAS hiccup)
+#                               does not change the count
+# worse, >= patience windows    multiplicative decrease: x decrease, then hold for cooldown windows
+#
+# Throughput counts each file as file_cost bytes on top of its size, against a smoothed baseline.
+# Opening and seeking to a file costs time regardless of its size, so a window of many small
+# files (low bytes/s, high files/s) is not taken for a slowdown.
+# The controller never locks: it keeps probing upward after each decrease, so a transient
+# slowdown early in a long run does not pin the thread count.
+
+class AIMDController:
+    """
+    Additive increase / multiplicative decrease thread count controller.
+
+    nthreads is the current limit on work in flight, between min_threads and max_threads.  Call update()
+    once per window of completed work.
+    """
+
+    def __init__(self, initial: int, max_threads: int, min_threads: int = 1,
+                 increase: int = 1, decrease: float = 0.7, tolerance: float = 0.05,
+                 patience: int = 2, cooldown: int = 2, smoothing: float = 0.3,
+                 file_cost: int = 256 * 1024):
+        self.min_threads = max(1, min_threads)
+        self.max_threads = max(self.min_threads, max_threads)
+        self.nthreads = min(self.max_threads, max(self.min_threads, initial))
+        self._increase = increase
+        self._decrease = decrease
+        self._tolerance = tolerance
+        self._patience = patience
+        self._cooldown = cooldown
+        self._smoothing = smoothing
+        self._file_cost = file_cost
+        self._baseline = None   # normalized bytes/s
+        self._worse = 0
+        self._hold = 0
+        # smoothed thread count and bytes/s over the run, for saving as a tuning profile.
+        self._mean_threads = None
+        self._mean_bps = None
+
+    def update(self, bytes_processed: int, elapsed: float, files: int = None) -> None:
+        """Call once per completed window with its total bytes, wall time and (optionally) file count."""
+        if (elapsed <= 0) or ((bytes_processed == 0) and not files):
+            return
+        bps = bytes_processed / elapsed
+        rate = (bytes_processed + (files or 0) * self._file_cost) / elapsed
+        if self._mean_threads is None:
+            (self._mean_threads, self._mean_bps) = (float(self.nthreads), bps)
+        else:
+            a = self._smoothing
+            self._mean_threads = (1 - a) * self._mean_threads + a * self.nthreads
+            self._mean_bps = (1 - a) * self._mean_bps + a * bps
+        if (self._baseline is None) or (self._baseline <= 0):
+            # first window at this level after a decrease (or at the start): measure only.
+            self._baseline = rate
+            if self._hold > 0:
+                self._hold -= 1
+            else:
+                self._set(self.nthreads + self._increase, "probing", bps)
+            return
+
+        if rate < self._baseline * (1.0 - self._tolerance):
+            self._worse += 1
+            if self._worse >= self._patience:
+                self._worse = 0
+                self._hold = self._cooldown
+                # the new level is compared with its own first window, not the earlier peak.
+                self._baseline = None
+                self._set(int(math.floor(self.nthreads * self._decrease)), "decreasing", bps)
+                return
+        else:
+            self._worse = 0
+            if self._hold > 0:
+                self._hold -= 1
+            else:
+                self._set(self.nthreads + self._increase, "probing", bps)
+
+        self._baseline = (1 - self._smoothing) * self._baseline + self._smoothing * rate
+
+    def profile(self) -> tuple:
+        """
+        returns (thread count, MB/s) the controller settled around, or None if update() was never called.
+        """
+        if self._mean_threads is None:
+            return None
+        return (max(self.min_threads, int(round(self._mean_threads))), self._mean_bps / 1e6)
+
+    def _set(self, new: int, reason: str, bps: float):
+        new = min(self.max_threads, max(self.min_threads, new))
+        if new == self.nthreads:
+            return
+        msg = f"Adaptive threads: {self.nthreads} → {new} ({reason}), throughput {bps / 1e6:.1f} MB/s"
+        if new < self.nthreads:
+            log.info(msg)
+        else:
+            log.debug(msg)
+        self.nthreads = new
+
+
+def run_adaptive(task, items, controller: AIMDController, size_of = None, window: int = 100):
+    """
+    Run task(item) for each item on a thread pool, keeping at most controller.nthreads in flight.
+
+    The pool is sized for controller.max_threads, so the controller can resize it between completions.
+
+    Args:
+        task: called with one item in a worker thread.
+        items: iterable of items.  consumed as slots free up.
+        controller (AIMDController): updated every window completions.
+        size_of (optional): called with an item, returns its size in bytes for the controller.
+        window (int): completions per controller update.
+
+    Yields:
+        (item, future) for each item, in completion order.
+    """
+    items = iter(items)
+    pending = {}
+    exhausted = False
+    nbytes, nfiles, start = 0, 0, time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers = controller.max_threads) as executor:
+        while True:
+            while (not exhausted) and (len(pending) < controller.nthreads):
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending[executor.submit(task, item)] = item
+            if len(pending) == 0:
+                return
+            (done, _) = concurrent.futures.wait(pending.keys(), return_when = concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                nbytes += size_of(item) if size_of is not None else 0
+                nfiles += 1
+                yield (item, future)
+            if nfiles >= window:
+                controller.update(nbytes, time.time() - start, files = nfiles)
+                nbytes, nfiles, start = 0, 0, time.time()
@@ -0,0 +1,151 @@
+import os
+import sqlite3
+import threading
+from contextlib import closing
+from typing import Optional
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Persistent MD5 cache for local files, keyed by (device, inode, size, mtime_ns).
+#
+# A file keeps its device and inode when it is renamed or moved within a file system, so a
+# reorganized tree costs a stat per file instead of a full re-read.  Any change to the content
+# changes size or mtime_ns, which invalidates the entry.
+#
+# backend   configured as              notes
+# --------  -------------------------  -----------------------------------------------------
+# sqlite    hash_cache = "<file.db>"   sidecar database, shared across journals.  one row per (dev, ino)
+# xattr     hash_cache = "xattr"       user.chorus.md5 attribute on the file itself.  Linux only, needs
+#                                      write access and a file system with user xattrs
+
+XATTR_NAME = "user.chorus.md5"
+
+class HashCache:
+    """
+    MD5 lookup for local files by (device, inode, size, mtime_ns).
+
+    get() returns the cached MD5 (if any) with the key from a stat taken before hashing.
+    put() stores the MD5 only if a second stat still gives the same key, so a file modified
+    while it was being hashed is not cached.
+    """
+
+    flush_size = 1000
+
+    def __init__(self, path: str = None, use_xattr: bool = False):
+        self.path = path
+        self.use_xattr = use_xattr
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._conn = None
+
+        if use_xattr:
+            if not hasattr(os, "getxattr"):
+                raise ValueError("hash_cache = \"xattr\" is not supported on this platform")
+            log.info(f"using hash cache in extended attribute {XATTR_NAME}")
+        elif path is not None:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            with closing(self._conn.cursor()) as cur:
+                cur.execute("CREATE TABLE IF NOT EXISTS hash_cache (DEV INTEGER NOT NULL, INO INTEGER NOT NULL,"
+                            " SIZE INTEGER NOT NULL, MTIME_NS INTEGER NOT NULL, MD5 TEXT NOT NULL,"
+                            " PRIMARY KEY (DEV, INO)) WITHOUT ROWID")
+            self._conn.commit()
+            log.info(f"using hash cache {path}")
+        else:
+            raise ValueError("HashCache requires a database path or use_xattr")
+
+    @classmethod
+    def from_config(cls, hash_cache: Optional[str]) -> Optional["HashCache"]:
+        """
+        create from the [configuration] hash_cache setting: None or "" (disabled), "xattr", or a sidecar database path.
+        """
+        if (hash_cache is None) or (hash_cache == ""):
+            return None
+        if hash_cache == "xattr":
+            return cls(use_xattr = True)
+        return cls(path = hash_cache)
+
+    @classmethod
+    def key_of(cls, st: os.stat_result) -> tuple:
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def get(self, fullpath: str) -> tuple:
+        """
+        returns (md5 or None, key).  key is None if the file could not be stat'd.
+        """
+        try:
+            key = self.key_of(os.stat(fullpath))
+        except OSError:
+            return (None, None)
+
+        md5 = self._get_xattr(fullpath, key) if self.use_xattr else self._get_db(key)
+        with self._lock:
+            if md5 is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return (md5, key)
+
+    def put(self, fullpath: str, key: tuple, md5: str):
+        if (key is None) or (md5 is None):
+            return
+        try:
+            if self.key_of(os.stat(fullpath)) != key:
+                log.debug(f"{fullpath} changed while hashing.  not caching md5")
+                return
+        except OSError:
+            return
+
+        if self.use_xattr:
+            self._put_xattr(fullpath, key, md5)
+            return
+        with self._lock:
+            self._pending[(key[0], key[1])] = (key[2], key[3], md5)
+            if len(self._pending) >= self.flush_size:
+                self._flush()
+
+    def _get_db(self, key: tuple) -> Optional[str]:
+        (dev, ino, size, mtime_ns) = key
+        with self._lock:
+            pending = self._pending.get((dev, ino), None)
+            if pending is not None:
+                return pending[2] if (pending[0] == size) and (pending[1] == mtime_ns) else None
+            with closing(self._conn.cursor()) as cur:
+                row = cur.execute("SELECT MD5 FROM hash_cache WHERE DEV = ? AND INO = ? AND SIZE = ? AND MTIME_NS = ?",
+                                  (dev, ino, size, mtime_ns)).fetchone()
+        return row[0] if row is not None else None
+
+    def _get_xattr(self, fullpath: str, key: tuple) -> Optional[str]:
+        try:
+            (size, mtime_ns, md5) = os.getxattr(fullpath, XATTR_NAME).decode("ascii").split(":")
+        except (OSError, ValueError, UnicodeDecodeError):
+            return None
+        return md5 if (int(size) == key[2]) and (int(mtime_ns) == key[3]) else None
+
+    def _put_xattr(self, fullpath: str, key: tuple, md5: str):
+        try:
+            # setting an xattr changes ctime only, so the key stays valid.
+            os.setxattr(fullpath, XATTR_NAME, f"{key[2]}:{key[3]}:{md5}".encode("ascii"))
+        except OSError as e:
+            log.debug(f"cannot set {XATTR_NAME} on {fullpath}: {e}")
+
+    # call with self._lock held
+    def _flush(self):
+        if (self._conn is None) or (len(self._pending) == 0):
+            return
+        params = [(dev, ino, size, mtime_ns, md5) for ((dev, ino), (size, mtime_ns, md5)) in self._pending.items()]
+        with closing(self._conn.cursor()) as cur:
+            cur.executemany("INSERT OR REPLACE INTO hash_cache (DEV, INO, SIZE, MTIME_NS, MD5) VALUES (?, ?, ?, ?, ?)", params)
+        self._conn.commit()
+        self._pending = {}
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        log.info(f"hash cache hits {self.hits}, misses {self.misses}")
@@ -76,7 +76,7 @@ def _get_paths_for_history(args, config):
     if (((command == "file") and 
          (args.file_command in ["upload"])) or 
         ((command == "journal") and 
-         (args.journal_command in ["update"]))):
+         (args.journal_command in ["update", "watch"]))):
         src_paths = { mod: config_helper.get_path_str(mod_config) for mod, mod_config in mod_configs.items() }
         # convert dict to json string
         if len(src_paths) > 0:
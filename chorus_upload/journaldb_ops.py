@@ -1,8 +1,16 @@
 import sqlite3
-from contextlib import closing
+from contextlib import closing, contextmanager
 from enum import Enum
 from pathlib import Path
+from typing import Optional
+import atexit
+import collections
+import os
+import re
 import shutil
+import socket
+import threading
+import time
 from chorus_upload.storage_helper import FileSystemHelper
 
 import logging
@@ -10,6 +18,197 @@ log = logging.getLogger(__name__)
 
 
 
+# Connections to a journal are kept open for the life of the process, instead of one connection per statement.
+#
+#   connection   per database  used by
+#   writer       1             SQLiteDB writes, inside a transaction scope.  serialized by a lock, so writes from
+#                              several threads (e.g. local_ops._JournalWriter and the main thread) take turns.
+#   readers      pooled        SQLiteDB reads outside a transaction.  in WAL mode readers see the last committed
+#                              transaction and do not wait for the writer.  a thread inside a transaction scope reads
+#                              through the writer, so it sees its own uncommitted writes.
+#
+# SQLiteConnections.transaction() scopes nest: only the outermost scope commits, or rolls back on an exception, so a
+# whole page of journal writes costs one commit.  connections are not shared with forked child processes.
+# the ids of lookup table values (srcpaths, modalities, versions, uploads) are cached with the connections, see
+# SQLiteDB.insert_lookup_table.  values are never deleted from lookup tables, so cached ids stay valid.
+# close() checkpoints the WAL back into the database file, and must be called before the journal file is copied,
+# moved or replaced (upload_ops.checkin_journal, checkout_journal).  it is also called at exit.
+
+class _SQLiteDatabase:
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.RLock()
+        self.writer = None
+        self.owner = None   # thread inside a transaction scope
+        self.depth = 0
+        self.readers = []   # idle readers
+        self.closed = False
+        self.lookups = {}   # committed lookup table ids, {table: {value: id}}
+        self.pending = {}   # lookup table ids added in the open transaction, {table: ChainMap(added, committed)}
+
+
+class SQLiteConnections:
+    """
+    Process wide connections to sqlite databases, keyed by absolute path.  see the table above.
+    """
+    pragmas = [
+        "PRAGMA journal_mode = WAL",
+        "PRAGMA synchronous = NORMAL",   # with WAL, a commit does not fsync.  checkpoints do.
+        "PRAGMA cache_size = -32768",    # KiB
+        "PRAGMA mmap_size = 268435456",
+        "PRAGMA temp_store = MEMORY",
+    ]
+    busy_timeout = 60  # seconds to wait for another process holding the write lock.
+    max_idle_readers = 4
+
+    _lock = threading.Lock()
+    _databases = {}
+    _pid = os.getpid()
+    _inherited = []  # connections opened before a fork.  kept referenced so the child never closes them.
+    _trace_callback = None
+
+    @classmethod
+    def connect(cls, database_name: str, pragmas: list = None) -> sqlite3.Connection:
+        """
+        open a connection with the tuned pragmas, in autocommit mode (transactions are begun explicitly).
+        """
+        conn = sqlite3.connect(database_name, check_same_thread = False, timeout = cls.busy_timeout, isolation_level = None)
+        for pragma in (cls.pragmas if pragmas is None else pragmas):
+            conn.execute(pragma).fetchall()
+        conn.set_trace_callback(cls._trace_callback)
+        return conn
+
+    @classmethod
+    @contextmanager
+    def trace(cls, callback):
+        """
+        call callback with each statement run on the connections of this process, with its parameters bound.
+        """
+        def _set(fn):
+            with cls._lock:
+                cls._trace_callback = fn
+                conns = [conn for db in cls._databases.values() for conn in db.readers + [db.writer] if conn is not None]
+            for conn in conns:
+                conn.set_trace_callback(fn)
+        _set(callback)
+        try:
+            yield
+        finally:
+            _set(None)
+
+    @classmethod
+    def _get(cls, database_name: str) -> _SQLiteDatabase:
+        path = os.path.abspath(database_name)
+        with cls._lock:
+            if cls._pid != os.getpid():
+                cls._inherited.append(cls._databases)
+                cls._databases = {}
+                cls._pid = os.getpid()
+            db = cls._databases.get(path, None)
+            if db is None:
+                db = _SQLiteDatabase(path)
+                cls._databases[path] = db
+            return db
+
+    @classmethod
+    @contextmanager
+    def transaction(cls, database_name: str):
+        """
+        yields the writer connection inside a transaction.  nested scopes join the outermost one.
+        """
+        db = cls._get(database_name)
+        with db.lock:
+            if db.depth == 0:
+                if db.writer is None:
+                    db.writer = cls.connect(db.path)
+                db.writer.execute("BEGIN IMMEDIATE")
+                db.owner = threading.get_ident()
+            db.depth += 1
+            try:
+                yield db.writer
+            except BaseException:
+                db.depth -= 1
+                if db.depth == 0:
+                    db.owner = None
+                    db.pending = {}
+                    if db.writer.in_transaction:
+                        db.writer.rollback()
+                raise
+            else:
+                db.depth -= 1
+                if db.depth == 0:
+                    db.owner = None
+                    (pending, db.pending) = (db.pending, {})
+                    db.writer.commit()
+                    for (table_name, ids) in pending.items():
+                        db.lookups[table_name].update(ids.maps[0])
+
+    @classmethod
+    def lookup_cache(cls, database_name: str, table_name: str) -> collections.ChainMap:
+        """
+        cached {value: id} of a lookup table.  only inside a transaction scope:  ids added to it are kept when the
+        outermost scope commits, and dropped if it rolls back.
+        """
+        db = cls._get(database_name)
+        if db.owner != threading.get_ident():
+            raise ValueError(f"lookup cache of {table_name} used outside a transaction")
+        if table_name not in db.pending:
+            db.pending[table_name] = collections.ChainMap({}, db.lookups.setdefault(table_name, {}))
+        return db.pending[table_name]
+
+    @classmethod
+    @contextmanager
+    def reader(cls, database_name: str):
+        """
+        yields a connection for reading.  inside a transaction scope of this thread, that is the writer.
+        """
+        db = cls._get(database_name)
+        if db.owner == threading.get_ident():
+            yield db.writer
+            return
+        with cls._lock:
+            conn = db.readers.pop() if len(db.readers) > 0 else None
+        if conn is None:
+            conn = cls.connect(db.path)
+        try:
+            yield conn
+        finally:
+            with cls._lock:
+                if (not db.closed) and (len(db.readers) < cls.max_idle_readers):
+                    db.readers.append(conn)
+                    conn = None
+            if conn is not None:
+                conn.close()
+
+    @classmethod
+    def close(cls, database_name: str = None):
+        """
+        close the connections to a database, or to all databases.  waits for open transactions to finish.
+        """
+        if cls._pid != os.getpid():
+            return
+        with cls._lock:
+            if database_name is None:
+                dbs = list(cls._databases.values())
+                cls._databases = {}
+            else:
+                db = cls._databases.pop(os.path.abspath(database_name), None)
+                dbs = [db] if db is not None else []
+        for db in dbs:
+            with db.lock:
+                with cls._lock:
+                    db.closed = True
+                    conns = db.readers
+                    db.readers = []
+                if db.writer is not None:
+                    conns.append(db.writer)
+                    db.writer = None
+                for conn in conns:
+                    conn.close()
+
+atexit.register(SQLiteConnections.close)
+
+
 #TODO: incrementally process the parameters.
 #TODO: check length of where clause.
 
@@ -17,7 +216,19 @@ class SQLiteDB:
     # set a class variable for verbosity
     chunk_size = 1000
     max_where_clause = 200000
+    max_params = 900  # below the sqlite limit on bound parameters in a statement
+    insert_returning = sqlite3.sqlite_version_info >= (3, 35, 0)
     
+    # group writes into one transaction:  with SQLiteDB.transaction(database_name): ...
+    @classmethod
+    def transaction(cls, database_name: str):
+        return SQLiteConnections.transaction(database_name)
+
+    # close the connections, e.g. before the database file is copied.
+    @classmethod
+    def close(cls, database_name: str = None):
+        SQLiteConnections.close(database_name)
+
     @classmethod
     def _make_select_stmt(cls, 
                          table_or_subquery:str, 
@@ -80,7 +291,7 @@ class SQLiteDB:
             select_str += f" GROUP BY {','.join(groupby)}"
         
         # print(select_str)
-        with sqlite3.connect(database_name, check_same_thread=False) as conn:
+        with SQLiteConnections.reader(database_name) as conn:
             with closing(conn.cursor()) as cur:
                 res = cur.execute(select_str)
                 if (max_return is None) or (max_return == 0):
@@ -141,7 +352,7 @@ class SQLiteDB:
 
         # print(select_stmt)
 
-        with sqlite3.connect(database_name, check_same_thread=False) as conn:
+        with SQLiteConnections.reader(database_name) as conn:
             with closing(conn.cursor()) as cur:
                 res = cur.execute(select_stmt)
                 
@@ -168,7 +379,7 @@ class SQLiteDB:
         columns = ', '.join([f"{k} {v} {prop}" for (k, v, prop) in column_types])
         foreigns = ', '.join([f"FOREIGN KEY ({lid}) REFERENCES {tab}({fid}) ON UPDATE RESTRICT ON DELETE RESTRICT" for (lid, tab, fid) in foreign_keys]) if foreign_keys is not None else ""
         indexes = ', '.join(index_on) if index_on is not None else ""
-        with sqlite3.connect(database_name, check_same_thread=False) as conn:
+        with SQLiteConnections.transaction(database_name) as conn:
             with closing(conn.cursor()) as cur:
                 if foreign_keys is not None:
                     log.debug(f"CREATE TABLE IF NOT EXISTS {table_name} ({columns}, {foreigns})")
@@ -178,7 +389,6 @@ class SQLiteDB:
                     cur.execute(f"CREATE TABLE IF NOT EXISTS {table_name} ({columns})")
                 if index_on is not None:
                     cur.execute(f"CREATE INDEX IF NOT EXISTS {table_name}_idx ON {table_name} ({indexes})")
-            conn.commit()
         
     # create a lookup table.  
     @classmethod
@@ -194,36 +404,36 @@ class SQLiteDB:
             index_on = [column_name, ])
 
     # insert and retrieve lookup table value,
+    # ids are cached per process (SQLiteConnections.lookup_cache), so only values not seen before reach the database.
     @classmethod
     def insert_lookup_table(cls, database_name: str, table_name: str, column_name: str, lookup: set):
         # if lookup is empty, return the whole lookup table.
-        
-        if lookup is not None and len(lookup) > 0:
-            lookup_list = list(lookup)
-            for i in range(0, len(lookup_list), cls.chunk_size):
-                batch = lookup_list[i:min(i + cls.chunk_size, len(lookup_list))]
-                insert_args = [(val,) for val in batch]
-                SQLiteDB.insert(database_name=database_name,
-                        table_name=table_name,
-                        columns=[column_name,],
-                        params=insert_args,
-                        unique=True)
-        # query to fill the dictionary
-        value_ids = []
-        if lookup is not None and (len(lookup) > 0):
-            for i in range(0, len(lookup), cls.chunk_size):
-                batch = lookup_list[i:min(i + cls.chunk_size, len(lookup_list))]
-                where_clause = column_name + " in (" + ",".join([f"'{val}'" for val in batch]) + ")"
-                value_ids.extend(SQLiteDB.query(database_name = database_name,
-                                                table_name = table_name,
-                                                columns = ['id', column_name],
-                                                where_clause = where_clause))
-        else:
+        if lookup is None or len(lookup) == 0:
             value_ids = SQLiteDB.query(database_name = database_name,
                                         table_name = table_name,
                                         columns = ['id', column_name],
                                         where_clause = None)
-        return {val: val_id for (val_id, val) in value_ids}
+            return {val: val_id for (val_id, val) in value_ids}
+
+        with SQLiteConnections.transaction(database_name) as conn:
+            ids = SQLiteConnections.lookup_cache(database_name, table_name)
+            missing = [val for val in lookup if val not in ids]
+            if len(missing) > 0:
+                with closing(conn.cursor()) as cur:
+                    if cls.insert_returning:
+                        for val in missing:
+                            row = cur.execute(f"INSERT OR IGNORE INTO {table_name} ({column_name}) VALUES (?) RETURNING id", (val,)).fetchone()
+                            if row is not None:
+                                ids[val] = row[0]
+                    else:
+                        cur.executemany(f"INSERT OR IGNORE INTO {table_name} ({column_name}) VALUES (?)", [(val,) for val in missing])
+                    # values already in the table, e.g. added before this process opened the database.
+                    missing = [val for val in missing if val not in ids]
+                    for i in range(0, len(missing), cls.max_params):
+                        batch = missing[i:i + cls.max_params]
+                        rows = cur.execute(f"SELECT id, {column_name} FROM {table_name} WHERE {column_name} IN ({', '.join('?' * len(batch))})", batch).fetchall()
+                        ids.update({val: val_id for (val_id, val) in rows})
+            return {val: ids[val] for val in lookup if val in ids}
 
 
     # columns is a list of columns names
@@ -241,7 +451,7 @@ class SQLiteDB:
         fields = ', '.join(columns)
         placeholders = ', '.join('?' * len(columns))
         inserted = 0
-        with sqlite3.connect(database_name, check_same_thread=False) as conn:
+        with SQLiteConnections.transaction(database_name) as conn:
             with closing(conn.cursor()) as cur:
                 try:
                     if unique is not None and unique:
@@ -260,8 +470,6 @@ class SQLiteDB:
                 except sqlite3.ProgrammingError as e:
                     log.error(f"insert {e}")
                     log.debug(params)
-
-            conn.commit()
         return inserted
 
     # columns is a list of columns names
@@ -282,7 +490,7 @@ class SQLiteDB:
         values = ', '.join(params)
         inserted = 0
         lastrowid = None
-        with sqlite3.connect(database_name, check_same_thread=False) as conn:
+        with SQLiteConnections.transaction(database_name) as conn:
             with closing(conn.cursor()) as cur:
                 try:
                     if unique:
@@ -302,8 +510,6 @@ class SQLiteDB:
                 except sqlite3.ProgrammingError as e:
                     log.error(f"insert {e}")
                     log.debug(params)
-
-            conn.commit()
         return inserted, lastrowid
 
     # sets is a list of string predicates "column_name = value", where value may be '?'
@@ -329,7 +535,7 @@ class SQLiteDB:
             log.warning(f"UPDATE where clause is long: {where_clause}")
         
         count = 0
-        with sqlite3.connect(database_name, check_same_thread=False) as conn:
+        with SQLiteConnections.transaction(database_name) as conn:
             with closing(conn.cursor()) as cur:
                 try:
                     log.debug(f"UPDATE {table_name} SET {set_str} {where_str}")
@@ -344,8 +550,6 @@ class SQLiteDB:
                 except sqlite3.ProgrammingError as e:
                     log.error(f"update {e}")
                     log.debug(params)
-                
-            conn.commit()
         return count
     
     @classmethod
@@ -360,7 +564,7 @@ class SQLiteDB:
         where_str = "" if (where_clause is None) or (where_clause == "") else f" WHERE {where_clause}"
 
         count = 0
-        with sqlite3.connect(database_name, check_same_thread=False) as conn:
+        with SQLiteConnections.transaction(database_name) as conn:
             with closing(conn.cursor()) as cur:
                 try:
                     log.debug(f"UPDATE {table_name} SET {set_str} {where_str}")
@@ -375,15 +579,55 @@ class SQLiteDB:
                 except sqlite3.ProgrammingError as e:
                     log.error(f"update {e}")
                     log.debug(sets)
-                
-            conn.commit()
         return count
     
 
 
+    # where_clause is a string with '?' placeholders matching params
+    @classmethod
+    def delete(cls, database_name: str, table_name: str, where_clause: str, params: tuple = ()):
+        with SQLiteConnections.transaction(database_name) as conn:
+            with closing(conn.cursor()) as cur:
+                log.debug(f"DELETE FROM {table_name} WHERE {where_clause}")
+                cur.execute(f"DELETE FROM {table_name} WHERE {where_clause}", params)
+                count = cur.rowcount
+        return count
+
+    # add a column to an existing table, if not already there.  used to upgrade journals in place.
+    @classmethod
+    def add_column(cls, database_name: str, table_name: str, column_name: str, column_type: str):
+        with SQLiteConnections.transaction(database_name) as conn:
+            with closing(conn.cursor()) as cur:
+                columns = [row[1] for row in cur.execute(f"PRAGMA table_info({table_name})").fetchall()]
+                if column_name in columns:
+                    return False
+                log.info(f"adding column {column_name} to {table_name}")
+                cur.execute(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}")
+        return True
+
+    # create an index, if not already there.  where_clause makes it a partial index.  used to upgrade journals in place.
+    @classmethod
+    def create_index(cls, database_name: str, table_name: str, index_name: str, columns: list, where_clause: str = None):
+        where_str = "" if (where_clause is None) or (where_clause == "") else f" WHERE {where_clause}"
+        with SQLiteConnections.transaction(database_name) as conn:
+            with closing(conn.cursor()) as cur:
+                if cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (index_name,)).fetchone() is not None:
+                    return False
+                log.info(f"adding index {index_name} to {table_name}")
+                cur.execute(f"CREATE INDEX {index_name} ON {table_name} ({', '.join(columns)}){where_str}")
+        return True
+
+    # run a parameterized select statement, for queries that do not fit query() or query_with_left_join()
+    @classmethod
+    def query_stmt(cls, database_name: str, stmt: str, params: tuple = ()):
+        with SQLiteConnections.reader(database_name) as conn:
+            with closing(conn.cursor()) as cur:
+                vals = cur.execute(stmt, params).fetchall()
+        return vals
+
     @classmethod
     def get_max_value(cls, database_name: str, table_name: str, column_name: str):
-        with sqlite3.connect(database_name, check_same_thread=False) as conn:
+        with SQLiteConnections.reader(database_name) as conn:
             with closing(conn.cursor()) as cur:
                 val = cur.execute(f"SELECT MAX({column_name}) FROM {table_name}").fetchone()[0]
         return val
@@ -393,7 +637,7 @@ class SQLiteDB:
                           table_name: str, 
                           column_name: str,
                           max_return: int = None):
-        with sqlite3.connect(database_name, check_same_thread=False) as conn:
+        with SQLiteConnections.reader(database_name) as conn:
             with closing(conn.cursor()) as cur:
                 res = cur.execute(f"SELECT DISTINCT {column_name} FROM {table_name}")
                 if (max_return is None) or (max_return == 0):
@@ -477,6 +721,11 @@ class CommandHistoryDispatcher:
             raise ValueError(f"Unsupported Journal version {dbver}")
 
 
+# MD5 of a file scanned with journal update --defer-hash.  the MD5 column is NOT NULL in journal v2, so a pending MD5
+# is stored as an empty string.  the upload computes the MD5 while streaming the file, and writes it back.
+PENDING_MD5 = ""
+
+
 # create dispatch class
 class JournalDispatcher:
     
@@ -512,15 +761,24 @@ class JournalDispatcher:
         else:
             raise ValueError(f"Unsupported Journal version {dbver}")
     
+    # add the tables, columns and indexes introduced since an existing journal was created.  run by every command
+    # that opens a journal, since queries read the new columns.  does not create a journal.
+    @classmethod
+    def upgrade_in_place(cls, database_name: str):
+        if cls.table_exists(database_name):
+            cls.create_journal_table(database_name)
+
     @classmethod
     def insert_journal_entries(cls, database_name: str, params: list) -> int:
         dbver = cls._get_version(database_name)
-        if dbver == 1:
-            return JournalTableV1.insert_journal_entries(database_name, params)
-        elif dbver == 2:
-            return JournalTableV2.insert_journal_entries(database_name, params)
-        else:
-            raise ValueError(f"Unsupported Journal version {dbver}")
+        # lookup tables and journal rows commit together.
+        with SQLiteDB.transaction(database_name):
+            if dbver == 1:
+                return JournalTableV1.insert_journal_entries(database_name, params)
+            elif dbver == 2:
+                return JournalTableV2.insert_journal_entries(database_name, params)
+            else:
+                raise ValueError(f"Unsupported Journal version {dbver}")
     
     @classmethod
     def inactivate_journal_entries(cls, database_name: str, invalidate_time: int, file_states: list):
@@ -535,12 +793,14 @@ class JournalDispatcher:
     @classmethod
     def mark_as_uploaded_with_duration(cls, database_name: str, update_args: list):
         dbver = cls._get_version(database_name)
-        if dbver == 1:
-            return JournalTableV1.mark_as_uploaded_with_duration(database_name, update_args)
-        elif dbver == 2:
-            return JournalTableV2.mark_as_uploaded_with_duration(database_name, update_args)
-        else:
-            raise ValueError(f"Unsupported Journal version {dbver}")
+        # lookup tables and journal rows commit together.
+        with SQLiteDB.transaction(database_name):
+            if dbver == 1:
+                return JournalTableV1.mark_as_uploaded_with_duration(database_name, update_args)
+            elif dbver == 2:
+                return JournalTableV2.mark_as_uploaded_with_duration(database_name, update_args)
+            else:
+                raise ValueError(f"Unsupported Journal version {dbver}")
     
     @classmethod
     def mark_as_uploaded(cls, database_name: str, version: str, upload_args: list):
@@ -604,6 +864,100 @@ class JournalDispatcher:
         else:
             raise ValueError(f"Unsupported Journal version {dbver}")
 
+    # scanned is a ScanSession holding the paths seen during a journal scan.
+    @classmethod
+    def get_unscanned_active_files(cls, scanned: "ScanSession", modality: str):
+        if scanned.dbver == 1:
+            return JournalTableV1.get_unscanned_active_files(scanned, modality)
+        elif scanned.dbver == 2:
+            return JournalTableV2.get_unscanned_active_files(scanned, modality)
+        else:
+            raise ValueError(f"Unsupported Journal version {scanned.dbver}")
+
+    # join: active entries of the modality whose path is in the scanned set.  returns list of (path, file_id, size, mtime, md5, upload_dt, version)
+    @classmethod
+    def get_scanned_active_files(cls, scanned: "ScanSession", modality: str):
+        if scanned.dbver == 1:
+            return JournalTableV1.get_scanned_active_files(scanned, modality)
+        elif scanned.dbver == 2:
+            return JournalTableV2.get_scanned_active_files(scanned, modality)
+        else:
+            raise ValueError(f"Unsupported Journal version {scanned.dbver}")
+
+    # {file_id: (block_size, block_md5)} for the entries that have digests.  journal v1 does not store digests.
+    @classmethod
+    def get_digests(cls, database_name: str, file_ids: list) -> dict:
+        dbver = cls._get_version(database_name)
+        if dbver == 1:
+            return {}
+        elif dbver == 2:
+            return JournalTableV2.get_digests(database_name, file_ids)
+        else:
+            raise ValueError(f"Unsupported Journal version {dbver}")
+
+    # copy the active entries of the modality into the session's sorted temp table.  returns the count.
+    @classmethod
+    def load_active_files_sorted(cls, session: "ScanSession", modality: str) -> int:
+        if session.dbver == 1:
+            return JournalTableV1.load_active_files_sorted(session, modality)
+        elif session.dbver == 2:
+            return JournalTableV2.load_active_files_sorted(session, modality)
+        else:
+            raise ValueError(f"Unsupported Journal version {session.dbver}")
+
+    # query plans of the read queries, for journal check-indexes.  returns [(query, statement, plan, full scans)]
+    @classmethod
+    def explain_queries(cls, database_name: str) -> list:
+        dbver = cls._get_version(database_name)
+        if dbver == 2:
+            return JournalTableV2.explain_queries(database_name)
+        else:
+            raise ValueError(f"Query plans are checked for journal version 2 only, not {dbver}.  Please upgrade the journal first.")
+
+    # pair files added in this update with files deleted in the same update, by size and md5.  returns count of moved files.
+    @classmethod
+    def mark_moved_files(cls, database_name: str, modality: str, curtimestamp: int) -> int:
+        dbver = cls._get_version(database_name)
+        if dbver == 1:
+            return JournalTableV1.mark_moved_files(database_name, modality, curtimestamp)
+        elif dbver == 2:
+            return JournalTableV2.mark_moved_files(database_name, modality, curtimestamp)
+        else:
+            raise ValueError(f"Unsupported Journal version {dbver}")
+
+    # directory mtimes and entry counts recorded by the last scan of the modality.  returns {reldir: (mtime_ns, nentries)}
+    @classmethod
+    def load_dir_index(cls, database_name: str, modality: str) -> dict:
+        dbver = cls._get_version(database_name)
+        if dbver == 1:
+            return JournalTableV1.load_dir_index(database_name, modality)
+        elif dbver == 2:
+            return JournalTableV2.load_dir_index(database_name, modality)
+        else:
+            raise ValueError(f"Unsupported Journal version {dbver}")
+
+    # replace the recorded directories of the modality.  dirs is {reldir: (mtime_ns, nentries)}
+    @classmethod
+    def save_dir_index(cls, database_name: str, modality: str, dirs: dict) -> int:
+        dbver = cls._get_version(database_name)
+        if dbver == 1:
+            return JournalTableV1.save_dir_index(database_name, modality, dirs)
+        elif dbver == 2:
+            return JournalTableV2.save_dir_index(database_name, modality, dirs)
+        else:
+            raise ValueError(f"Unsupported Journal version {dbver}")
+
+    # active, not uploaded files that were moved from an uploaded file.  returns {file_id: (src_file_id, src_path, src_modality, src_version)}
+    @classmethod
+    def get_moved_files(cls, database_name: str, modalities: list) -> dict:
+        dbver = cls._get_version(database_name)
+        if dbver == 1:
+            return JournalTableV1.get_moved_files(database_name, modalities)
+        elif dbver == 2:
+            return JournalTableV2.get_moved_files(database_name, modalities)
+        else:
+            raise ValueError(f"Unsupported Journal version {dbver}")
+
 class CommandHistoryTableV1:
     table_name = "command_history"
     
@@ -698,6 +1052,8 @@ class JournalTableV1:
     # list is a list of tuples
     @classmethod
     def insert_journal_entries(cls, database_name: str, params: list) -> int:
+        # the trailing prehash and digests are not stored in journal v1.
+        params = [p[:11] for p in params]
         return SQLiteDB.insert(database_name = database_name, 
                            table_name = cls.table_name,
                            columns = [
@@ -731,12 +1087,20 @@ class JournalTableV1:
     @classmethod
     def mark_as_uploaded_with_duration(cls, database_name: str, 
                             update_args: list):
+        # update_args are (upload_dt, upload_duration, verify_duration, file_id, md5).  md5 is set if computed by the upload.
+        md5_args = [(md5, fid) for (_, _, _, fid, md5) in update_args if md5 is not None]
+        if len(md5_args) > 0:
+            SQLiteDB.update(database_name = database_name,
+                            table_name = cls.table_name,
+                            sets = ["md5=?"],
+                            params = md5_args,
+                            where_clause="file_id=?")
         return SQLiteDB.update(database_name = database_name, 
                                 table_name = cls.table_name,
                                 sets = ["upload_dtstr=?", 
                                         "upload_duration=?",
                                         "verify_duration=?"],
-                                params = update_args,
+                                params = [p[:4] for p in update_args],
                                 where_clause="file_id=?"
                                 )
     
@@ -811,11 +1175,15 @@ class JournalTableV1:
         where_clause = cls._make_where_clause(version, modalities, **kwargs)
         max_return = kwargs.get("count", None)
             
-        return SQLiteDB.query(database_name = database_name,
+        result = SQLiteDB.query(database_name = database_name,
                         table_name = cls.table_name,
                         columns = ["FILE_ID", "FILEPATH", "SRC_MODTIME_us", "SIZE", "MD5", "MODALITY", "TIME_INVALID_us", "VERSION", "UPLOAD_DTSTR"],
                         where_clause = where_clause,
                         max_return = max_return)
+        # v1 journals do not store prehashes.
+        if kwargs.get("with_prehash", False):
+            return [row + (None,) for row in result]
+        return result
 
 
     @classmethod
@@ -872,6 +1240,45 @@ class JournalTableV1:
                                       table_name = cls.table_name,
                                       column_name = "VERSION")
 
+    # anti-join: active entries of the modality whose path is not in the scanned set.  returns list of (file_id, path)
+    @classmethod
+    def get_unscanned_active_files(cls, scanned: "ScanSession", modality: str):
+        return scanned.query(f"SELECT FILE_ID, FILEPATH FROM {cls.table_name} j"
+                             " WHERE j.TIME_INVALID_us IS NULL AND j.MODALITY = ?"
+                             f" AND NOT EXISTS (SELECT 1 FROM temp.{scanned.table_name} t WHERE t.FILEPATH = j.FILEPATH)",
+                             (modality,))
+
+    @classmethod
+    def get_scanned_active_files(cls, scanned: "ScanSession", modality: str):
+        return scanned.query("SELECT j.FILEPATH, j.FILE_ID, j.SIZE, j.SRC_MODTIME_us, j.MD5, j.UPLOAD_DTSTR, j.VERSION, NULL"
+                             f" FROM {cls.table_name} j JOIN temp.{scanned.table_name} t ON t.FILEPATH = j.FILEPATH"
+                             " WHERE j.TIME_INVALID_us IS NULL AND j.MODALITY = ?",
+                             (modality,))
+
+    @classmethod
+    def load_active_files_sorted(cls, session: "ScanSession", modality: str) -> int:
+        return session.load_active_files("SELECT FILEPATH, FILE_ID, SIZE, SRC_MODTIME_us, MD5, UPLOAD_DTSTR, VERSION, NULL"
+                                         f" FROM {cls.table_name} WHERE TIME_INVALID_us IS NULL AND MODALITY = ?",
+                                         (modality,))
+
+    # v1 journals do not record moves.  moved files are uploaded again.
+    @classmethod
+    def mark_moved_files(cls, database_name: str, modality: str, curtimestamp: int) -> int:
+        return 0
+
+    @classmethod
+    def get_moved_files(cls, database_name: str, modalities: list) -> dict:
+        return {}
+
+    # v1 journals do not record directory mtimes.  every file is stat'd.
+    @classmethod
+    def load_dir_index(cls, database_name: str, modality: str) -> dict:
+        return {}
+
+    @classmethod
+    def save_dir_index(cls, database_name: str, modality: str, dirs: dict) -> int:
+        return 0
+
 
 class CommandHistoryTableV2:
     table_name = "command_history_v2"
@@ -941,6 +1348,26 @@ class JournalTableV2:
     
     profiling = False  # set to True to enable performance measurement.
     table_name = "journal_v2"
+    dir_table_name = "dir_mtimes"
+
+    # indexes on journal_v2, as (name, columns, partial index condition).
+    #
+    #   index                   serves
+    #   journal_v2_path_idx     entries at a path:  mark_moved_files, get_scanned_active_files
+    #   journal_v2_active_idx   active entries of a modality:  journal update, get_files(active = True)
+    #   journal_v2_pending_idx  active entries not yet uploaded (the upload queue):  file upload, get_moved_files
+    #   journal_v2_invalid_idx  entries inactivated by an update:  mark_moved_files, get_files(active = False)
+    #   journal_v2_version_idx  entries of a version, active or not
+    #
+    # the partial indexes only hold the rows matching their condition, so the upload queue index stays small
+    # once files are uploaded.  "journal check-indexes" reports the query plans of the dispatcher queries.
+    indexes = [
+        ("journal_v2_path_idx", ["SRC_PATH_ID", "FILENAME"], None),
+        ("journal_v2_active_idx", ["MODALITY_ID", "VERSION_ID"], "TIME_INVALID_us IS NULL"),
+        ("journal_v2_pending_idx", ["MODALITY_ID", "VERSION_ID"], "TIME_INVALID_us IS NULL AND UPLOAD_DT_ID IS NULL"),
+        ("journal_v2_invalid_idx", ["TIME_INVALID_us"], "TIME_INVALID_us IS NOT NULL"),
+        ("journal_v2_version_idx", ["VERSION_ID", "MODALITY_ID"], None),
+    ]
     
     @classmethod
     def create_journal_table(cls, database_name: str):
@@ -986,12 +1413,38 @@ class JournalTableV2:
                 ("UPLOAD_DT_ID", "INTEGER", ""),  # upload timestamp, used as query filter (a flag), and as a record.
                 ("VERSION_ID", "INTEGER", "NOT NULL"), # matches the cloud directory. required
                 # ("STATE", "TEXT", ""),  # set but not used.  possible value ADDED, UPDATED, DELETED, OUTDATED, MOVED
+                ("MOVED_FROM_ID", "INTEGER", ""),  # uploaded file with the same content at another path.  copied server side on upload.
+                ("PREHASH", "TEXT", ""),  # sampled-content hash of large local files, for classifying mtime changes.  optional
+                ("BLOCK_SIZE", "INTEGER", ""),  # optional digests computed with the MD5, see storage_helper.FileDigests
+                ("BLOCK_MD5", "BLOB", ""),
                 ],
             foreign_keys = [ ("SRC_PATH_ID", "srcpaths", "id"),
                              ("MODALITY_ID", "modalities", "id"),
                              ("UPLOAD_DT_ID", "uploads", "id"),
                              ("VERSION_ID", "versions", "id")],
             index_on = None) # index on SRC_PATH_ID
+        # journals created before MOVED_FROM_ID was added.
+        SQLiteDB.add_column(database_name, cls.table_name, "MOVED_FROM_ID", "INTEGER")
+        SQLiteDB.add_column(database_name, cls.table_name, "PREHASH", "TEXT")
+        SQLiteDB.add_column(database_name, cls.table_name, "BLOCK_SIZE", "INTEGER")
+        SQLiteDB.add_column(database_name, cls.table_name, "BLOCK_MD5", "BLOB")
+        # journals created before the indexes were added.
+        for (index_name, columns, where_clause) in cls.indexes:
+            SQLiteDB.create_index(database_name, cls.table_name, index_name, columns, where_clause)
+
+        # directory mtimes from the last scan, for skipping stats of unchanged directories.
+        SQLiteDB.create_table(
+            database_name = database_name,
+            table_name = cls.dir_table_name,
+            column_types = [
+                ("SRC_PATH_ID", "INTEGER", "NOT NULL"),  # directory, relative to the modality root.  '.' for the root
+                ("MODALITY_ID", "INTEGER", "NOT NULL"),
+                ("MTIME_ns", "INTEGER", "NOT NULL"),
+                ("NENTRIES", "INTEGER", "NOT NULL"),  # files and subdirectories
+                ],
+            foreign_keys = [ ("SRC_PATH_ID", "srcpaths", "id"),
+                             ("MODALITY_ID", "modalities", "id")],
+            index_on = ["MODALITY_ID", "SRC_PATH_ID"])
                         
         if cls.profiling:
             profile_db = database_name.replace(".db", "_profile.db")
@@ -1018,7 +1471,7 @@ class JournalTableV2:
         uploads = set()
         versions = set()
         parent_paths = set()
-        for (pid, fpath, mod, mtime, size, md5, valid_time, upload, state, md5_dur, ver) in params:
+        for (pid, fpath, mod, mtime, size, md5, valid_time, upload, state, md5_dur, ver, prehash, digests) in params:
             # get file parent path and filename using pathlib
             # print(f"add parent path from {fpath} as {Path(fpath).parent.as_posix()}")
             parent_paths.add(Path(fpath).parent.as_posix())
@@ -1057,7 +1510,7 @@ class JournalTableV2:
         # formulate the args for the new journal entries.
         new_params = []
         filenames = set()
-        for (pid, fpath, mod, mtime, size, md5, valid_time, upload, state, md5_dur, ver) in params:
+        for (pid, fpath, mod, mtime, size, md5, valid_time, upload, state, md5_dur, ver, prehash, digests) in params:
             path = Path(fpath)
             # print(f"path {fpath} parent {path.parent.as_posix()} name {path.name}.  parent_paths {parent_paths}, parent_dict {parent_dict} ")
             
@@ -1065,7 +1518,9 @@ class JournalTableV2:
             mod_id = modalities_dict[mod]
             upload_id = uploads_dict[upload] if upload is not None else None
             ver_id = versions_dict[ver]
-            new_params.append( (pid, parent_id, path.name, mod_id, mtime, size, md5, valid_time, upload_id, ver_id))
+            (block_size, block_md5) = digests if digests is not None else (None, None)
+            new_params.append( (pid, parent_id, path.name, mod_id, mtime, size, md5, valid_time, upload_id, ver_id, prehash,
+                                block_size, block_md5))
             
             filenames.add(fpath)
             
@@ -1082,6 +1537,9 @@ class JournalTableV2:
                                "TIME_VALID_us", 
                                "UPLOAD_DT_ID",
                                "VERSION_ID", 
+                               "PREHASH",
+                               "BLOCK_SIZE",
+                               "BLOCK_MD5",
                                ],
                             params = new_params)
 
@@ -1097,7 +1555,7 @@ class JournalTableV2:
 
             # Prepare performance parameters
             perf_params = []
-            for (pid, fpath, mod, mtime, size, md5, valid_time, upload, state, md5_dur, ver) in params:
+            for (pid, fpath, mod, mtime, size, md5, valid_time, upload, state, md5_dur, ver, prehash, digests) in params:
                 perf_params.append((fids[fpath], state, md5_dur))
                 
             # insert the performance parameters.
@@ -1141,9 +1599,13 @@ class JournalTableV2:
         # update the uploads table first
         uploads = set()
         perf_params = []
-        for (upload_dt, upload_dur, verify_dur, fid) in update_args:
+        md5_args = []
+        for (upload_dt, upload_dur, verify_dur, fid, md5) in update_args:
             uploads.add(upload_dt)
             perf_params.append((upload_dur, verify_dur, fid))
+            if md5 is not None:
+                # computed by the upload, for files scanned with --defer-hash.
+                md5_args.append((md5, fid))
             
         # insert upload timestamp and get he corresponding ids
         uploads = SQLiteDB.insert_lookup_table(database_name = database_name,
@@ -1161,7 +1623,13 @@ class JournalTableV2:
                             where_clause="FILE_ID=?")
         
         # update the journal table
-        journal_args = [(uploads[upload_dt], fid) for (upload_dt, _, _, fid) in update_args]
+        if len(md5_args) > 0:
+            SQLiteDB.update(database_name = database_name,
+                            table_name = cls.table_name,
+                            sets = ["MD5=?"],
+                            params = md5_args,
+                            where_clause="file_id=?")
+        journal_args = [(uploads[upload_dt], fid) for (upload_dt, _, _, fid, _) in update_args]
         
         return SQLiteDB.update(database_name = database_name, 
                                 table_name = cls.table_name,
@@ -1257,6 +1725,10 @@ class JournalTableV2:
             ("versions.VERSION", "version"),
             ("uploads.UPLOAD_DT", "upload_dtstr"),
         ]
+        # with_prehash appends the PREHASH of each entry, for journal update.
+        with_prehash = kwargs.get("with_prehash", False)
+        if with_prehash:
+            columns.append(("PREHASH", None))
         join_criteria = [
             ("srcpaths", "srcpaths.id", f"{cls.table_name}.SRC_PATH_ID"),
             ("modalities", "modalities.id", f"{cls.table_name}.MODALITY_ID"),
@@ -1273,6 +1745,8 @@ class JournalTableV2:
                         max_return = max_return)
 
         # create a generator to yield the results
+        if with_prehash:
+            return [(fid, (Path(srcpath) / fn).as_posix(), mtime, size, md5, mod, invalidtime, ver, uploaddt, prehash) for (fid, srcpath, fn, mtime, size, md5, mod, invalidtime, ver, uploaddt, prehash) in result]
         return [(fid, (Path(srcpath) / fn).as_posix(), mtime, size, md5, mod, invalidtime, ver, uploaddt) for (fid, srcpath, fn, mtime, size, md5, mod, invalidtime, ver, uploaddt) in result]
 
     @classmethod
@@ -1366,6 +1840,461 @@ class JournalTableV2:
                          where_clause = None,
                          max_return = None)
 
+    @classmethod
+    def get_digests(cls, database_name: str, file_ids: list) -> dict:
+        digests = {}
+        file_ids = list(file_ids)
+        # stay below the sqlite parameter limit.
+        for start in range(0, len(file_ids), 900):
+            chunk = file_ids[start:start + 900]
+            rows = SQLiteDB.query_stmt(database_name,
+                                       f"SELECT FILE_ID, BLOCK_SIZE, BLOCK_MD5 FROM {cls.table_name}"
+                                       f" WHERE FILE_ID IN ({', '.join('?' * len(chunk))})"
+                                       " AND BLOCK_MD5 IS NOT NULL", tuple(chunk))
+            digests.update({fid: (block_size, block_md5) for (fid, block_size, block_md5) in rows})
+        return digests
+
+    # anti-join: active entries of the modality whose path is not in the scanned set.  returns list of (file_id, path)
+    @classmethod
+    def get_unscanned_active_files(cls, scanned: "ScanSession", modality: str):
+        result = scanned.query(f"SELECT j.FILE_ID, s.SRC_PATH, j.FILENAME FROM {cls.table_name} j"
+                               " JOIN srcpaths s ON s.id = j.SRC_PATH_ID"
+                               " WHERE j.TIME_INVALID_us IS NULL"
+                               " AND j.MODALITY_ID IN (SELECT id FROM modalities WHERE MODALITY = ?)"
+                               f" AND NOT EXISTS (SELECT 1 FROM temp.{scanned.table_name} t WHERE t.SRC_PATH = s.SRC_PATH AND t.FILENAME = j.FILENAME)",
+                               (modality,))
+        return [(fid, (Path(srcpath) / fn).as_posix()) for (fid, srcpath, fn) in result]
+
+    @classmethod
+    def get_scanned_active_files(cls, scanned: "ScanSession", modality: str):
+        return scanned.query("SELECT t.FILEPATH, j.FILE_ID, j.SIZE, j.SRC_MODTIME_us, j.MD5, u.UPLOAD_DT, v.VERSION, j.PREHASH"
+                             f" FROM temp.{scanned.table_name} t"
+                             " JOIN srcpaths s ON s.SRC_PATH = t.SRC_PATH"
+                             f" JOIN {cls.table_name} j ON j.SRC_PATH_ID = s.id AND j.FILENAME = t.FILENAME"
+                             " LEFT JOIN uploads u ON u.id = j.UPLOAD_DT_ID"
+                             " LEFT JOIN versions v ON v.id = j.VERSION_ID"
+                             " WHERE j.TIME_INVALID_us IS NULL"
+                             " AND j.MODALITY_ID IN (SELECT id FROM modalities WHERE MODALITY = ?)",
+                             (modality,))
+
+    @classmethod
+    def load_active_files_sorted(cls, session: "ScanSession", modality: str) -> int:
+        # path is rebuilt as (Path(SRC_PATH) / FILENAME).as_posix(), so files at the root have SRC_PATH '.'
+        return session.load_active_files("SELECT CASE s.SRC_PATH WHEN '.' THEN j.FILENAME ELSE s.SRC_PATH || '/' || j.FILENAME END,"
+                                         " j.FILE_ID, j.SIZE, j.SRC_MODTIME_us, j.MD5, u.UPLOAD_DT, v.VERSION, j.PREHASH"
+                                         f" FROM {cls.table_name} j"
+                                         " JOIN srcpaths s ON s.id = j.SRC_PATH_ID"
+                                         " LEFT JOIN uploads u ON u.id = j.UPLOAD_DT_ID"
+                                         " LEFT JOIN versions v ON v.id = j.VERSION_ID"
+                                         " WHERE j.TIME_INVALID_us IS NULL"
+                                         " AND j.MODALITY_ID IN (SELECT id FROM modalities WHERE MODALITY = ?)",
+                                         (modality,))
+
+    @classmethod
+    def mark_moved_files(cls, database_name: str, modality: str, curtimestamp: int) -> int:
+        # new:  added in this update, not uploaded.
+        # old:  inactivated in this update, with no active file left at its path (deleted, not outdated), same size and md5.
+        #       either uploaded, or itself moved from an uploaded file (moved twice between uploads).
+        # new files with a pending md5 (--defer-hash) cannot be matched.
+        candidates = SQLiteDB.query_stmt(database_name,
+                                         "SELECT n.FILE_ID, o.FILE_ID, o.UPLOAD_DT_ID, o.MOVED_FROM_ID"
+                                         f" FROM {cls.table_name} n JOIN {cls.table_name} o"
+                                         " ON o.SIZE = n.SIZE AND o.MD5 = n.MD5 AND o.MODALITY_ID = n.MODALITY_ID"
+                                         " WHERE n.TIME_VALID_us = ? AND n.TIME_INVALID_us IS NULL"
+                                         " AND n.UPLOAD_DT_ID IS NULL AND n.MOVED_FROM_ID IS NULL AND n.MD5 <> ?"
+                                         " AND n.MODALITY_ID IN (SELECT id FROM modalities WHERE MODALITY = ?)"
+                                         " AND o.TIME_INVALID_us = ?"
+                                         " AND (o.UPLOAD_DT_ID IS NOT NULL OR o.MOVED_FROM_ID IS NOT NULL)"
+                                         f" AND NOT EXISTS (SELECT 1 FROM {cls.table_name} a"
+                                         "   WHERE a.SRC_PATH_ID = o.SRC_PATH_ID AND a.FILENAME = o.FILENAME AND a.TIME_INVALID_us IS NULL)"
+                                         " ORDER BY n.FILE_ID, o.FILE_ID",
+                                         (curtimestamp, PENDING_MD5, modality, curtimestamp))
+
+        # one to one, in file id order.
+        used = set()
+        paired = set()
+        move_args = []
+        for (new_fid, old_fid, old_upload, old_moved_from) in candidates:
+            if (new_fid in paired) or (old_fid in used):
+                continue
+            paired.add(new_fid)
+            used.add(old_fid)
+            move_args.append((old_fid if old_upload is not None else old_moved_from, new_fid))
+
+        return SQLiteDB.update(database_name = database_name,
+                               table_name = cls.table_name,
+                               sets = ["MOVED_FROM_ID=?"],
+                               params = move_args,
+                               where_clause = "FILE_ID=?")
+
+    @classmethod
+    def load_dir_index(cls, database_name: str, modality: str) -> dict:
+        if not SQLiteDB.table_exists(database_name, cls.dir_table_name):
+            return {}
+        result = SQLiteDB.query_stmt(database_name,
+                                     "SELECT s.SRC_PATH, d.MTIME_ns, d.NENTRIES"
+                                     f" FROM {cls.dir_table_name} d JOIN srcpaths s ON s.id = d.SRC_PATH_ID"
+                                     " WHERE d.MODALITY_ID IN (SELECT id FROM modalities WHERE MODALITY = ?)",
+                                     (modality,))
+        return {reldir: (mtime_ns, nentries) for (reldir, mtime_ns, nentries) in result}
+
+    @classmethod
+    def save_dir_index(cls, database_name: str, modality: str, dirs: dict) -> int:
+        modalities_dict = SQLiteDB.insert_lookup_table(database_name = database_name,
+                                                       table_name = "modalities",
+                                                       column_name = "MODALITY",
+                                                       lookup = set([modality]))
+        mod_id = modalities_dict[modality]
+        SQLiteDB.delete(database_name, cls.dir_table_name, "MODALITY_ID = ?", (mod_id,))
+        if len(dirs) == 0:
+            return 0
+
+        parent_dict = SQLiteDB.insert_lookup_table(database_name = database_name,
+                                                   table_name = "srcpaths",
+                                                   column_name = "SRC_PATH",
+                                                   lookup = set(dirs.keys()))
+        SQLiteDB.insert(database_name = database_name,
+                        table_name = cls.dir_table_name,
+                        columns = ["SRC_PATH_ID", "MODALITY_ID", "MTIME_ns", "NENTRIES"],
+                        params = [(parent_dict[reldir], mod_id, mtime_ns, nentries) for (reldir, (mtime_ns, nentries)) in dirs.items()])
+        return len(dirs)
+
+    @classmethod
+    def get_moved_files(cls, database_name: str, modalities: list) -> dict:
+        where_clause = ""
+        if (modalities is not None) and (len(modalities) > 0):
+            modestr = [f"'{m}'" for m in modalities]
+            where_clause = " AND m.MODALITY in (" + ",".join(modestr) + ")"
+        result = SQLiteDB.query_stmt(database_name,
+                                     "SELECT j.FILE_ID, o.FILE_ID, s.SRC_PATH, o.FILENAME, m.MODALITY, v.VERSION"
+                                     f" FROM {cls.table_name} j JOIN {cls.table_name} o ON o.FILE_ID = j.MOVED_FROM_ID"
+                                     " JOIN srcpaths s ON s.id = o.SRC_PATH_ID"
+                                     " JOIN modalities m ON m.id = j.MODALITY_ID"  # moves are detected within a modality
+                                     " JOIN versions v ON v.id = o.VERSION_ID"
+                                     " WHERE j.MOVED_FROM_ID IS NOT NULL AND j.TIME_INVALID_us IS NULL AND j.UPLOAD_DT_ID IS NULL"
+                                     + where_clause)
+        return {fid: (src_fid, (Path(srcpath) / fn).as_posix(), mod, ver) for (fid, src_fid, srcpath, fn, mod, ver) in result}
+
+    # tables that grow with the number of files, and should not be read in full by a query.
+    large_tables = [table_name, dir_table_name, "srcpaths"]
+    # partial indexes that stay small (the upload queue and the entries inactivated since), so walking all of them is ok.
+    # the active index holds nearly every row, so walking it is a full scan.
+    scannable_indexes = ["journal_v2_pending_idx", "journal_v2_invalid_idx"]
+
+    @classmethod
+    def explain_queries(cls, database_name: str) -> list:
+        """
+        Run the read queries of the dispatcher with sample arguments from the journal, and return their query plans.
+        returns [(query, statement, plan, scans)], where plan lists the EXPLAIN QUERY PLAN details, and scans the large
+        tables that the statement reads in full:  without an index, or through an index other than scannable_indexes.
+        """
+        modality = SQLiteDB.query_stmt(database_name, "SELECT MIN(MODALITY) FROM modalities")[0][0] or "Images"
+        version = cls.get_latest_version(database_name) or ""
+        file_id = SQLiteDB.get_max_value(database_name, cls.table_name, "FILE_ID") or 0
+
+        results = []
+        with ScanSession(database_name) as session:
+            queries = [
+                ("upload queue", lambda: cls.get_files_with_meta(database_name, None, [modality], active = True, uploaded = False, count = 10)),
+                ("upload queue of a version", lambda: cls.get_files_with_meta(database_name, version, [modality], active = True, uploaded = False, count = 10)),
+                ("uploaded files", lambda: cls.get_files_with_meta(database_name, None, [modality], active = True, uploaded = True, count = 10)),
+                ("active files", lambda: cls.get_files_with_meta(database_name, None, [modality], active = True, count = 10)),
+                ("inactive files", lambda: cls.get_files(database_name, None, None, active = False, count = 10)),
+                ("files of a version", lambda: cls.get_files_with_meta(database_name, version, None, count = 10)),
+                ("moved files", lambda: cls.get_moved_files(database_name, [modality])),
+                ("move detection", lambda: cls.mark_moved_files(database_name, modality, -1)),
+                ("digests", lambda: cls.get_digests(database_name, [file_id])),
+                ("directory index", lambda: cls.load_dir_index(database_name, modality)),
+                ("unscanned active files", lambda: cls.get_unscanned_active_files(session, modality)),
+                ("scanned active files", lambda: cls.get_scanned_active_files(session, modality)),
+                ("sorted active files", lambda: cls.load_active_files_sorted(session, modality)),
+            ]
+            for (name, query) in queries:
+                statements = []
+                def _trace(stmt):
+                    if stmt.lstrip().upper().startswith(("SELECT", "INSERT INTO TEMP")) and ("sqlite_master" not in stmt) and \
+                        ((cls.table_name in stmt) or (cls.dir_table_name in stmt)):
+                        statements.append(stmt)
+                session.conn.set_trace_callback(_trace)
+                with SQLiteConnections.trace(_trace):
+                    query()
+                session.conn.set_trace_callback(None)
+                for stmt in statements:
+                    plan = [detail for (_, _, _, detail) in session.query("EXPLAIN QUERY PLAN " + stmt)]
+                    results.append((name, stmt, plan, cls._full_scans(stmt, plan)))
+        return results
+
+    @classmethod
+    def _full_scans(cls, stmt: str, plan: list) -> list:
+        # large tables by name or alias in the statement, e.g. "journal_v2 j"
+        tables = {}
+        for m in re.finditer(r"\b(" + "|".join(cls.large_tables) + r")\b(?:\s+(?:AS\s+)?(\w+))?", stmt):
+            tables[m.group(1)] = m.group(1)
+            if m.group(2) is not None:
+                tables[m.group(2)] = m.group(1)
+        scans = []
+        for detail in plan:
+            m = re.match(r"SCAN (\w+)(?: USING (?:COVERING )?INDEX (\w+))?", detail)
+            if (m is not None) and (m.group(1) in tables) and (m.group(2) not in cls.scannable_indexes):
+                scans.append(tables[m.group(1)])
+        return scans
+
+
+class ScanSession:
+    """
+    Dedicated connection for a journal scan, holding TEMP tables.
+
+    Temp tables are private to their connection, so this holds one open for the duration of the scan.
+    Writing or reading temp tables does not lock the journal, so other connections can update it meanwhile.
+
+    scanned_paths: paths seen during the scan.  At the end of the scan, JournalDispatcher.get_unscanned_active_files
+        finds the active journal entries whose paths were not seen with an anti-join, and get_scanned_active_files the
+        entries of a known set of paths (watch mode) with a join.  Paths are stored whole (journal v1) and as parent path
+        and filename (journal v2).
+    active_files: snapshot of the active journal entries of a modality, keyed by path, so they can be read back in
+        path order for a merge-join with a sorted directory walk (JournalDispatcher.load_active_files_sorted).
+    """
+    table_name = "scanned_paths"
+    active_table_name = "active_files"
+
+    def __init__(self, database_name: str):
+        self.database_name = database_name
+        self.dbver = JournalDispatcher._get_version(database_name)
+        self.count = 0
+        # temp tables may hold every path of a scan, so they are left on disk (default temp_store).
+        self.conn = sqlite3.connect(database_name, check_same_thread=False, timeout = SQLiteConnections.busy_timeout)
+        for pragma in SQLiteConnections.pragmas:
+            if not pragma.startswith("PRAGMA temp_store"):
+                self.conn.execute(pragma).fetchall()
+        with closing(self.conn.cursor()) as cur:
+            cur.execute(f"CREATE TEMP TABLE IF NOT EXISTS {self.table_name} (FILEPATH TEXT PRIMARY KEY, SRC_PATH TEXT NOT NULL, FILENAME TEXT NOT NULL)")
+            if self.dbver == 2:
+                cur.execute(f"CREATE INDEX IF NOT EXISTS temp.{self.table_name}_idx ON {self.table_name} (SRC_PATH, FILENAME)")
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add(self, paths: list) -> int:
+        """
+        add relative paths in posix format.  returns number of new paths.
+        """
+        if (paths is None) or (len(paths) == 0):
+            return 0
+        params = []
+        for fpath in paths:
+            path = Path(fpath)
+            params.append((fpath, path.parent.as_posix(), path.name))
+        with closing(self.conn.cursor()) as cur:
+            cur.executemany(f"INSERT OR IGNORE INTO {self.table_name} (FILEPATH, SRC_PATH, FILENAME) VALUES (?, ?, ?)", params)
+            added = cur.rowcount
+        self.conn.commit()
+        self.count += added
+        return added
+
+    def query(self, stmt: str, params: tuple = ()):
+        with closing(self.conn.cursor()) as cur:
+            return cur.execute(stmt, params).fetchall()
+
+    def load_active_files(self, select_stmt: str, params: tuple = ()) -> int:
+        """
+        replace the active_files snapshot with the rows of select_stmt: (path, file_id, size, mtime, md5, upload, version, prehash).
+        """
+        with closing(self.conn.cursor()) as cur:
+            cur.execute(f"CREATE TEMP TABLE IF NOT EXISTS {self.active_table_name} (FILEPATH TEXT NOT NULL, FILE_ID INTEGER NOT NULL,"
+                        " SIZE INTEGER, SRC_MODTIME_us INTEGER, MD5 TEXT, UPLOAD_DT TEXT, VERSION TEXT, PREHASH TEXT,"
+                        " PRIMARY KEY (FILEPATH, FILE_ID)) WITHOUT ROWID")
+            cur.execute(f"DELETE FROM temp.{self.active_table_name}")
+            cur.execute(f"INSERT INTO temp.{self.active_table_name} {select_stmt}", params)
+            count = cur.rowcount
+        self.conn.commit()
+        return count
+
+    def iter_active_files(self, chunk_size: int = 10000, start_after: str = None):
+        """
+        Yields (path, [(file_id, size, mtime, md5, upload, version, prehash), ...]) from the active_files snapshot, in ascending path order.
+        if start_after is set, only paths after it are returned.
+
+        Reads in chunks keyed on (path, file_id), so no statement stays open between chunks.
+        """
+        path, rows = None, []
+        last = ("", -1) if start_after is None else (start_after, 2**63 - 1)
+        while True:
+            chunk = self.query(f"SELECT FILEPATH, FILE_ID, SIZE, SRC_MODTIME_us, MD5, UPLOAD_DT, VERSION, PREHASH FROM temp.{self.active_table_name}"
+                               " WHERE (FILEPATH, FILE_ID) > (?, ?) ORDER BY FILEPATH, FILE_ID LIMIT ?",
+                               (last[0], last[1], chunk_size))
+            if len(chunk) == 0:
+                break
+            for (fpath, fid, size, mtime, md5, upload, ver, prehash) in chunk:
+                if fpath != path:
+                    if path is not None:
+                        yield (path, rows)
+                    path, rows = fpath, []
+                rows.append((fid, size, mtime, md5, upload, ver, prehash))
+            last = (chunk[-1][0], chunk[-1][1])
+        if path is not None:
+            yield (path, rows)
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+class DirIndex:
+    """
+    Directory mtimes and entry counts of a modality root, as seen by the local walker (storage_helper._walk_local).
+
+    The walker calls visit() for every directory it lists, with the mtime from a stat taken before the listing.  All
+    visits are recorded and saved to the journal at the end of the scan.  With trust enabled, visit() returns True
+    for a directory whose mtime and entry count match the previous scan, and the walker does not stat its files.
+    A file modified in place does not change its directory's mtime, so trust is opt-in (--trust-dir-mtime).
+    """
+
+    def __init__(self, database_name: str, modality: str, trust: bool = False):
+        self.database_name = database_name
+        self.modality = modality
+        self.previous = JournalDispatcher.load_dir_index(database_name, modality) if trust else {}
+        self.current = {}
+        self.trusted = 0
+
+    def visit(self, reldir: str, mtime_ns: int, nentries: int) -> bool:
+        self.current[reldir] = (mtime_ns, nentries)
+        if self.previous.get(reldir, None) == (mtime_ns, nentries):
+            self.trusted += 1
+            return True
+        return False
+
+    def save(self) -> int:
+        log.info(f"directories {len(self.current)}, unchanged and trusted {self.trusted} for modality {self.modality}")
+        return JournalDispatcher.save_dir_index(self.database_name, self.modality, self.current)
+
+
+class ScanCheckpoint:
+    """
+    Progress of a journal update per modality, so an interrupted update can continue (journal update --resume).
+
+    scan_checkpoints: version and timestamp of the update, and the last path such that every walked path up to and
+        including it has been written to the journal.  Only sorted (local) walks are checkpointed.
+    scan_checkpoint_deleted: active files found missing so far.  They are inactivated when the modality finishes,
+        so an interrupted update does not leave a partial set of deletions in the journal.
+
+    Both are removed when the modality finishes.
+    """
+    table_name = "scan_checkpoints"
+    deleted_table_name = "scan_checkpoint_deleted"
+
+    @classmethod
+    def create_table(cls, database_name: str):
+        SQLiteDB.create_table(
+            database_name = database_name,
+            table_name = cls.table_name,
+            column_types = [
+                ("MODALITY", "TEXT", "PRIMARY KEY"),
+                ("VERSION", "TEXT", "NOT NULL"),
+                ("TIME_us", "INTEGER", "NOT NULL"),  # the update's timestamp, reused on resume
+                ("LAST_PATH", "TEXT", ""),
+                ],
+            foreign_keys = None,
+            index_on = None)
+        # a file found missing again, e.g. after a resume, is recorded once.
+        with SQLiteConnections.transaction(database_name) as conn:
+            with closing(conn.cursor()) as cur:
+                cur.execute(f"CREATE TABLE IF NOT EXISTS {cls.deleted_table_name} (MODALITY TEXT NOT NULL, FILE_ID INTEGER NOT NULL,"
+                            " PRIMARY KEY (MODALITY, FILE_ID)) WITHOUT ROWID")
+
+    @classmethod
+    def load(cls, database_name: str, modality: str) -> Optional[tuple]:
+        """
+        returns (version, time_us, last_path) of the modality's checkpoint, or None.
+        """
+        result = SQLiteDB.query_stmt(database_name, f"SELECT VERSION, TIME_us, LAST_PATH FROM {cls.table_name} WHERE MODALITY = ?", (modality,))
+        return result[0] if len(result) > 0 else None
+
+    @classmethod
+    def get_versions(cls, database_name: str) -> list:
+        if not SQLiteDB.table_exists(database_name, cls.table_name):
+            return []
+        return [ver for (ver,) in SQLiteDB.query_stmt(database_name, f"SELECT DISTINCT VERSION FROM {cls.table_name}")]
+
+    @classmethod
+    def save(cls, database_name: str, modality: str, version: str, curtimestamp: int, last_path: str, deleted: list):
+        """
+        record progress and the file ids of newly found missing files, in one transaction.
+        """
+        with SQLiteConnections.transaction(database_name) as conn:
+            with closing(conn.cursor()) as cur:
+                cur.execute(f"INSERT OR REPLACE INTO {cls.table_name} (MODALITY, VERSION, TIME_us, LAST_PATH) VALUES (?, ?, ?, ?)",
+                            (modality, version, curtimestamp, last_path))
+                if len(deleted) > 0:
+                    cur.executemany(f"INSERT OR IGNORE INTO {cls.deleted_table_name} (MODALITY, FILE_ID) VALUES (?, ?)",
+                                    [(modality, fid) for fid in deleted])
+
+    @classmethod
+    def get_deleted(cls, database_name: str, modality: str) -> list:
+        return [fid for (fid,) in SQLiteDB.query_stmt(database_name,
+                                                      f"SELECT FILE_ID FROM {cls.deleted_table_name} WHERE MODALITY = ?",
+                                                      (modality,))]
+
+    @classmethod
+    def clear(cls, database_name: str, modality: str):
+        SQLiteDB.delete(database_name, cls.deleted_table_name, "MODALITY = ?", (modality,))
+        SQLiteDB.delete(database_name, cls.table_name, "MODALITY = ?", (modality,))
+
+
+class TuningProfiles:
+    """
+    Thread counts and throughput that the adaptive pools (see concurrency.AIMDController) settled on, per host,
+    storage root, modality and pool.  The next run on the same host starts from them instead of converging again.
+
+    pool is e.g. "hash_thread", "hash_process" for journal scans (root is the mount point of the device), or
+    "upload_<size group>" for uploads (root is the destination).
+    """
+    table_name = "tuning_profiles"
+
+    @classmethod
+    def create_table(cls, database_name: str):
+        SQLiteDB.create_table(
+            database_name = database_name,
+            table_name = cls.table_name,
+            column_types = [
+                ("HOST", "TEXT", "NOT NULL"),
+                ("ROOT", "TEXT", "NOT NULL"),
+                ("MODALITY", "TEXT", "NOT NULL"),
+                ("POOL", "TEXT", "NOT NULL"),
+                ("NTHREADS", "INTEGER", "NOT NULL"),
+                ("THROUGHPUT_MBps", "REAL", ""),
+                ("TIME_us", "INTEGER", ""),
+                ],
+            foreign_keys = None,
+            index_on = ["HOST", "ROOT", "MODALITY", "POOL"])
+
+    @classmethod
+    def load(cls, database_name: str, root: str, modality: str, pool: str) -> Optional[tuple]:
+        """
+        returns (nthreads, throughput_MBps) saved for this host, or None.
+        """
+        if not SQLiteDB.table_exists(database_name, cls.table_name):
+            return None
+        result = SQLiteDB.query_stmt(database_name,
+                                     f"SELECT NTHREADS, THROUGHPUT_MBps FROM {cls.table_name} WHERE HOST = ? AND ROOT = ? AND MODALITY = ? AND POOL = ?",
+                                     (socket.gethostname(), root, modality, pool))
+        return result[0] if len(result) > 0 else None
+
+    @classmethod
+    def save(cls, database_name: str, root: str, modality: str, pool: str, nthreads: int, throughput: float):
+        cls.create_table(database_name)
+        key = (socket.gethostname(), root, modality, pool)
+        with SQLiteConnections.transaction(database_name) as conn:
+            with closing(conn.cursor()) as cur:
+                cur.execute(f"DELETE FROM {cls.table_name} WHERE HOST = ? AND ROOT = ? AND MODALITY = ? AND POOL = ?", key)
+                cur.execute(f"INSERT INTO {cls.table_name} (HOST, ROOT, MODALITY, POOL, NTHREADS, THROUGHPUT_MBps, TIME_us) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            key + (nthreads, throughput, int(time.time() * 1e6)))
+        log.info(f"saved tuning profile {pool} for {modality} at {root}: {nthreads} threads, {throughput:.1f} MB/s")
+
 
 def _copy_journal_v1_to_v2(database_name: str, params: list) -> int:
     # insert or retrieve the modalities, uploads, and versions first.
@@ -1513,6 +2442,7 @@ def _upgrade_journal(local_path, lock_path):
 
     # create a locak backup first.    
     orig_db_fn = local_fn.replace(".db", f"_{old_ver}.db")
+    SQLiteDB.close(local_fn)
     shutil.move(local_fn, orig_db_fn)
     
     # TESTING
@@ -1528,11 +2458,11 @@ def _upgrade_journal(local_path, lock_path):
                             max_return = None)
 
     new_cmd_hist_class.create_command_history_table(local_fn)
-    for (_, dt, common, command, param, src, dest, time) in history:
+    for (_, dt, common, command, param, src, dest, duration) in history:
         new_arg = (f"'{dt}'", f"'{common}'", f"'{command}'", f"'{param}'", f"'{src}'", f"'{dest}'")
         (_, cmd_id) = new_cmd_hist_class.insert_command_history_entry(local_fn, new_arg)
-        if (time is not None):
-            new_cmd_hist_class.update_command_completion(local_fn, cmd_id, time)
+        if (duration is not None):
+            new_cmd_hist_class.update_command_completion(local_fn, cmd_id, duration)
 
 
     # create the other tables and copy the journal
@@ -1543,6 +2473,8 @@ def _upgrade_journal(local_path, lock_path):
                             columns = None,
                             where_clause = None,
                             max_return = None)
+    # done reading the old journal, which is kept as the backup.
+    SQLiteDB.close(orig_db_fn)
     
     if old_ver == "V1":
         count = _copy_journal_v1_to_v2(local_fn, journals)
@@ -1563,3 +2495,28 @@ def _upgrade_journal(local_path, lock_path):
 
     
     
+
+
+def _make_synthetic_journal(database_name: str, nrows: int, page_size: int = 10000) -> int:
+    """
+    Fill a new v2 journal with nrows generated entries, for journal check-indexes --synthetic.
+    40 files per patient, in 4 modalities and 5 versions.  about 60% are uploaded, 10% inactive and 1% moved.
+    """
+    JournalTableV2.create_journal_table(database_name)
+    modalities = ["Images", "Waveforms", "OMOP", "Metadata"]
+    nversions = 5
+    for start in range(0, nrows, page_size):
+        params = []
+        for i in range(start, min(nrows, start + page_size)):
+            modality = modalities[i % len(modalities)]
+            ver = f"20240101{(i * nversions // nrows):06d}"
+            upload = (ver + "U") if (i % 5) < 3 else None
+            params.append((i // 40, f"{i // 40:08d}/{modality}/{i % 7}/file{i:09d}.dat", modality, 1000000 + i, 1024 + (i % 4096),
+                           f"{i:032x}", 1000000 + (i * nversions // nrows), upload, "ADDED", 0.0, ver, None, None))
+        JournalDispatcher.insert_journal_entries(database_name, params)
+    with SQLiteDB.transaction(database_name):
+        JournalTableV2.inactivate_journal_entries(database_name, 2000000, [("DELETED", fid) for fid in range(1, nrows + 1, 10)])
+        SQLiteDB.update(database_name, JournalTableV2.table_name, ["MOVED_FROM_ID = ?"],
+                        [(fid, fid + 1) for fid in range(1, nrows, 100)], "FILE_ID = ? AND UPLOAD_DT_ID IS NULL")
+    JournalTableV2.save_dir_index(database_name, modalities[0], {f"{p:08d}/{modalities[0]}": (1000000 + p, 40) for p in range(0, nrows // 40, 10)})
+    return nrows
@@ -2,15 +2,24 @@ import re
 import time
 import math
 import os
-import contextlib
 from typing import Optional, List
-from chorus_upload.storage_helper import FileSystemHelper
+from chorus_upload.storage_helper import FileSystemHelper, FileDigests, FilePrehash, NameFilter, SCAN_BACKENDS, _md5_local_file, configure_hashing, get_hashing_config
 from pathlib import Path
 import concurrent.futures
 import threading
+import queue
+import itertools
+import collections
+import multiprocessing
 import chorus_upload.perf_counter as perf_counter
 from chorus_upload.journaldb_ops import SQLiteDB
-from chorus_upload.journaldb_ops import JournalDispatcher
+from chorus_upload.journaldb_ops import JournalDispatcher, PENDING_MD5
+from chorus_upload.journaldb_ops import ScanSession
+from chorus_upload.journaldb_ops import DirIndex
+from chorus_upload.journaldb_ops import ScanCheckpoint
+from chorus_upload.journaldb_ops import TuningProfiles
+from chorus_upload.hash_cache import HashCache
+from chorus_upload.concurrency import AIMDController
 
 import parse
 
@@ -34,51 +43,650 @@ log = logging.getLogger(__name__)
 # /NFS      per request         cpu_count×2        concurrency; more threads keep
 #                                                  pipeline full
 #
-# _AdaptiveThreads starts at 4 and hill-climbs (doubling per page) until
-# throughput degrades, then halves and locks.  Typical convergence:
-#   SSD: 4 → 8 → 16 → locked at 16 (or cpu_count, whichever is lower)
-#   HDD: 4 → degraded at 8 → locked at 4 (or 4 → locked at 2 if very slow)
-#   NAS: 4 → 8 → 16 → ... climbs further before degrading
-
-class _AdaptiveThreads:
-    """Hill-climbing adaptive thread count tuner for I/O-bound work.
-
-    After each page of files, compares throughput (bytes/s) to the previous
-    page. If throughput improved (within 5% noise), doubles the thread count
-    up to max_threads. On the first degradation, halves and locks — no further
-    climbing. This converges naturally:
-      - HDD:  ~1-2 threads (seek thrashing kills throughput quickly)
-      - SSD:  ~cpu_count  (CPU-bound hashing, threads help up to core count)
-      - NAS:  higher      (network latency hides well with concurrency)
-    """
-
-    def __init__(self, initial: int, max_threads: int):
-        self.nthreads = initial
-        self._max = max_threads
-        self._prev_mbps: float | None = None
-        self._locked = False
-
-    def update(self, bytes_processed: int, elapsed: float) -> None:
-        """Call once per completed page with its total bytes and wall time."""
-        if elapsed <= 0 or self._locked or bytes_processed == 0:
-            return
-        mbps = bytes_processed / elapsed
-        if self._prev_mbps is not None:
-            if mbps >= self._prev_mbps * 0.95:          # improved or flat
-                new = min(self._max, self.nthreads * 2)
-            else:                                        # degraded — lock in
-                new = max(1, self.nthreads // 2)
-                self._locked = True
-            if new != self.nthreads:
-                log.info(f"Adaptive threads: {self.nthreads} → {new} "
-                         f"({'locked' if self._locked else 'climbing'}), "
-                         f"throughput {mbps / 1e6:.1f} MB/s")
-                self.nthreads = new
-        self._prev_mbps = mbps
-
-    @property
-    def locked(self) -> bool:
-        return self._locked
+# AIMDController (see concurrency.py) starts at 4, probes upward one thread per page, and
+# backs off multiplicatively when throughput stays down.  It keeps probing for the whole scan,
+# so the thread count tracks the device:
+#   SSD: climbs to cpu_count (or the maximum) and stays near it
+#   HDD: saw-tooths around 1-2
+#   NAS: climbs further before backing off
+
+
+# Journal scans run as a three stage pipeline so listing, hashing and DB writes overlap:
+#
+#   lister thread  --list_q-->  dispatcher  --lane queue-->  hash stage (executor per device)  --result_q-->  caller (single DB writer)
+#
+# All queues are bounded, so a slow stage applies backpressure instead of buffering the tree.
+# A modality root can span several devices (e.g. patient shards mounted from different disks), and
+# the right concurrency differs by device (see the table above).  The dispatcher routes each entry
+# to a lane for its device, and each lane has its own executor and tuner, so a slow disk does not
+# cap the thread count for the others.  A lane keeps at most tuner.nthreads files in flight; its
+# executor is sized for the tuner's maximum, so the tuner can resize the lane without a page barrier.
+
+_PIPELINE_DONE = object()
+
+
+# Modality patterns such as "{patient_id:w}/Images/{filepath}" are matched against every scanned path, and every
+# journal path converted to a central path for upload, verify and listing.  PathPattern compiles them into re:
+#
+# field        regex            notes
+# -----------  ---------------  -----------------------------------------------------------------------
+# {name}       (?P<name>.+?)    as parse.  lazy, so earlier fields take the shortest match
+# {name:w}     (?P<name>\w+)    letters, digits and underscore
+# other        -                format specs with a conversion (":d" gives an int), positional or repeated
+#                               fields.  the whole pattern falls back to parse
+#
+# as with parse, the whole path must match, case insensitively.
+
+_PATTERN_TOKEN_RE = re.compile(r"({{|}}|{[^{}]*})")
+_PATTERN_FIELD_RE = {"": ".+?", "w": r"\w+"}
+_PATTERN_NAME_RE = re.compile(r"[A-Za-z_]\w*")
+
+class PathPattern:
+    """
+    A modality pattern compiled into an equivalent regular expression with named groups, or into a parse.Parser
+    if it has fields the regular expression cannot match with the same results.
+    """
+
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        self._regex = self._compile(pattern)
+        self._parser = parse.compile(pattern) if self._regex is None else None
+
+    @classmethod
+    def _compile(cls, pattern: str) -> Optional[re.Pattern]:
+        expression = []
+        names = set()
+        for part in _PATTERN_TOKEN_RE.split(pattern):
+            if (part == "{{") or (part == "}}"):
+                expression.append(re.escape(part[0]))
+            elif part.startswith("{") and part.endswith("}"):
+                (name, _, spec) = part[1:-1].partition(":")
+                if (spec not in _PATTERN_FIELD_RE.keys()) or (_PATTERN_NAME_RE.fullmatch(name) is None) or (name in names):
+                    return None
+                names.add(name)
+                expression.append(f"(?P<{name}>{_PATTERN_FIELD_RE[spec]})")
+            elif ("{" in part) or ("}" in part):
+                return None
+            else:
+                expression.append(re.escape(part))
+        return re.compile("".join(expression), re.IGNORECASE | re.DOTALL)
+
+    def named(self, path: str) -> Optional[dict]:
+        """
+        the named fields of path, or None if it does not match.
+        """
+        if self._regex is not None:
+            matched = self._regex.fullmatch(path)
+            return matched.groupdict() if matched is not None else None
+        parsed = self._parser.parse(path)
+        return parsed.named if parsed is not None else None
+
+    def __repr__(self):
+        return f"<PathPattern {self.pattern!r}>"
+
+
+def _mount_point(path: str) -> str:
+    path = os.path.abspath(path)
+    while not os.path.ismount(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+class _DeviceMap:
+    """
+    Device (st_dev) of the entries of a local walk, from one stat of each parent directory.
+    Called in the lister thread only.  Bind mounts of one device share its st_dev, so they share a lane.
+    """
+
+    max_cached_dirs = 10000
+
+    def __init__(self, root: str):
+        self.root = root
+        self.mounts = {}
+        self._dirs = {}
+
+    def __call__(self, entry: tuple) -> int:
+        reldir = os.path.dirname(entry[0])
+        dev = self._dirs.get(reldir, None)
+        if dev is None:
+            dirpath = os.path.join(self.root, reldir)
+            try:
+                dev = os.stat(dirpath).st_dev
+            except OSError:
+                # removed since it was listed.  the scan reports the file.
+                dev = -1
+            if len(self._dirs) >= self.max_cached_dirs:
+                self._dirs = {}
+            self._dirs[reldir] = dev
+            if dev not in self.mounts:
+                self.mounts[dev] = _mount_point(dirpath) if dev != -1 else None
+                log.info(f"device {dev} mounted at {self.mounts[dev]}: hashing with its own thread pool")
+        return dev
+
+
+def _scan_pipeline(entry_pages, work_fn, make_tuner, page_size: int = 1000, batch_size: int = None,
+                   device_of = None, result_bytes = None):
+    """
+    Run work_fn over the entries from a directory walk as a pipeline.
+
+    Args:
+        entry_pages: iterable of lists of entries, e.g. FileSystemHelper.get_files_meta_iter().
+        work_fn: called with one entry in a hash stage worker thread.  returns the result for that entry.
+        make_tuner: called with the device key to create the AIMDController for each device lane.  it controls the
+            number of entries (or batches) being processed concurrently on that device.
+        page_size (int): number of results per yielded batch, and per tuner update.
+        batch_size (int, optional): if set, work_fn is called with lists of up to batch_size entries and returns a list of results.
+        device_of (optional): called with an entry in the lister thread, returns its device key.  entries of a batch share
+            a device.  by default all entries share one lane.
+        result_bytes (optional): called with a result, returns the bytes processed, for the tuners.
+
+    Yields:
+        list: up to page_size results, in completion order.
+    """
+    list_q = queue.Queue(maxsize = 2 * page_size)
+    result_q = queue.Queue(maxsize = 2 * page_size)
+    stop = threading.Event()
+    lanes = {}
+
+    def _put(q, item):
+        # give up if the consumer went away, so no stage blocks forever on a full queue.
+        while not stop.is_set():
+            try:
+                q.put(item, timeout = 0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _lister():
+        try:
+            chunks = {}
+            for entries in entry_pages:
+                for entry in entries:
+                    key = device_of(entry) if device_of is not None else None
+                    if batch_size is None:
+                        if not _put(list_q, (key, entry)):
+                            return
+                        continue
+                    chunk = chunks.setdefault(key, [])
+                    chunk.append(entry)
+                    if len(chunk) >= batch_size:
+                        if not _put(list_q, (key, chunk)):
+                            return
+                        chunks[key] = []
+            for (key, chunk) in chunks.items():
+                if (len(chunk) > 0) and not _put(list_q, (key, chunk)):
+                    return
+            _put(list_q, (None, _PIPELINE_DONE))
+        except Exception as e:
+            _put(list_q, (None, e))
+
+    def _run_lane(lane):
+        tuner = lane["tuner"]
+        cv = lane["cv"]
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers = max(1, tuner.max_threads))
+
+        def _on_done(future):
+            try:
+                item = future.result()
+            except Exception as e:
+                item = e
+            results = [] if isinstance(item, Exception) else (item if batch_size is not None else [item])
+            nbytes = sum(result_bytes(r) for r in results) if result_bytes is not None else 0
+            # enqueue before releasing the slot, so the end marker can not overtake this result.
+            _put(result_q, item)
+            with cv:
+                lane["inflight"] -= 1
+                # throughput is measured per lane, so it reflects the device, over time that includes backpressure
+                # from the DB write.
+                lane["bytes"] += nbytes
+                lane["count"] += len(results)
+                if lane["count"] >= page_size:
+                    tuner.update(lane["bytes"], time.time() - lane["start"], files = lane["count"])
+                    lane.update(bytes = 0, count = 0, start = time.time())
+                cv.notify_all()
+
+        try:
+            while not stop.is_set():
+                try:
+                    item = lane["q"].get(timeout = 0.5)
+                except queue.Empty:
+                    continue
+                if item is _PIPELINE_DONE:
+                    # drain in-flight work before finishing.
+                    with cv:
+                        while lane["inflight"] > 0 and not stop.is_set():
+                            cv.wait(timeout = 0.5)
+                    return
+                with cv:
+                    while (lane["inflight"] >= tuner.nthreads) and not stop.is_set():
+                        cv.wait(timeout = 0.5)
+                    lane["inflight"] += 1
+                executor.submit(work_fn, item).add_done_callback(_on_done)
+        finally:
+            executor.shutdown(wait = True, cancel_futures = True)
+
+    def _dispatcher():
+        end = None
+        while not stop.is_set():
+            try:
+                (key, item) = list_q.get(timeout = 0.5)
+            except queue.Empty:
+                continue
+            if (item is _PIPELINE_DONE) or isinstance(item, Exception):
+                end = item
+                break
+            lane = lanes.get(key, None)
+            if lane is None:
+                lane = { "q": queue.Queue(maxsize = 2 * page_size), "tuner": make_tuner(key), "cv": threading.Condition(),
+                         "inflight": 0, "bytes": 0, "count": 0, "start": time.time() }
+                lane["thread"] = threading.Thread(target = _run_lane, args = (lane,), name = f"journal-lane-{key}", daemon = True)
+                lane["thread"].start()
+                lanes[key] = lane
+            _put(lane["q"], item)
+        # signal the end after all lanes have drained.
+        for lane in lanes.values():
+            _put(lane["q"], _PIPELINE_DONE)
+        for lane in lanes.values():
+            lane["thread"].join()
+        if end is not None:
+            _put(result_q, end)
+
+    lister = threading.Thread(target = _lister, name = "journal-lister", daemon = True)
+    dispatcher = threading.Thread(target = _dispatcher, name = "journal-dispatcher", daemon = True)
+    lister.start()
+    dispatcher.start()
+    try:
+        batch = []
+        while True:
+            item = result_q.get()
+            if item is _PIPELINE_DONE:
+                break
+            if isinstance(item, Exception):
+                raise item
+            if batch_size is None:
+                batch.append(item)
+            else:
+                batch.extend(item)
+            if len(batch) >= page_size:
+                yield batch
+                batch = []
+        if len(batch) > 0:
+            yield batch
+    finally:
+        stop.set()
+        dispatcher.join()
+        lister.join()
+
+
+# MD5 hashing engines for journal scans:
+#
+# engine    hashing runs in        best for
+# --------  ---------------------  ------------------------------------------------------
+# thread    hash stage threads     large files: hashlib releases the GIL while hashing
+# process   ProcessPoolExecutor    many small files: per-file open/read/hexdigest overhead
+#                                  is Python code under the GIL, so threads stop scaling
+#
+# "auto" picks process for local roots whose first page has a median file size below
+# _SMALL_FILE_MEDIAN.  The process engine ships batches of _PROCESS_HASH_BATCH paths per task.
+
+HASH_ENGINES = ["auto", "thread", "process"]
+_SMALL_FILE_MEDIAN = 1024 * 1024
+_PROCESS_HASH_BATCH = 64
+
+def _md5_files_batch(root: str, relpaths: list[str], digests: tuple = None, prehash_mb: int = None) -> list[tuple]:
+    """
+    Compute MD5 (and the digests configured as (names, block_size), and the prehash, if any) for a batch of local files.
+    Runs in a worker process, so only takes and returns plain values.
+
+    Returns:
+        list of (relpath, size, mtime_us, md5, md5_time, digests, prehash).  size, mtime_us and md5 are None if the file could not be read.
+    """
+    out = []
+    for relpath in relpaths:
+        start = time.time()
+        try:
+            file_digests = FileDigests(*digests) if digests is not None else None
+            file_prehash = FilePrehash(prehash_mb) if prehash_mb is not None else None
+            (md5, info) = _md5_local_file(os.path.join(root, relpath), digests = file_digests, prehash = file_prehash)
+            out.append((relpath, info.st_size, int(math.floor(info.st_mtime * 1e6)), md5.hexdigest(), time.time() - start,
+                        file_digests.result() if file_digests is not None else None,
+                        file_prehash.result() if file_prehash is not None else None))
+        except OSError:
+            out.append((relpath, None, None, None, None, None, None))
+    return out
+
+
+def _select_hash_engine(root: FileSystemHelper, hash_engine: str, entries: list) -> str:
+    """
+    resolve the configured hash engine to "thread" or "process", using the (relpath, size, mtime) entries of the first page for "auto".
+    """
+    if hash_engine not in HASH_ENGINES:
+        raise ValueError(f"Unsupported hash_engine {hash_engine}.  Expected one of {HASH_ENGINES}")
+
+    local = isinstance(root.root, Path) and not root.is_cloud
+    if hash_engine == "thread":
+        return "thread"
+    if hash_engine == "process":
+        if not local:
+            log.warning(f"process hash engine only supports local files.  using threads for {root.root}")
+            return "thread"
+        return "process"
+
+    if (not local) or ((os.cpu_count() or 1) < 2):
+        return "thread"
+    sizes = sorted(size for (_, size, _) in entries if size is not None)
+    if len(sizes) == 0:
+        return "thread"
+    median = sizes[len(sizes) // 2]
+    engine = "process" if median < _SMALL_FILE_MEDIAN else "thread"
+    log.info(f"median file size {median} bytes in first {len(sizes)} files.  using {engine} hash engine")
+    return engine
+
+
+def _needs_md5(relpath: str, filesize: int, modtimestamp: int, known: dict, compiled_pattern: PathPattern, defer_hash: bool = False,
+               prehash: "Prehash" = None) -> bool:
+    """
+    whether _update_journal_one_file would compute the MD5 for this file, before knowing its prehash. mirrors its branches.
+    """
+    if compiled_pattern.named(relpath) is None:
+        return False
+    if relpath not in known.keys():
+        return not defer_hash
+    if len(known[relpath]) != 1:
+        return False
+    (_, oldsize, oldmtime, oldmd5, _, _, oldprehash) = known[relpath][0]
+    if defer_hash and (oldmd5 == PENDING_MD5):
+        return False
+    if defer_hash and (prehash is not None) and (oldmtime != modtimestamp) and (oldsize == filesize) and prehash.comparable(oldprehash):
+        # sampled first, and only read in full if the prehash is the same.
+        return False
+    return oldmtime != modtimestamp
+
+
+def _hash_and_scan_batch(pool: concurrent.futures.ProcessPoolExecutor, root: FileSystemHelper, entries: list,
+                         known: dict, compiled_pattern: PathPattern, scan_one, hash_cache: HashCache = None,
+                         digests: tuple = None, defer_hash: bool = False, prehash: "Prehash" = None) -> list:
+    """
+    process engine work unit: hash the entries that need an MD5 in a worker process, then classify all entries with scan_one.
+    MD5s found in hash_cache are not recomputed, so those files have no digests or prehash.
+    """
+    to_hash = [relpath for (relpath, filesize, modtimestamp) in entries
+               if _needs_md5(relpath, filesize, modtimestamp, known, compiled_pattern, defer_hash, prehash)]
+    cached = {}
+    keys = {}
+    if hash_cache is not None:
+        for relpath in to_hash:
+            (md5, keys[relpath]) = hash_cache.get(os.path.join(str(root.root), relpath))
+            if md5 is not None:
+                cached[relpath] = md5
+        to_hash = [relpath for relpath in to_hash if relpath not in cached.keys()]
+
+    hashed = {}
+    if len(to_hash) > 0:
+        prehash_mb = prehash.sample_mb if prehash is not None else None
+        for (relpath, size, mtime, md5, md5_time, md5_digests, md5_prehash) in pool.submit(_md5_files_batch, str(root.root), to_hash, digests, prehash_mb).result():
+            if md5 is not None:
+                hashed[relpath] = (size, mtime, md5, md5_time, md5_digests, md5_prehash)
+                if hash_cache is not None:
+                    hash_cache.put(os.path.join(str(root.root), relpath), keys[relpath], md5)
+
+    results = []
+    for entry in entries:
+        relpath = entry[0]
+        if relpath in cached.keys():
+            results.append(scan_one(entry, md5 = cached[relpath], md5_time = 0.0))
+        elif relpath in hashed.keys():
+            (size, mtime, md5, md5_time, md5_digests, md5_prehash) = hashed[relpath]
+            # use the stat taken while hashing, so size, mtime and md5 are consistent.
+            results.append(scan_one((relpath, size, mtime), md5 = md5, md5_time = md5_time, md5_digests = md5_digests, md5_prehash = md5_prehash))
+        else:
+            # unreadable or no hash needed: thread engine path.
+            results.append(scan_one(entry))
+    return results
+
+
+# Prehash: a sampled content hash of large local files (see storage_helper.FilePrehash), stored in the PREHASH column
+# (journal v2).  It is computed in the same pass as the MD5 whenever a file is read, so it costs no extra read.
+#
+# With --defer-hash, a file whose mtime changed but whose size did not is sampled first, if its journal entry has a
+# prehash of the same sample_mb.  A different prehash means the content changed, so the file is UPDATED with a pending
+# MD5 and not read in full; the upload computes the MD5.  A matching prehash still needs the full MD5.
+# Without --defer-hash the MD5 is needed either way, so prehashes are only recorded.
+
+class Prehash:
+    """
+    prehash settings for a journal update, from the [configuration] prehash_mb setting.
+    """
+
+    def __init__(self, sample_mb: int):
+        self.sample_mb = sample_mb
+
+    @classmethod
+    def from_config(cls, prehash_mb: Optional[int]) -> Optional["Prehash"]:
+        """
+        None if prehash_mb is not set or 0 (disabled).  a whole number of MB, else ValueError.
+        """
+        if prehash_mb is None:
+            return None
+        if isinstance(prehash_mb, bool) or (not isinstance(prehash_mb, (int, float))) or (prehash_mb != int(prehash_mb)) or (prehash_mb < 0):
+            log.error(f"prehash_mb must be a whole number of MB, got {prehash_mb!r}")
+            raise ValueError(f"prehash_mb must be a whole number of MB, got {prehash_mb!r}")
+        if int(prehash_mb) == 0:
+            return None
+        log.info(f"using {int(prehash_mb)} MB prehash for files with changed modification time")
+        return cls(int(prehash_mb))
+
+    def new(self) -> FilePrehash:
+        return FilePrehash(self.sample_mb)
+
+    def compute(self, root: FileSystemHelper, relpath: str) -> Optional[str]:
+        """
+        prehash of a local file from its sampled regions only, or None for cloud files, small files, and unreadable files.
+        """
+        if root.is_cloud or not isinstance(root.root, Path):
+            return None
+        file_prehash = self.new()
+        try:
+            with open(os.path.join(str(root.root), relpath), "rb") as f:
+                file_prehash.start(os.fstat(f.fileno()).st_size)
+                for (start, end) in list(file_prehash.regions):
+                    f.seek(start)
+                    file_prehash.update(f.read(end - start), offset = start)
+        except OSError:
+            return None
+        return file_prehash.result()
+
+    def comparable(self, value: Optional[str]) -> bool:
+        """
+        whether a stored prehash was taken with this sample size.
+        """
+        return (value is not None) and value.startswith(f"{self.sample_mb}:")
+
+    def differs(self, old: Optional[str], new: Optional[str]) -> bool:
+        """
+        True only if both prehashes were taken with this sample size and they are different.
+        """
+        return self.comparable(old) and self.comparable(new) and (old != new)
+
+
+def _fill_from_journal(entry: tuple, rows: list) -> tuple:
+    # rows are (fid, size, mtime, md5, upload, version, prehash).  with no single journal entry, the file is stat'd downstream.
+    if (rows is None) or (len(rows) != 1):
+        return entry
+    return (entry[0], rows[0][1], rows[0][2])
+
+
+def _merge_with_journal(entry_pages, journal_files, pending: dict, on_journal_only):
+    """
+    merge-join a path-sorted directory walk with path-sorted active journal entries, in one streaming pass.
+
+    Args:
+        entry_pages: pages of (relpath, size, mtime) from a sorted walk (FileSystemHelper.walk_is_sorted).
+        journal_files: (path, rows) in ascending path order, e.g. ScanSession.iter_active_files().
+        pending (dict): the journal rows of each walked file that has them are stored here by relpath, for the hash stage
+            and the writer.  the writer removes them, so this holds only the files in flight.
+        on_journal_only: called with (path, rows) for journal entries that are not in the walk.
+
+    Yields:
+        the pages of entry_pages.  entries the walker did not stat (size None, in a directory trusted by DirIndex)
+        take size and mtime from their journal entry, so they come out as KEEP.
+    """
+    journal_iter = iter(journal_files)
+    journal_cur = next(journal_iter, None)
+    prev = None
+    for entries in entry_pages:
+        for entry in entries:
+            relpath = entry[0]
+            if (prev is not None) and (relpath <= prev):
+                # a merge with an unsorted walk would report present files as deleted.
+                raise ValueError(f"directory walk is not in sorted order: {relpath} after {prev}")
+            prev = relpath
+            while (journal_cur is not None) and (journal_cur[0] < relpath):
+                on_journal_only(*journal_cur)
+                journal_cur = next(journal_iter, None)
+            if (journal_cur is not None) and (journal_cur[0] == relpath):
+                pending[relpath] = journal_cur[1]
+                journal_cur = next(journal_iter, None)
+        if any(entry[1] is None for entry in entries):
+            entries = [_fill_from_journal(entry, pending.get(entry[0], None)) if entry[1] is None else entry for entry in entries]
+        yield entries
+
+    while journal_cur is not None:
+        on_journal_only(*journal_cur)
+        journal_cur = next(journal_iter, None)
+
+
+def _scan_modality(root: FileSystemHelper, pattern: str, known: dict, compiled_pattern: PathPattern, scan_one,
+                   nthreads: int, page_size: int = 1000, hash_engine: str = "auto",
+                   entry_filter = None, hash_cache: HashCache = None, dir_index = None, start_after: str = None,
+                   load_profile = None, tuners: dict = None, digests: tuple = None, defer_hash: bool = False,
+                   prehash: Prehash = None, name_filter: NameFilter = None, scan_backend: tuple = ("thread", 256)):
+    """
+    walk the files matching pattern and run scan_one on each through _scan_pipeline, using the selected hash engine.
+
+    Args:
+        known (dict): active journal entries by relpath, as passed to _update_journal_one_file.
+        scan_one: called as scan_one(entry, md5 = None, md5_time = None, md5_digests = None, md5_prehash = None) with a
+            (relpath, size, mtime) entry.
+        entry_filter (optional): wraps the iterator of walk pages, e.g. _merge_with_journal.  runs in the lister thread.
+        hash_cache (HashCache, optional): used by the process engine.  the thread engine's scan_one uses it directly.
+        dir_index (DirIndex, optional): records directory mtimes during a local walk, see FileSystemHelper._walk_local.
+        start_after (str, optional): resume a local walk after this relpath, see FileSystemHelper._walk_local.
+        load_profile (optional): called as load_profile(lane_root, pool) for each device lane.  returns a saved
+            (nthreads, throughput) to start from, or None.
+        tuners (dict, optional): filled with {(lane_root, pool): AIMDController} for each device lane, to save their profiles.
+        digests (tuple, optional): (names, block_size) from FileDigests.parse_config, for the process engine's workers.
+        defer_hash (bool, optional): the process engine does not hash files whose MD5 is deferred to the upload.
+        prehash (Prehash, optional): the process engine's workers compute the prehash with the MD5.
+        name_filter (NameFilter, optional): the modality's include/exclude globs and max_depth, applied by the walk.
+        scan_backend (tuple, optional): (backend, workers) for the local walk, from _get_scan_backend.
+
+    Yields:
+        list: up to page_size results of scan_one.
+    """
+    entry_pages = root.get_files_meta_iter(pattern = pattern, page_size = page_size, dir_index = dir_index, start_after = start_after,
+                                           name_filter = name_filter, scan_backend = scan_backend[0], scan_workers = scan_backend[1])
+    if entry_filter is not None:
+        entry_pages = entry_filter(entry_pages)
+    engine = "thread"
+    if hash_engine != "thread":
+        first_page = next(entry_pages, [])
+        entry_pages = itertools.chain([first_page], entry_pages)
+        engine = _select_hash_engine(root, hash_engine, first_page)
+
+    pool = None
+    if engine == "process":
+        nprocs = max(1, min(nthreads, os.cpu_count() or 1))
+        # not fork: the pipeline threads are already running when workers start.
+        methods = multiprocessing.get_all_start_methods()
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers = nprocs,
+            mp_context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn"),
+            initializer = configure_hashing, initargs = get_hashing_config())
+        # tuners control batches in flight per device.  the worker processes are shared, as hashing them is CPU bound.
+        #   keep at least one batch per worker process.
+        (initial, max_threads, min_threads) = (nprocs, 2 * nprocs, nprocs)
+        work_fn = lambda entries: _hash_and_scan_batch(pool, root, entries, known, compiled_pattern, scan_one,
+                                                       hash_cache = hash_cache, digests = digests, defer_hash = defer_hash,
+                                                       prehash = prehash)
+        batch_size = _PROCESS_HASH_BATCH
+        log.info(f"hashing with {nprocs} processes")
+    else:
+        (initial, max_threads, min_threads) = (min(4, nthreads), nthreads, 1)
+        work_fn = scan_one
+        batch_size = None
+
+    # local files are hashed with a thread pool and tuner per device.
+    device_of = _DeviceMap(str(root.root)) if (isinstance(root.root, Path) and not root.is_cloud) else None
+
+    def make_tuner(key):
+        # start from the thread count saved by the last run on this device, if any.
+        lane_root = device_of.mounts.get(key, None) if device_of is not None else None
+        lane_root = lane_root if lane_root is not None else str(root.root)
+        pool_name = f"hash_{engine}"
+        saved = load_profile(lane_root, pool_name) if load_profile is not None else None
+        tuner = AIMDController(initial = saved[0] if saved is not None else initial, max_threads = max_threads, min_threads = min_threads)
+        if saved is not None:
+            log.info(f"starting {pool_name} for {lane_root} at {tuner.nthreads} from the saved tuning profile")
+        if tuners is not None:
+            tuners[(lane_root, pool_name)] = tuner
+        return tuner
+
+    try:
+        yield from _scan_pipeline(entry_pages, work_fn, make_tuner, page_size = page_size, batch_size = batch_size,
+                                  device_of = device_of, result_bytes = lambda myargs: myargs[4] or 0)
+    finally:
+        if pool is not None:
+            pool.shutdown(wait = True, cancel_futures = True)
+
+
+def _save_tuning_profiles(databasename: str, modality: str, tuners: dict):
+    for ((lane_root, pool_name), tuner) in tuners.items():
+        profile = tuner.profile()
+        if profile is not None:
+            TuningProfiles.save(databasename, lane_root, modality, pool_name, *profile)
+
+
+class _JournalWriter:
+    """
+    Single writer thread for the journal, shared by concurrent modality scans.
+
+    SQLite allows one writer at a time, so journal writes from all scans are queued here and run in submission
+    order, while the scans carry on listing and hashing.  After a write fails, later writes are not run, so a
+    checkpoint is never saved past a lost write.  The error is raised to the submitter by result() or check().
+    """
+
+    def __init__(self):
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers = 1, thread_name_prefix = "journal_writer")
+        self._error = None
+
+    def _run(self, fn, args, kwargs):
+        if self._error is not None:
+            raise RuntimeError(f"journal writer stopped after an earlier error: {self._error}")
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            self._error = e
+            raise
+
+    def submit(self, fn, *args, **kwargs) -> concurrent.futures.Future:
+        return self._executor.submit(self._run, fn, args, kwargs)
+
+    def call(self, fn, *args, **kwargs):
+        """
+        run fn on the writer thread after all writes submitted so far, and return its result.
+        """
+        return self.submit(fn, *args, **kwargs).result()
+
+    def check(self):
+        if self._error is not None:
+            raise self._error
+
+    def close(self):
+        self._executor.shutdown(wait = True)
 
 
 # Futures ThreadPoolExecutor may not work since python has a global interpreter lock (GIL) that prevents thread based parallelism, at least until 3.13 (optional)
@@ -96,13 +704,74 @@ def update_journal(root : FileSystemHelper, modalities: list[str],
     
     table_exists = JournalDispatcher.table_exists(database_name = databasename) if Path(databasename).exists() else False
 
-    # check if journal table exists
-    if table_exists:
-        return _update_journal(root, modalities, databasename = databasename, 
-                               journaling_mode = journaling_mode, 
-                               version = version, amend = amend, **kwargs)
-    else:  # no amend possible since the file did not exist.
-        return _gen_journal(root, modalities, databasename, version = version, **kwargs)
+    # optional digests computed with the md5, from the digests and digest_block_mb config settings.
+    digests = FileDigests.parse_config(kwargs.pop("digests", None), kwargs.pop("digest_block_mb", None) or 8)
+    # optional persistent md5 cache, from the hash_cache config setting.
+    hash_cache = HashCache.from_config(kwargs.pop("hash_cache", None))
+    prehash = Prehash.from_config(kwargs.pop("prehash_mb", None))
+    try:
+        # check if journal table exists
+        if table_exists:
+            return _update_journal(root, modalities, databasename = databasename, 
+                                   journaling_mode = journaling_mode, 
+                                   version = version, amend = amend, hash_cache = hash_cache, prehash = prehash, digests = digests, **kwargs)
+        else:  # no amend possible since the file did not exist.
+            return _gen_journal(root, modalities, databasename, version = version, hash_cache = hash_cache, prehash = prehash, digests = digests, **kwargs)
+    finally:
+        if hash_cache is not None:
+            hash_cache.close()
+
+
+def update_journal_modalities(roots: dict,
+                              databasename: str,
+                              journaling_mode = "append",
+                              version: str = None,
+                              amend: bool = False,
+                              **kwargs):
+    """
+    Update the journal for several modalities concurrently, each with its own root.
+
+    Modalities often live on different devices, so each is scanned in its own thread, with its own thread count
+    tuner, and all journal writes go through one _JournalWriter.  The update takes about as long as the slowest
+    modality instead of the sum.
+
+    Args:
+        roots (dict): FileSystemHelper for each modality.
+        other arguments are as for update_journal.
+    """
+    if len(roots) == 0:
+        return
+
+    digests = FileDigests.parse_config(kwargs.pop("digests", None), kwargs.pop("digest_block_mb", None) or 8)
+    hash_cache = HashCache.from_config(kwargs.pop("hash_cache", None))
+    prehash = Prehash.from_config(kwargs.pop("prehash_mb", None))
+    writer = _JournalWriter()
+    try:
+        # a new journal is created here, so concurrent updates do not race to create it.  an update into an empty
+        # journal adds every file, the same as _gen_journal.
+        writer.call(JournalDispatcher.create_journal_table, databasename)
+
+        errors = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers = len(roots), thread_name_prefix = "modality") as executor:
+            futures = { executor.submit(_update_journal, root, [modality], databasename = databasename,
+                                        journaling_mode = journaling_mode, version = version, amend = amend,
+                                        hash_cache = hash_cache, prehash = prehash, digests = digests, journal_writer = writer, **kwargs): modality
+                        for modality, root in roots.items() }
+            for future in concurrent.futures.as_completed(futures):
+                modality = futures[future]
+                try:
+                    future.result()
+                    log.info(f"Completed journal update for modality {modality}")
+                except Exception as e:
+                    log.error(f"Journal update for modality {modality} failed: {e}")
+                    errors[modality] = e
+        if len(errors) > 0:
+            # the other modalities are complete.  report the first failure.
+            raise next(iter(errors.values()))
+    finally:
+        writer.close()
+        if hash_cache is not None:
+            hash_cache.close()
         
 # compile a regex for extracting person id from waveform and iamge paths
 # the personid is the first part of the path, followed by the modality, then the rest of the path
@@ -128,6 +797,30 @@ def _get_modality_pattern(modality:str, modality_configs:dict):
     return pattern
 
 
+def _get_scan_backend(modality: str, modality_configs: dict, root: FileSystemHelper = None) -> tuple:
+    """
+    (backend, workers) for walking the modality's files, from its scan_backend and scan_workers settings.
+    """
+    modality_config = modality_configs.get(modality, {})
+    backend = modality_config.get("scan_backend", "thread")
+    workers = int(modality_config.get("scan_workers", 256))
+    if backend not in SCAN_BACKENDS:
+        raise ValueError(f"Unsupported scan_backend {backend} for modality {modality}.  Expected one of {SCAN_BACKENDS}")
+    if workers < 1:
+        raise ValueError(f"scan_workers should be at least 1 for modality {modality}.  Got {workers}")
+    if (backend != "thread") and (root is not None) and not root.walk_is_sorted:
+        log.warning(f"scan_backend {backend} is only used for local directories.  listing {str(root.root)} for modality {modality}")
+    elif backend != "thread":
+        log.info(f"walking modality {modality} with the {backend} backend, {workers} workers")
+    return (backend, workers)
+
+
+def _log_unmatched(unmatched: int, modality: str, pattern: str):
+    if unmatched > 0:
+        log.warning(f"{unmatched} files for modality {modality} do not fit pattern {pattern} and were skipped.  " +
+                    "Use --verbose to list them, or skip them while walking with include/exclude in the modality's site_path config")
+
+
 def _gen_journal(root : FileSystemHelper, modalities: list[str], 
                   databasename: str, 
                   version:str, 
@@ -156,13 +849,20 @@ def _gen_journal(root : FileSystemHelper, modalities: list[str],
         
     JournalDispatcher.create_journal_table(databasename)
     
-    paths = []
     curtimestamp = int(math.floor(time.time() * 1e6))
     all_args = []
     
     page_size = kwargs.get("page_size", 1000)
     n_cores = kwargs.get("n_cores", 32)
     nthreads = min(n_cores, min(32, (os.cpu_count() or 1) + 4))
+    hash_engine = kwargs.get("hash_engine", "auto")
+    hash_cache = kwargs.get("hash_cache", None)
+    prehash = kwargs.get("prehash", None)
+    digests = kwargs.get("digests", None)
+    defer_hash = kwargs.get("defer_hash", False)
+    if defer_hash and root.is_cloud:
+        log.warning(f"deferred hashing needs a local source.  computing MD5s for {root.root}")
+        defer_hash = False
     log.info(f"Scanning files to create journal. Calculating MD5 using {nthreads} threads")
 
     for modality in modalities:
@@ -173,47 +873,49 @@ def _gen_journal(root : FileSystemHelper, modalities: list[str],
             raise ValueError(f"Please use forward slash as path separator in pattern.  Got {pattern} for modality {modality}")
         
         version_in_pattern = ("{version:w}" in pattern) or ("{version}" in pattern)
-        compiled_pattern = parse.compile(pattern)
+        compiled_pattern = PathPattern(pattern)
+        name_filter = NameFilter.from_config(kwargs.get("modality_configs", {}).get(modality, {}))
+        scan_backend = _get_scan_backend(modality, kwargs.get("modality_configs", {}), root)
        
         total_count = 0
+        unmatched = 0
         lock = threading.Lock()
-        tuner = _AdaptiveThreads(initial=min(4, nthreads), max_threads=nthreads)
-        persistent_executor = None
-
-        for paths in root.get_files_iter(pattern = pattern, page_size = page_size):
-            page_start = time.time()
-            page_bytes = 0
-
-            ctx = (contextlib.nullcontext(persistent_executor)
-                   if persistent_executor is not None
-                   else concurrent.futures.ThreadPoolExecutor(max_workers=tuner.nthreads))
-            with ctx as executor:
-                futures = []
-                for relpath in paths:
-                    log.debug(f"scanning {relpath}")
-                    futures.append(executor.submit(_update_journal_one_file, root, relpath, modality, curtimestamp,
-                                                   {}, compiled_pattern,
-                                                   None if version_in_pattern else new_version,
-                                                   **{'lock': lock}))
-
-                for future in concurrent.futures.as_completed(futures):
-                    myargs = future.result()
-                    page_bytes += myargs[4] or 0
-                    perf.add_file(myargs[4])
-                    rlpath = myargs[1]
-                    status = myargs[8]
-                    if status in ["ADDED", "MOVED", "UPDATED"]:
-                        if verbose:
-                            log.debug(f"{status} {rlpath}")
-                        else:
-                            print(".", end="", flush=True)
-                        all_args.append(myargs)
-                    elif status == "ERROR4":
-                        log.debug(f"File does not fit pattern. {rlpath}")
-
-            tuner.update(page_bytes, time.time() - page_start)
-            if tuner.locked and persistent_executor is None:
-                persistent_executor = concurrent.futures.ThreadPoolExecutor(max_workers=tuner.nthreads)
+        def _scan_one(entry, md5 = None, md5_time = None, md5_digests = None, md5_prehash = None):
+            (relpath, filesize, modtimestamp) = entry
+            log.debug(f"scanning {relpath}")
+            return _update_journal_one_file(root, relpath, modality, curtimestamp,
+                                            {}, compiled_pattern,
+                                            None if version_in_pattern else new_version,
+                                            filesize = filesize, modtimestamp = modtimestamp,
+                                            md5 = md5, md5_time = md5_time, hash_cache = hash_cache,
+                                            prehash = prehash, digests = digests, md5_digests = md5_digests, md5_prehash = md5_prehash,
+                                            defer_hash = defer_hash,
+                                            **{'lock': lock})
+
+        # record directory mtimes, for --trust-dir-mtime in later updates.
+        dir_index = DirIndex(databasename, modality) if root.walk_is_sorted else None
+        # thread counts start from the last run's tuning profiles, and are saved for the next.
+        tuners = {}
+        load_profile = lambda lane_root, pool_name: TuningProfiles.load(databasename, lane_root, modality, pool_name)
+        for results in _scan_modality(root, pattern, {}, compiled_pattern, _scan_one, nthreads,
+                                      page_size = page_size, hash_engine = hash_engine, hash_cache = hash_cache,
+                                      dir_index = dir_index, load_profile = load_profile, tuners = tuners,
+                                      digests = digests, defer_hash = defer_hash, prehash = prehash, name_filter = name_filter,
+                                      scan_backend = scan_backend):
+            for myargs in results:
+                perf.add_file(myargs[4])
+                rlpath = myargs[1]
+                status = myargs[8]
+                if status in ["ADDED", "MOVED", "UPDATED"]:
+                    if verbose:
+                        log.debug(f"{status} {rlpath}")
+                    else:
+                        print(".", end="", flush=True)
+                    all_args.append(myargs)
+                elif status == "ERROR4":
+                    unmatched += 1
+                    if verbose:
+                        log.info(f"File does not fit pattern. {rlpath}")
 
             insert_count = JournalDispatcher.insert_journal_entries(databasename, all_args)
             total_count += len(all_args)
@@ -221,20 +923,35 @@ def _gen_journal(root : FileSystemHelper, modalities: list[str],
             all_args = []
             perf.report()
 
-        if persistent_executor is not None:
-            persistent_executor.shutdown(wait=True)
-        
+        if dir_index is not None:
+            dir_index.save()
+        _save_tuning_profiles(databasename, modality, tuners)
+        _log_unmatched(unmatched, modality, pattern)
         del perf
         log.info(f"Journal Update took {time.time() - start} s")
         
 
 # only accept relpath with forward slash
 def _update_journal_one_file(root: FileSystemHelper, relpath:str, modality:str, curtimestamp:int, 
-                             modality_files_to_inactivate:dict, compiled_pattern:parse.Parser, 
+                             modality_files_to_inactivate:dict, compiled_pattern:PathPattern, 
                              version:str = None, 
+                             filesize:int = None, modtimestamp:int = None,
+                             md5:str = None, md5_time:float = None,
+                             hash_cache: HashCache = None,
+                             prehash: Prehash = None,
+                             digests: tuple = None, md5_digests: tuple = None, md5_prehash: str = None,
+                             defer_hash: bool = False,
                              **kwargs):
     
     # version can be none only if version is embedded in the path.
+    # filesize and modtimestamp may be supplied by the directory walker, in which case the file is not stat'd again.
+    # md5 (and md5_time) may be supplied by the process hash engine, in which case the file is not hashed again.
+    # otherwise the md5 comes from hash_cache if it has an entry for the file, or from reading the file.
+    # with digests set ((names, block_size) from FileDigests.parse_config), and prehash set, files read for their MD5 also get
+    # those digests and their prehash, computed in the same pass.  md5_digests and md5_prehash came with md5 from the
+    # process hash engine.  with defer_hash as well, a changed prehash marks a file UPDATED without reading it in full.
+    # with defer_hash, files without an uploaded version (new files, and files whose MD5 is still pending) are not read:
+    # their MD5 is PENDING_MD5, and the upload computes it.
     
     # TODO need to handle version vs old version.
     lock = kwargs.get("lock", None)
@@ -242,13 +959,13 @@ def _update_journal_one_file(root: FileSystemHelper, relpath:str, modality:str,
     relpath = Path(relpath).as_posix()
     
     # first item is personid.
-    parsed = compiled_pattern.parse(relpath)
+    parsed = compiled_pattern.named(relpath)
     if parsed is not None:
-        personid = parsed.named.get("patient_id", None)
-        version = version if version is not None else parsed.named.get("version", None)
+        personid = parsed.get("patient_id", None)
+        version = version if version is not None else parsed.get("version", None)
         log.debug(f"Parsed {relpath} person id {personid} version {version}")
     else:
-        return (None, relpath, modality, None, 0, None, curtimestamp, None, "ERROR4", None, None)
+        return (None, relpath, modality, None, 0, None, curtimestamp, None, "ERROR4", None, None, None, None)
         
     # matched = PERSONID_REGEX.match(relpath)
     # personid = matched.group(1) if matched else None
@@ -259,17 +976,18 @@ def _update_journal_one_file(root: FileSystemHelper, relpath:str, modality:str,
         
         # There should only be 1 active file according to the path in a well-formed 
         if (len(results) > 1):
-            return (personid, relpath, modality, None, 0, None, curtimestamp, None, "ERROR1", None, None)
+            return (personid, relpath, modality, None, 0, None, curtimestamp, None, "ERROR1", None, None, None, None)
         if (len(results) == 0):
-            return (personid, relpath, modality, None, 0, None, curtimestamp, None, "ERROR2", None, None)
+            return (personid, relpath, modality, None, 0, None, curtimestamp, None, "ERROR2", None, None, None, None)
         
         if len(results) == 1:
-            (oldfileid, oldsize, oldmtime, oldmd5, oldsync, oldversion) = results[0]
+            (oldfileid, oldsize, oldmtime, oldmd5, oldsync, oldversion, oldprehash) = results[0]
             
-            # get information about the current file
-            meta = FileSystemHelper.get_metadata(root = root.root, path = relpath, with_metadata = True, with_md5 = False, **kwargs)
-            filesize = meta['size']
-            modtimestamp = meta['modify_time_us']
+            # get information about the current file, unless the walker already provided it
+            if (filesize is None) or (modtimestamp is None):
+                meta = FileSystemHelper.get_metadata(root = root.root, path = relpath, with_metadata = True, with_md5 = False, **kwargs)
+                filesize = meta['size']
+                modtimestamp = meta['modify_time_us']
         
             # if old size and new size, old mtime and new mtime are same (name is already matched)
             # then same file, skip rest.
@@ -279,47 +997,118 @@ def _update_journal_one_file(root: FileSystemHelper, relpath:str, modality:str,
                     
                     # del modality_files_to_inactivate[relpath]  # do not mark file as inactive.
                     log.debug(f"SAME {relpath}")
-                    return (personid, relpath, modality, oldmtime, oldsize, oldmd5, curtimestamp, oldsync, "KEEP", None, oldversion)
+                    return (personid, relpath, modality, oldmtime, oldsize, oldmd5, curtimestamp, oldsync, "KEEP", None, oldversion, None, None)
                 else:
                     #time stamp same but file size is different?
-                    return (personid, relpath, modality, oldmtime, oldsize, oldmd5, curtimestamp, oldsync, "ERROR3", None, oldversion)
+                    return (personid, relpath, modality, oldmtime, oldsize, oldmd5, curtimestamp, oldsync, "ERROR3", None, oldversion, None, None)
                 
+            elif defer_hash and (oldmd5 == PENDING_MD5) and (md5 is None):
+                # never hashed, so never uploaded.  the MD5 stays pending for the upload, and the file is not read.
+                myargs = (personid, relpath, modality, modtimestamp, filesize, PENDING_MD5, curtimestamp, None, "UPDATED", None, version, None, None)
+
             else:
                 # timestamp changed. we need to compute md5 to check, or to update.
-                start = time.time()
-                mymd5 = FileSystemHelper.get_metadata(root = root.root, path = relpath, with_metadata = False, with_md5 = True,  **kwargs)['md5']
-                md5_time = time.time() - start
+                # with the MD5 deferred to the upload, the file is sampled first: a different prehash means the content changed.
+                sampled = None
+                if defer_hash and (md5 is None) and (prehash is not None) and (oldsize == filesize) and prehash.comparable(oldprehash):
+                    sampled = prehash.compute(root, relpath)
+                    if prehash.differs(oldprehash, sampled):
+                        log.debug(f"prehash changed {relpath}")
+                        return (personid, relpath, modality, modtimestamp, filesize, PENDING_MD5, curtimestamp, None, "UPDATED", None, version, sampled, None)
+
+                if md5 is not None:
+                    (mymd5, mydigests, myprehash) = (md5, md5_digests, md5_prehash)
+                else:
+                    start = time.time()
+                    (mymd5, mydigests, myprehash) = _get_local_md5(root, relpath, hash_cache, digests = digests, prehash = prehash, **kwargs)
+                    md5_time = time.time() - start
+                # not read in full if the MD5 came from hash_cache.
+                myprehash = myprehash if myprehash is not None else sampled
 
                 # files are extremely likely the same just moved.
                 # set the old entry as invalid and add a new one that's essentially a copy except for modtime..
                 # choosing not to change SYNC_TIME
                 # cur.execute("UPDATE journal SET TIME_INVALID_us=? WHERE file_id=?", (curtimestamp, oldfileid))
                 if (oldsize == filesize) and (mymd5 == oldmd5):
-                    # essentially copy the old and update the modtime.
-                    myargs = (personid, relpath, modality, modtimestamp, oldsize, oldmd5, curtimestamp, oldsync, "MOVED", md5_time, oldversion)
+                    # essentially copy the old and update the modtime.  the content, and so the prehash, is the same.
+                    if (myprehash is None) and (prehash is not None) and prehash.comparable(oldprehash):
+                        myprehash = oldprehash
+                    myargs = (personid, relpath, modality, modtimestamp, oldsize, oldmd5, curtimestamp, oldsync, "MOVED", md5_time, oldversion, myprehash, mydigests)
 
                     # files_to_inactivate.remove(oldfileid)  # we should mark old as inactive 
                 else:
                     # files are different.  set the old file as invalid and add a new file.
-                    myargs = (personid, relpath, modality, modtimestamp, filesize, mymd5, curtimestamp, None, "UPDATED", md5_time, version)
+                    myargs = (personid, relpath, modality, modtimestamp, filesize, mymd5, curtimestamp, None, "UPDATED", md5_time, version, myprehash, mydigests)
                     # if verbose:
                     #     log.debug(f"UPDATED {relpath}")
                     # modified file. old one should be removed.
     else:
         # if DNE, add new file
         start = time.time()
-        meta = FileSystemHelper.get_metadata(root = root.root, path = relpath, with_metadata = True, with_md5 = True,  **kwargs)
-        filesize = meta['size']
-        modtimestamp = meta['modify_time_us']
-        mymd5 = meta['md5']
-        md5_time = time.time() - start
+        (mydigests, myprehash) = (None, None)
+        if defer_hash and (md5 is None):
+            # a file with a pending MD5 is not read.
+            if (filesize is None) or (modtimestamp is None):
+                meta = FileSystemHelper.get_metadata(root = root.root, path = relpath, with_metadata = True, with_md5 = False,  **kwargs)
+                filesize = meta['size']
+                modtimestamp = meta['modify_time_us']
+            (mymd5, md5_time) = (PENDING_MD5, None)
+        elif ((filesize is None) or (modtimestamp is None)) and (digests is None) and (prehash is None):
+            meta = FileSystemHelper.get_metadata(root = root.root, path = relpath, with_metadata = True, with_md5 = True,  **kwargs)
+            filesize = meta['size']
+            modtimestamp = meta['modify_time_us']
+            mymd5 = meta['md5']
+            md5_time = time.time() - start
+        elif (filesize is None) or (modtimestamp is None):
+            meta = FileSystemHelper.get_metadata(root = root.root, path = relpath, with_metadata = True, with_md5 = False,  **kwargs)
+            filesize = meta['size']
+            modtimestamp = meta['modify_time_us']
+            (mymd5, mydigests, myprehash) = _get_local_md5(root, relpath, hash_cache, digests = digests, prehash = prehash, **kwargs)
+            md5_time = time.time() - start
+        elif md5 is not None:
+            (mymd5, mydigests, myprehash) = (md5, md5_digests, md5_prehash)
+        else:
+            (mymd5, mydigests, myprehash) = _get_local_md5(root, relpath, hash_cache, digests = digests, prehash = prehash, **kwargs)
+            md5_time = time.time() - start
 
-        myargs = (personid, relpath, modality, modtimestamp, filesize, mymd5, curtimestamp, None, "ADDED", md5_time, version)
+        myargs = (personid, relpath, modality, modtimestamp, filesize, mymd5, curtimestamp, None, "ADDED", md5_time, version, myprehash, mydigests)
 
             
     return myargs
 
 
+def _get_local_md5(root: FileSystemHelper, relpath: str, hash_cache: HashCache = None, digests: tuple = None,
+                   prehash: Prehash = None, **kwargs) -> tuple:
+    """
+    MD5 of a file, looked up in hash_cache by (device, inode, size, mtime) before reading the file.  
+    cloud files are always read.
+
+    Returns:
+        (md5, digests, prehash).  digests is the FileDigests result if digests ((names, block_size)) is set, and prehash
+        the prehash if prehash is set, when the local file was read.  otherwise None.
+    """
+    is_local = (not root.is_cloud) and isinstance(root.root, Path)
+    fullpath = os.path.join(str(root.root), relpath)
+    key = None
+    if (hash_cache is not None) and is_local:
+        (md5, key) = hash_cache.get(fullpath)
+        if md5 is not None:
+            return (md5, None, None)
+
+    file_digests = None
+    file_prehash = None
+    if is_local and ((digests is not None) or (prehash is not None)):
+        file_digests = FileDigests(*digests) if digests is not None else None
+        file_prehash = prehash.new() if prehash is not None else None
+        md5 = _md5_local_file(fullpath, digests = file_digests, prehash = file_prehash)[0].hexdigest()
+    else:
+        md5 = FileSystemHelper.get_metadata(root = root.root, path = relpath, with_metadata = False, with_md5 = True,  **kwargs)['md5']
+    if key is not None:
+        hash_cache.put(fullpath, key, md5)
+    return (md5, file_digests.result() if file_digests is not None else None,
+            file_prehash.result() if file_prehash is not None else None)
+
+
 # record is a mess with a file-wise traversal. Files need to be grouped by unique record ID (visit_occurence?)
 def _update_journal(root: FileSystemHelper, modalities: list[str],
                     databasename : str,
@@ -335,6 +1124,10 @@ def _update_journal(root: FileSystemHelper, modalities: list[str],
         modalities (list[str], optional): The subdirectories to search for files. Defaults to ['Waveforms', 'Images', 'OMOP', 'Metadata'].
         databasename (str, optional): The name of the journal database. Defaults to "journal.db".
         verbose (bool, optional): Whether to print verbose output. Defaults to False.
+        resume (bool, optional): continue an interrupted update of a local root from its checkpoint (see ScanCheckpoint).
+        defer_hash (bool, optional): journal new files with a pending MD5 (PENDING_MD5), computed later by the upload.
+        journal_writer (_JournalWriter, optional): shared writer when modalities are updated concurrently.  by default
+            the update uses its own.
     """
     
     verbose = kwargs.get("verbose", False)
@@ -356,171 +1149,290 @@ def _update_journal(root: FileSystemHelper, modalities: list[str],
     
 
     perf = perf_counter.PerformanceCounter()
+
+    # all journal writes go through the writer thread.  reads use their own connections.
+    journal_writer = kwargs.get("journal_writer", None)
+    writer = journal_writer if journal_writer is not None else _JournalWriter()
     
-    # check if journal table exists.
-    curtimestamp = int(math.floor(time.time() * 1e6))
+    # check if journal table exists.  also adds tables and columns introduced since the journal was created.
+    writer.call(JournalDispatcher.create_journal_table, databasename)
+    writer.call(ScanCheckpoint.create_table, databasename)
+    run_timestamp = int(math.floor(time.time() * 1e6))
     
     page_size = kwargs.get("page_size", 1000)
     
     n_cores = kwargs.get("n_cores", 32)
     nthreads = min(n_cores, min(32, (os.cpu_count() or 1) + 4))
+    hash_engine = kwargs.get("hash_engine", "auto")
+    hash_cache = kwargs.get("hash_cache", None)
+    prehash = kwargs.get("prehash", None)
+    digests = kwargs.get("digests", None)
+    defer_hash = kwargs.get("defer_hash", False)
+    if defer_hash and root.is_cloud:
+        log.warning(f"deferred hashing needs a local source.  computing MD5s for {root.root}")
+        defer_hash = False
+    trust_dir_mtime = kwargs.get("trust_dir_mtime", False)
+    resume = kwargs.get("resume", False)
     log.info(f"Updating journal {databasename} using {nthreads} threads")
 
-    paths = []
-    all_insert_args = []
-    all_del_args = []
-    total_count = 0
-    total_deleted = 0
-    for modality in modalities:
-        start = time.time()
+    try:
+        all_insert_args = []
+        total_count = 0
+        total_deleted = 0
+        for modality in modalities:
+            start = time.time()
         
-        pattern = _get_modality_pattern(modality, kwargs.get("modality_configs", {}))
-        if "\\" in pattern:
-            raise ValueError(f"Please use forward slash as path separator in pattern.  Got {pattern} for modality {modality}")
-        # if version is in the file name, then use that.
-        version_in_pattern = ("{version:w}" in pattern) or ("{version}" in pattern)
-        # compile the pattern
-        compiled_pattern = parse.compile(pattern)
+            pattern = _get_modality_pattern(modality, kwargs.get("modality_configs", {}))
+            if "\\" in pattern:
+                raise ValueError(f"Please use forward slash as path separator in pattern.  Got {pattern} for modality {modality}")
+            # if version is in the file name, then use that.
+            version_in_pattern = ("{version:w}" in pattern) or ("{version}" in pattern)
+            # compile the pattern
+            compiled_pattern = PathPattern(pattern)
+            # include/exclude globs and max_depth, applied while walking.
+            name_filter = NameFilter.from_config(kwargs.get("modality_configs", {}).get(modality, {}))
+            scan_backend = _get_scan_backend(modality, kwargs.get("modality_configs", {}), root)
+            unmatched = 0
         
-        # do one modality at a time for now - logic is tested.  doing multiple modalities may accidentally delete?
-        activefiletuples = JournalDispatcher.get_files_with_meta(databasename, 
-                                                           version = None, 
-                                                           modalities = [modality], 
-                                                           **{'active': True} )
-        log.info(f"known active, existing files in journal: count {len(activefiletuples)}")
-
-        # initialize by putting all files in files_to_inactivate.  remove from this list if we see the files on disk
-        modality_files_to_inactivate = {}
-        for (fid, fpath, modtime, size, md5, mod, invalidtime, ver, uploadtime) in activefiletuples:
-            if fpath not in modality_files_to_inactivate.keys():
-                modality_files_to_inactivate[fpath] = [ (fid, size, modtime, md5, uploadtime, ver), ]
-            else:
-                modality_files_to_inactivate[fpath].append((fid, size, modtime, md5, uploadtime, ver))
-        # log.info(f"filenames count = {len(modality_files_to_inactivate)}, {modality_files_to_inactivate.keys()}")
-
-        modality_files_to_inactivate_rdonly = dict(modality_files_to_inactivate)
-
-        lock = threading.Lock()
-        tuner = _AdaptiveThreads(initial=min(4, nthreads), max_threads=nthreads)
-        persistent_executor = None
-
-        for paths in root.get_files_iter(pattern = pattern, page_size = page_size ):
-            page_start = time.time()
-            page_bytes = 0
-            modality_files_to_inactivate_in_iter = {}
-
-            ctx = (contextlib.nullcontext(persistent_executor)
-                   if persistent_executor is not None
-                   else concurrent.futures.ThreadPoolExecutor(max_workers=tuner.nthreads))
-            with ctx as executor:
-                futures = []
-                for relpath in paths:
-                    futures.append(executor.submit(_update_journal_one_file, root, relpath, modality, curtimestamp,
-                                                   modality_files_to_inactivate_rdonly,
-                                                   compiled_pattern, None if version_in_pattern else journal_version,
-                                                   **{'lock': lock}))
-
-                for future in concurrent.futures.as_completed(futures):
-                    myargs = future.result()
-                    page_bytes += myargs[4] or 0
-                    perf.add_file(myargs[4])
-
-                    status = myargs[8]
-                    rlpath = myargs[1]
-                    if status == "ERROR1":
-                        log.error(f"Multiple active files with that path - journal is not consistent {rlpath}")
-                    elif status == "ERROR2":
-                        log.error(f"File found but no metadata. {rlpath}")
-                    elif status == "ERROR3":
-                        log.error(f"File size is different but modtime is the same. {rlpath}")
-                    elif status == "ERROR4":
-                        log.error(f"File does not fit pattern. {rlpath}")
-                    elif status == "KEEP":
-                        if verbose:
-                            log.debug(f"{status} {rlpath}")
-                        del modality_files_to_inactivate[rlpath]
-                    elif status == "ADDED":
-                        if verbose:
-                            log.debug(f"{status} {rlpath}")
-                        all_insert_args.append(myargs)
-                    elif status in ["MOVED", "UPDATED"]:
-                        if verbose:
-                            log.debug(f"{status} {rlpath}")
-                        all_insert_args.append(myargs)
-                        modality_files_to_inactivate_in_iter[rlpath] = modality_files_to_inactivate[rlpath]
-                        del modality_files_to_inactivate[rlpath]
-                    else:
-                        log.debug(f"unknown status:  {status}, {rlpath}")
-
-            tuner.update(page_bytes, time.time() - page_start)
-            if tuner.locked and persistent_executor is None:
-                persistent_executor = concurrent.futures.ThreadPoolExecutor(max_workers=tuner.nthreads)
-
-            # remove the outdated items.
-            del_args_in_iter = []
-            for relpath, vals in modality_files_to_inactivate_in_iter.items():
-                if not (relpath.isalnum() or relpath.isascii()):
-                    log.warning(f"Path contains non-alphanumeric characters: {relpath}")
-                for v in vals:
-                    if (relpath in paths):
-                        del_args_in_iter.append(("OUTDATED", v[0]))
-                        if verbose:
-                            log.debug(f"OUTDATED  {relpath}")
-                    elif (journaling_mode == "full") or (journaling_mode == "snapshot"):
-                        del_args_in_iter.append(("DELETED", v[0]))
-                        if verbose:
-                            log.debug(f"DELETED  {relpath}")
-
-            if len(del_args_in_iter) > 0:
-                deleted = JournalDispatcher.inactivate_journal_entries(databasename,
-                                                                       curtimestamp,
-                                                                       del_args_in_iter)
-                total_deleted += deleted
-                log.info(f"deleted/outdated {deleted} of {len(del_args_in_iter)} from journal. total {total_deleted} inactivated")
-
-            update_count = JournalDispatcher.insert_journal_entries(databasename, all_insert_args)
-            total_count += len(all_insert_args)
-            log.info(f"inserted {update_count} of {len(all_insert_args)}.  added {total_count} files to journal.db")
-            all_insert_args = []
-            perf.report()
+            delete_missing = (journaling_mode == "full") or (journaling_mode == "snapshot")
+
+            # local walks are sorted by path: merge-join them with the active entries, read back in path order.
+            #   memory is bounded by the files in flight, and deleted files come out of the merge.
+            #   progress is checkpointed, and files found missing are only inactivated once the walk completes.
+            # other walks (cloud) look up a dict of all active entries, and find deleted files by anti-join at the end.
+            merge = root.walk_is_sorted
+
+            # an interrupted update continues after the last checkpointed path, with the same version and timestamp.
+            curtimestamp = run_timestamp
+            start_after = None
+            checkpoint = ScanCheckpoint.load(databasename, modality)
+            if (checkpoint is not None) and resume and merge:
+                (cp_version, cp_timestamp, start_after) = checkpoint
+                if cp_version != journal_version:
+                    raise ValueError(f"Checkpoint for modality {modality} is for version {cp_version}, not {journal_version}.  Resume with --version {cp_version}")
+                curtimestamp = cp_timestamp
+                log.info(f"resuming update of modality {modality}, version {cp_version}, after {start_after}")
+            elif checkpoint is not None:
+                log.warning(f"discarding checkpoint of an interrupted update of modality {modality}, version {checkpoint[0]}.  scanning all files")
+                writer.call(ScanCheckpoint.clear, databasename, modality)
+            elif resume:
+                log.info(f"no checkpoint for modality {modality}.  scanning all files")
+            if resume and not merge:
+                log.warning(f"resume is only supported for local directories.  scanning all files in {str(root.root)}")
+        
+            # do one modality at a time for now - logic is tested.  doing multiple modalities may accidentally delete?
+            with ScanSession(databasename) as session:
+                journal_only = queue.SimpleQueue()
+                if merge:
+                    nactive = JournalDispatcher.load_active_files_sorted(session, modality)
+                    # active entries by path, for the files in flight only.  filled by the merge, emptied by the writer.
+                    modality_active_files = {}
+                    def _on_journal_only(relpath, rows):
+                        if delete_missing:
+                            journal_only.put((relpath, rows))
+                    # walked paths in order, for the checkpoint: the last path such that it and all before it are written.
+                    walked = collections.deque()
+                    written = set()
+                    def _track(pages):
+                        for page in pages:
+                            walked.extend(entry[0] for entry in page)
+                            yield page
+                    entry_filter = lambda pages: _track(_merge_with_journal(pages, session.iter_active_files(start_after = start_after),
+                                                                            modality_active_files, _on_journal_only))
+                    # files in directories unchanged since the last update are not stat'd if trusted.  their values come from the merge.
+                    # a resumed walk does not list every directory, so the index is not updated.
+                    dir_index = DirIndex(databasename, modality, trust = trust_dir_mtime) if start_after is None else None
+                else:
+                    activefiletuples = JournalDispatcher.get_files_with_meta(databasename, 
+                                                                       version = None, 
+                                                                       modalities = [modality], 
+                                                                       **{'active': True, 'with_prehash': True} )
+                    nactive = len(activefiletuples)
+                    # active entries by path, for classifying scanned files.  read-only during the scan.
+                    modality_active_files = {}
+                    for (fid, fpath, modtime, size, md5, mod, invalidtime, ver, uploadtime, oldprehash) in activefiletuples:
+                        if fpath not in modality_active_files.keys():
+                            modality_active_files[fpath] = [ (fid, size, modtime, md5, uploadtime, ver, oldprehash), ]
+                        else:
+                            modality_active_files[fpath].append((fid, size, modtime, md5, uploadtime, ver, oldprehash))
+                    del activefiletuples
+                    entry_filter = None
+                    dir_index = None
+                    if trust_dir_mtime:
+                        log.warning(f"directory mtimes are only used for local directories.  stat'ing all files in {str(root.root)}")
+                log.info(f"known active, existing files in journal: count {nactive}")
+
+                def _deleted_args():
+                    # files in the journal but no longer on disk, as found by the merge so far.
+                    args = []
+                    while True:
+                        try:
+                            (relpath, rows) = journal_only.get_nowait()
+                        except queue.Empty:
+                            return args
+                        # check if there are non alphanumeric characters in the path
+                        # if so, print out the path
+                        if not (relpath.isalnum() or relpath.isascii()):
+                            log.warning(f"Path contains non-alphanumeric characters: {relpath}")
+                        for v in rows:
+                            args.append(("DELETED", v[0]))
+                            if verbose:
+                                log.debug(f"DELETED  {relpath}")
+
+                def _write_page(del_args, insert_args, checkpoint):
+                    # runs on the writer thread.  returns the number of entries inactivated.
+                    # one transaction, so the checkpoint is never saved without the page's writes, or vice versa.
+                    deleted = 0
+                    with SQLiteDB.transaction(databasename):
+                        if len(del_args) > 0:
+                            deleted = JournalDispatcher.inactivate_journal_entries(databasename, curtimestamp, del_args)
+                            log.info(f"deleted/outdated {deleted} of {len(del_args)} from journal for modality {modality}")
+                        if len(insert_args) > 0:
+                            update_count = JournalDispatcher.insert_journal_entries(databasename, insert_args)
+                            log.info(f"inserted {update_count} of {len(insert_args)} into journal for modality {modality}")
+                        if checkpoint is not None:
+                            ScanCheckpoint.save(databasename, modality, journal_version, curtimestamp, *checkpoint)
+                    return deleted
+                # writes queued but not yet done, oldest first.  a few are allowed so the scan does not wait on each write.
+                pending_writes = collections.deque()
+
+                lock = threading.Lock()
+                def _scan_one(entry, md5 = None, md5_time = None, md5_digests = None, md5_prehash = None):
+                    (relpath, filesize, modtimestamp) = entry
+                    return _update_journal_one_file(root, relpath, modality, curtimestamp,
+                                                    modality_active_files,
+                                                    compiled_pattern, None if version_in_pattern else journal_version,
+                                                    filesize = filesize, modtimestamp = modtimestamp,
+                                                    md5 = md5, md5_time = md5_time, hash_cache = hash_cache,
+                                                    prehash = prehash, digests = digests, md5_digests = md5_digests, md5_prehash = md5_prehash,
+                                                    defer_hash = defer_hash,
+                                                    **{'lock': lock})
+
+                # thread counts start from the last run's tuning profiles, and are saved for the next.
+                tuners = {}
+                load_profile = lambda lane_root, pool_name: TuningProfiles.load(databasename, lane_root, modality, pool_name)
+                for results in _scan_modality(root, pattern, modality_active_files, compiled_pattern, _scan_one, nthreads,
+                                              page_size = page_size, hash_engine = hash_engine, entry_filter = entry_filter,
+                                              hash_cache = hash_cache, dir_index = dir_index, start_after = start_after,
+                                              load_profile = load_profile, tuners = tuners, digests = digests,
+                                              defer_hash = defer_hash, prehash = prehash, name_filter = name_filter,
+                                              scan_backend = scan_backend):
+                    if not merge:
+                        # every scanned path goes into a temp table, for the anti-join at the end.
+                        session.add([myargs[1] for myargs in results])
+
+                    del_args_in_iter = []
+                    for myargs in results:
+                        perf.add_file(myargs[4])
+
+                        status = myargs[8]
+                        rlpath = myargs[1]
+                        known = modality_active_files.pop(rlpath, None) if merge else modality_active_files.get(rlpath, None)
+                        if status == "ERROR1":
+                            log.error(f"Multiple active files with that path - journal is not consistent {rlpath}")
+                        elif status == "ERROR2":
+                            log.error(f"File found but no metadata. {rlpath}")
+                        elif status == "ERROR3":
+                            log.error(f"File size is different but modtime is the same. {rlpath}")
+                        elif status == "ERROR4":
+                            # summarized after the scan.  often temp files or other data under the root.
+                            unmatched += 1
+                            if verbose:
+                                log.info(f"File does not fit pattern. {rlpath}")
+                        elif status == "KEEP":
+                            if verbose:
+                                log.debug(f"{status} {rlpath}")
+                            continue
+                        elif status == "ADDED":
+                            if verbose:
+                                log.debug(f"{status} {rlpath}")
+                            all_insert_args.append(myargs)
+                            continue
+                        elif status in ["MOVED", "UPDATED"]:
+                            if verbose:
+                                log.debug(f"{status} {rlpath}")
+                            all_insert_args.append(myargs)
+                        else:
+                            log.debug(f"unknown status:  {status}, {rlpath}")
+
+                        # the file is on disk, but its current entries are replaced (MOVED, UPDATED) or inconsistent (ERROR): outdate them.
+                        if known is not None:
+                            if not (rlpath.isalnum() or rlpath.isascii()):
+                                log.warning(f"Path contains non-alphanumeric characters: {rlpath}")
+                            for v in known:
+                                del_args_in_iter.append(("OUTDATED", v[0]))
+                                if verbose:
+                                    log.debug(f"OUTDATED  {rlpath}")
+
+                    checkpoint = None
+                    if merge:
+                        # the checkpoint is written after this page's entries, so it covers them.
+                        written.update(myargs[1] for myargs in results)
+                        while (len(walked) > 0) and (walked[0] in written):
+                            start_after = walked.popleft()
+                            written.discard(start_after)
+                        checkpoint = (start_after, [fid for (_, fid) in _deleted_args()])
+
+                    writer.check()
+                    pending_writes.append(writer.submit(_write_page, del_args_in_iter, all_insert_args, checkpoint))
+                    total_count += len(all_insert_args)
+                    log.info(f"queued {len(all_insert_args)} new entries.  added {total_count} files to journal for modality {modality}")
+                    all_insert_args = []
+                    while len(pending_writes) > 2:
+                        total_deleted += pending_writes.popleft().result()
+                    perf.report()
+
+                while len(pending_writes) > 0:
+                    total_deleted += pending_writes.popleft().result()
+
+                if dir_index is not None:
+                    writer.call(dir_index.save)
+                writer.call(_save_tuning_profiles, databasename, modality, tuners)
+
+                # for all files that were active but aren't there anymore, invalidate in journal
+                if merge:
+                    writer.call(ScanCheckpoint.save, databasename, modality, journal_version, curtimestamp, start_after,
+                                [fid for (_, fid) in _deleted_args()])
+                    all_del_args = [("DELETED", fid) for fid in ScanCheckpoint.get_deleted(databasename, modality)]
+                else:
+                    all_del_args = []
+                    if delete_missing:
+                        for (fid, relpath) in JournalDispatcher.get_unscanned_active_files(session, modality):
+                            journal_only.put((relpath, [(fid,)]))
+                        all_del_args = _deleted_args()
+                    log.info(f"scanned {session.count} files for modality {modality}")
+            _log_unmatched(unmatched, modality, pattern)
 
-            # for all files that were active but aren't there anymore
-            # invalidate in journal
-            for relpath, vals in modality_files_to_inactivate.items():
-                # check if there are non alphanumeric characters in the path
-                # if so, print out the path
-                if not (relpath.isalnum() or relpath.isascii()):
-                    log.warning(f"Path contains non-alphanumeric characters: {relpath}")
-
-                for v in vals:
-                    if (relpath in paths):
-                        all_del_args.append(("OUTDATED", v[0]))
-                        if verbose:
-                            log.debug(f"OUTDATED  {relpath}")
-                    elif (journaling_mode == "full") or (journaling_mode == "snapshot"):
-                        all_del_args.append(("DELETED", v[0]))
-                        if verbose:
-                            log.debug(f"DELETED  {relpath}")
             # log.info(f"SQLITE update arguments {all_del_args}")
-            if (total_count == 0) and len(all_del_args) == 0:
+            if (total_count == 0) and (total_deleted == 0) and len(all_del_args) == 0:
                 log.info(f"Nothing to change in journal for modality {modality}")
             elif (len(all_del_args) > 0):
                 # back up only on upload
                 # backup_journal(databasename)
-                
-                deleted = JournalDispatcher.inactivate_journal_entries(databasename, 
-                                                       curtimestamp, 
-                                                       all_del_args)
+
+                deleted = writer.call(JournalDispatcher.inactivate_journal_entries, databasename, 
+                                      curtimestamp, 
+                                      all_del_args)
                 total_deleted += deleted
                 to_delete = len(all_del_args)
-                log.info(f"deleted/outdated {deleted} of {to_delete} from journal." )
-            
-        if persistent_executor is not None:
-            persistent_executor.shutdown(wait=True)
+                log.info(f"deleted {deleted} of {to_delete} from journal." )
 
-        del perf
-        log.info(f"Total added {total_count} and inactivated {total_deleted} files in journal.db")
-        log.info(f"Journal Update Elapsed time {time.time() - start} s")
+            if delete_missing:
+                # renamed or relocated files are added and deleted in the same update.  link them so upload copies server side.
+                moved = writer.call(JournalDispatcher.mark_moved_files, databasename, modality, curtimestamp)
+                if moved > 0:
+                    log.info(f"found {moved} moved files for modality {modality}")
+
+            if merge:
+                writer.call(ScanCheckpoint.clear, databasename, modality)
+
+            del perf
+            log.info(f"Total added {total_count} and inactivated {total_deleted} files in journal.db")
+            log.info(f"Journal Update Elapsed time {time.time() - start} s")
+    finally:
+        # a writer of our own finishes the queued writes, so an interrupted update keeps its checkpoint.
+        if journal_writer is None:
+            writer.close()
 
 
 # explicitly mark files as deleted.  This is best used when the journaling mode is "append"
@@ -603,13 +1515,15 @@ def list_files_with_info(databasename: str, version: Optional[str] = None,
     modality_configs = kwargs.get("modality_configs", {})
     compiled_patterns = {}
     for mod in modalities:
-        compiled_patterns[mod] = parse.compile(_get_modality_pattern(mod, modality_configs))
+        compiled_patterns[mod] = PathPattern(_get_modality_pattern(mod, modality_configs))
     
     
 
     if not table_exists:
         log.error(f"table journal does not exist in {databasename}.")
         return None, None, None
+    # e.g. MOVED_FROM_ID, read by get_moved_files.
+    JournalDispatcher.upgrade_in_place(databasename)
 
     # identify 3 subsets:   deleted, updated, and added.
     # deleted:  file with invalid time stamp.  No additional valid time stamp
@@ -638,6 +1552,7 @@ def list_files_with_info(databasename: str, version: Optional[str] = None,
     active_files_by_version = {}
     active_files = {}  # file path should be unique.
     inactive_files = {}  # file path to file id mapping is not unique
+    active_by_modality = {}  # central paths are converted per modality, in batches.
     
     
     for (fid, fn, mtime, size, md5, modality, invalidtime, version, uploadtime) in files_to_update:
@@ -646,10 +1561,10 @@ def list_files_with_info(databasename: str, version: Optional[str] = None,
             if (fn in active_files.keys()):
                 log.error(f"Inconsistent Journal.  Multiple active files with path {fn}")
             else:
-                central_fn = convert_local_to_central_path(fn, in_compiled_pattern = compiled_patterns.get(modality, None), 
-                                                           modality = modality,
-                                                           omop_per_patient = modality_configs.get(modality, {}).get("omop_per_patient", False))
-                active_files[fn] = {'file_id': fid, 'size': size, 'md5': md5, 'version': version, 'central_path': central_fn}
+                # a pending md5 (journal update --defer-hash) is computed by the upload.
+                active_files[fn] = {'file_id': fid, 'size': size, 'md5': md5 if md5 != PENDING_MD5 else None,
+                                    'version': version, 'central_path': None}
+                active_by_modality.setdefault(modality, []).append(fn)
                 
             if (version in active_files_by_version.keys()):
                 active_files_by_version[version].append(fn)
@@ -662,6 +1577,24 @@ def list_files_with_info(databasename: str, version: Optional[str] = None,
             else:
                 inactive_files[fn] = [fid]
     
+    for (modality, fns) in active_by_modality.items():
+        central_fns = convert_local_to_central_paths(fns, compiled_patterns.get(modality, None), modality,
+                                                     omop_per_patient = modality_configs.get(modality, {}).get("omop_per_patient", False))
+        for (fn, central_fn) in zip(fns, central_fns):
+            active_files[fn]['central_path'] = central_fn
+
+    # files moved from an uploaded file:  record the source's version and central path, for a server side copy.
+    moved_files = JournalDispatcher.get_moved_files(databasename, modalities) if len(active_files) > 0 else {}
+    active_fns = {info['file_id']: fn for (fn, info) in active_files.items()} if len(moved_files) > 0 else {}
+    for (fid, (src_fid, src_fn, src_modality, src_version)) in moved_files.items():
+        fn = active_fns.get(fid, None)
+        if fn is None:
+            continue
+        src_central_fn = convert_local_to_central_path(src_fn, in_compiled_pattern = compiled_patterns.get(src_modality, None),
+                                                       modality = src_modality,
+                                                       omop_per_patient = modality_configs.get(src_modality, {}).get("omop_per_patient", False))
+        active_files[fn]['moved_from'] = {'file_id': src_fid, 'version': src_version, 'central_path': src_central_fn}
+
     for version in active_files_by_version.keys():
         active_files_by_version[version] = set(active_files_by_version[version])
     for fn in inactive_files.keys():
@@ -696,8 +1629,16 @@ MOD_STRING = {
     "metadata": "Metadata"
 }
 
+def _as_posix(local_path: str) -> str:
+    # same as Path(local_path).as_posix(), which also drops "." components, repeated and trailing slashes.
+    # journal paths are already in that form, so only paths that could change go through Path.
+    if (local_path == "") or ("\\" in local_path) or ("//" in local_path) or local_path.endswith("/") or \
+        (local_path == ".") or local_path.startswith("./") or ("/./" in local_path) or local_path.endswith("/."):
+        return Path(local_path).as_posix()
+    return local_path
+
 # if version is specified, then it has priority over what's in the local_path string.
-def convert_local_to_central_path(local_path:str, in_compiled_pattern:parse.Parser, modality:str, 
+def convert_local_to_central_path(local_path:str, in_compiled_pattern:PathPattern, modality:str, 
                                     omop_per_patient:bool = False, patient_centric: bool = True):
     """
     Convert a local path to a central path using the pattern.
@@ -711,26 +1652,40 @@ def convert_local_to_central_path(local_path:str, in_compiled_pattern:parse.Pars
         str: The central path, including version.
 
     """
+    return convert_local_to_central_paths([local_path], in_compiled_pattern, modality,
+                                          omop_per_patient = omop_per_patient, patient_centric = patient_centric)[0]
 
-    local_path = Path(local_path).as_posix()
+def convert_local_to_central_paths(local_paths: list[str], in_compiled_pattern: PathPattern, modality: str,
+                                   omop_per_patient: bool = False, patient_centric: bool = True) -> list[str]:
+    """
+    Convert local paths of one modality to central paths, as convert_local_to_central_path.  The output path
+    format is chosen once for the batch.
 
-    parsed = in_compiled_pattern.parse(local_path)
-    if parsed is None:
-        raise ValueError(f"ERROR: Invalid local path {local_path}, pattern {in_compiled_pattern}")
-    
-    patient_id = parsed.named.get('patient_id', None)
-    filepath = parsed.named.get('filepath', None)
-    
+    Returns:
+        list[str]: the central paths, in the order of local_paths.
+
+    Raises:
+        ValueError: if a local path does not match the pattern.
+    """
     mod = modality.lower()
     MOD_STR = MOD_STRING.get(mod, modality)
-    out_pattern = "{patient_id}/" + MOD_STR + "/{filepath}" if patient_centric else MOD_STR + "/{patient_id}/" + "{filepath}"
     if mod == "omop" and not omop_per_patient:
-        out_pattern = "OMOP/{filepath}"
+        to_central = lambda named: f"OMOP/{named.get('filepath', None)}"
     elif mod == "metadata":
-        out_pattern = "Metadata/{filepath}"
-
-    # convert the local path to a central path
-    return out_pattern.format(patient_id = patient_id, filepath = filepath)
+        to_central = lambda named: f"Metadata/{named.get('filepath', None)}"
+    elif patient_centric:
+        to_central = lambda named: f"{named.get('patient_id', None)}/{MOD_STR}/{named.get('filepath', None)}"
+    else:
+        to_central = lambda named: f"{MOD_STR}/{named.get('patient_id', None)}/{named.get('filepath', None)}"
+
+    central_paths = []
+    for local_path in local_paths:
+        local_path = _as_posix(local_path)
+        named = in_compiled_pattern.named(local_path)
+        if named is None:
+            raise ValueError(f"ERROR: Invalid local path {local_path}, pattern {in_compiled_pattern}")
+        central_paths.append(to_central(named))
+    return central_paths
 
 def list_versions(databasename: str, version: str):
     """
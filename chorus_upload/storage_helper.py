@@ -50,6 +50,7 @@ from cloudpathlib.enums import FileCacheMode
 from pathlib import Path, WindowsPath, PureWindowsPath, PurePosixPath
 # from pathlib import PosixPath
 import hashlib
+import inspect
 import math
 from typing import Optional, Union
 import sys
@@ -59,6 +60,12 @@ else:
     from typing_extensions import Self
 
 import os
+import re
+import fnmatch
+import stat
+import threading
+import mmap
+import time
 
 import shutil
 from chorus_upload import config_helper
@@ -66,14 +73,18 @@ import base64
 
 import asyncio
 import aiofiles
-from azure.core.exceptions import ResourceNotFoundError
+import concurrent.futures
+import functools
+import heapq
+import itertools
+from azure.core.exceptions import ResourceNotFoundError, HttpResponseError
 
 import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 from cloudpathlib import S3Client
 from azure.identity import DefaultAzureCredential
-from azure.storage.blob import BlobServiceClient
+from azure.storage.blob import BlobServiceClient, ContentSettings
 from cloudpathlib import AzureBlobClient
 import requests
 from requests.adapters import HTTPAdapter
@@ -358,6 +369,628 @@ def __clone_az_client(orig: AzureBlobClient, pool_size: int = None) -> AzureBlob
 #     return GoogleCloudClient(**params) 
 
 
+# Local file hashing reads with readinto into a buffer that each thread (or hash worker process) reuses, so hashing
+# does not allocate a bytes object per chunk.  The buffer size depends on the device class of the file:
+#
+# device class     detected by                                   buffer   notes
+# ---------------  --------------------------------------------  -------  ----------------------------------------
+# ssd              /sys/dev/block/<major:minor>, rotational = 0  1 MB     already at full speed with small reads
+# hdd              /sys/dev/block/<major:minor>, rotational = 1  4 MB     fewer, larger reads between seeks
+# other            no block device (NFS, SMB, zfs, btrfs, non    4 MB     fewer round trips on network file systems
+#                  Linux)
+#
+# Where posix_fadvise is available (Linux), the file is marked SEQUENTIAL before reading (larger readahead), and
+# DONTNEED after, so a journal scan does not evict the page cache that other services on the host rely on.
+#
+# Files of at least _mmap_min_size bytes on the device classes in _mmap_devices are instead hashed from a read-only
+# memory map with madvise(MADV_SEQUENTIAL), which avoids the read syscalls and the copy into the buffer.  This is
+# set with configure_hashing() from the hash_mmap config setting, and is off by default: whether it is faster
+# depends on the device (see benchmark_hashing), and a file truncated while it is mapped raises SIGBUS.
+
+_HASH_BUFFER_SIZES = {"ssd": 1024 * 1024, "hdd": 4 * 1024 * 1024, "other": 4 * 1024 * 1024}
+DEVICE_CLASSES = list(_HASH_BUFFER_SIZES.keys())
+HASH_READERS = ["read", "mmap"]
+_MMAP_CHUNK_SIZE = 16 * 1024 * 1024
+_device_classes = {}
+_hash_buffers = threading.local()
+_mmap_min_size = 256 * 1024 * 1024
+_mmap_devices = set()
+
+def configure_hashing(mmap_devices: Union[str, list, None] = None, mmap_min_mb: int = 256):
+    """
+    select the device classes whose large files are hashed through a memory map.
+
+    Args:
+        mmap_devices: comma separated string or list of device classes ("ssd", "hdd", "other").  None or "" for none.
+        mmap_min_mb (int): files smaller than this are always read.
+    """
+    global _mmap_min_size, _mmap_devices
+    if isinstance(mmap_devices, str):
+        mmap_devices = [d.strip() for d in mmap_devices.split(",") if d.strip() != ""]
+    devices = set(mmap_devices or [])
+    unknown = devices - set(DEVICE_CLASSES)
+    if len(unknown) > 0:
+        raise ValueError(f"Unsupported device class {sorted(unknown)} in hash_mmap.  Expected some of {DEVICE_CLASSES}")
+    (_mmap_devices, _mmap_min_size) = (devices, int(mmap_min_mb) * 1024 * 1024)
+    if len(devices) > 0:
+        log.info(f"hashing files of at least {mmap_min_mb} MB on {', '.join(sorted(devices))} devices through a memory map")
+
+def get_hashing_config() -> tuple:
+    """
+    (mmap_devices, mmap_min_mb), for configuring worker processes the same way.
+    """
+    return (sorted(_mmap_devices), _mmap_min_size // (1024 * 1024))
+
+def _device_class(st_dev: int) -> str:
+    """
+    "ssd", "hdd" or "other" for a device id, from sysfs.  cached per device.
+    """
+    device_class = _device_classes.get(st_dev, None)
+    if device_class is not None:
+        return device_class
+    device_class = "other"
+    if sys.platform.startswith("linux"):
+        sysdir = f"/sys/dev/block/{os.major(st_dev)}:{os.minor(st_dev)}"
+        # a partition has its queue settings in the parent device.
+        for queue in (os.path.join(sysdir, "queue"), os.path.join(sysdir, "..", "queue")):
+            try:
+                with open(os.path.join(queue, "rotational")) as f:
+                    device_class = "hdd" if f.read().strip() == "1" else "ssd"
+                break
+            except OSError:
+                continue
+    _device_classes[st_dev] = device_class
+    log.debug(f"device {st_dev} is {device_class}.  hashing with {_HASH_BUFFER_SIZES[device_class] // 1024} KB reads")
+    return device_class
+
+def _hash_buffer(size: int) -> memoryview:
+    buf = getattr(_hash_buffers, "buf", None)
+    if (buf is None) or (len(buf) != size):
+        buf = memoryview(bytearray(size))
+        _hash_buffers.buf = buf
+    return buf
+
+# Digests that can be computed in the same pass as the MD5, configured with the digests setting:
+#
+# digest      stored as                                      used for
+# ----------  ---------------------------------------------  ------------------------------------------------
+# block_md5   BLOCK_MD5 column: the 16 byte MD5 of each      verify of S3 multipart ETags (md5 of the part
+#             BLOCK_SIZE block, concatenated                 md5s), when the part size is BLOCK_SIZE
+#
+# Azure uploads do not need them: the blob Content-MD5 is set from the journal MD5 at upload (see copy_file_to).
+
+DIGESTS = ["block_md5"]
+
+# default multipart_chunksize of boto3 and the aws cli
+S3_DEFAULT_PART_SIZE = 8 * 1024 * 1024
+
+class FileDigests:
+    """
+    The configured extra digests of one file, updated with the same data as its MD5.
+    """
+
+    def __init__(self, names: list, block_size: int):
+        self.block_size = block_size
+        self._blocks = bytearray() if "block_md5" in names else None
+        self._block_md5 = hashlib.md5()
+        self._block_fill = 0
+
+    @classmethod
+    def parse_config(cls, digests: Union[str, list, None], block_mb: int = S3_DEFAULT_PART_SIZE // (1024 * 1024)) -> Optional[tuple]:
+        """
+        (names, block_size) from the digests and digest_block_mb settings, or None if no extra digests are configured.
+        """
+        if isinstance(digests, str):
+            digests = [d.strip() for d in digests.split(",") if d.strip() != ""]
+        names = sorted(set(digests or []) - {"md5"})
+        if len(names) == 0:
+            return None
+        unknown = set(names) - set(DIGESTS)
+        if len(unknown) > 0:
+            raise ValueError(f"Unsupported digest {sorted(unknown)}.  Expected some of {DIGESTS}")
+        log.info(f"computing {', '.join(names)} digests with the MD5, block size {block_mb} MB")
+        return (names, int(block_mb) * 1024 * 1024)
+
+    def update(self, data: memoryview):
+        if self._blocks is not None:
+            pos = 0
+            while pos < len(data):
+                n = min(len(data) - pos, self.block_size - self._block_fill)
+                self._block_md5.update(data[pos:pos + n])
+                (pos, self._block_fill) = (pos + n, self._block_fill + n)
+                if self._block_fill == self.block_size:
+                    self._blocks += self._block_md5.digest()
+                    (self._block_md5, self._block_fill) = (hashlib.md5(), 0)
+
+    def result(self) -> tuple:
+        """
+        (block size or None, block md5s or None).  call once, after the last update.
+        """
+        if self._blocks is None:
+            return (None, None)
+        if self._block_fill > 0:
+            self._blocks += self._block_md5.digest()
+        return (self.block_size, bytes(self._blocks))
+
+
+# Prehash: a sampled MD5 of a large file, for telling a changed file from a touched one without reading it in full.
+#
+# region    bytes hashed
+# --------  ----------------------------------------------------------------
+# size      the file size, as decimal text
+# head      the first sample_mb MB
+# blocks    _PREHASH_BLOCKS evenly spaced blocks of up to _PREHASH_BLOCK_SIZE between head and tail
+# tail      the last sample_mb MB
+#
+# Files not larger than head + tail have no prehash.  The value is "<sample_mb>:<md5 hex>".
+
+_PREHASH_BLOCKS = 8
+_PREHASH_BLOCK_SIZE = 64 * 1024
+
+class FilePrehash:
+    """
+    The prehash of one file.  Updated with the same data as its MD5, or with the sampled regions only.
+    """
+
+    def __init__(self, sample_mb: int):
+        self.sample_mb = sample_mb
+        self.sample_size = sample_mb * 1024 * 1024
+        self.regions = []
+        self._md5 = None
+        self._pos = 0
+
+    def start(self, size: int):
+        """
+        set the file size, which places the regions.  call before the first update.
+        """
+        (self.regions, self._md5, self._pos) = ([], None, 0)
+        if size <= 2 * self.sample_size:
+            return
+        self._md5 = hashlib.md5(str(size).encode("ascii"))
+        span = size - 2 * self.sample_size
+        block = min(_PREHASH_BLOCK_SIZE, span // _PREHASH_BLOCKS)
+        blocks = [self.sample_size + (span * i) // _PREHASH_BLOCKS for i in range(_PREHASH_BLOCKS)] if block > 0 else []
+        self.regions = [(0, self.sample_size)] + [(offset, offset + block) for offset in blocks] + [(size - self.sample_size, size)]
+
+    def update(self, data: memoryview, offset: int = None):
+        """
+        hash the parts of data that fall in the regions.  data follows the previous update, or starts at offset.
+        """
+        if offset is not None:
+            self._pos = offset
+        end = self._pos + len(data)
+        while (self._md5 is not None) and (len(self.regions) > 0) and (self.regions[0][0] < end):
+            (region_start, region_end) = self.regions[0]
+            self._md5.update(data[max(region_start - self._pos, 0):min(region_end, end) - self._pos])
+            if region_end > end:
+                break
+            self.regions.pop(0)
+        self._pos = end
+
+    def result(self) -> Optional[str]:
+        """
+        the prehash, or None if the file is too small or not all regions were read.
+        """
+        if (self._md5 is None) or (len(self.regions) > 0):
+            return None
+        return f"{self.sample_mb}:{self._md5.hexdigest()}"
+
+
+def multipart_etag(block_md5: bytes) -> str:
+    """
+    S3 ETag of a multipart upload whose parts have the given concatenated MD5s.
+    """
+    return f"{hashlib.md5(block_md5).hexdigest()}-{len(block_md5) // 16}"
+
+
+def _md5_local_file(path: Union[str, Path], md5 = None, reader: str = None, digests: FileDigests = None,
+                    prehash: FilePrehash = None) -> tuple:
+    """
+    MD5 of a local file, read with readinto into the calling thread's buffer, or from a memory map (see configure_hashing).
+
+    Args:
+        path: local file path.
+        md5 (optional): hashlib object to update, e.g. to continue a hash.  a new md5 by default.
+        reader (str, optional): "read" or "mmap" to override the configured choice, for benchmarking.
+        digests (FileDigests, optional): updated with the same data.
+        prehash (FilePrehash, optional): started with the file size, and updated with the same data.
+
+    Returns:
+        (md5, stat) with the hashlib object and the os.stat_result of the opened file, so size and mtime match the content.
+
+    Raises:
+        OSError: if the file cannot be opened or read.
+    """
+    md5 = md5 if md5 is not None else hashlib.md5()
+    with open(path, "rb", buffering = 0) as f:
+        fd = f.fileno()
+        st = os.fstat(fd)
+        if prehash is not None:
+            prehash.start(st.st_size)
+        device_class = _device_class(st.st_dev)
+        if reader is None:
+            reader = "mmap" if (device_class in _mmap_devices) and (st.st_size >= _mmap_min_size) else "read"
+        advise = hasattr(os, "posix_fadvise")
+        if advise:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        try:
+            if (reader == "mmap") and (st.st_size > 0):
+                with mmap.mmap(fd, 0, access = mmap.ACCESS_READ) as m:
+                    if hasattr(m, "madvise"):
+                        m.madvise(mmap.MADV_SEQUENTIAL)
+                    with memoryview(m) as view:
+                        for offset in range(0, len(view), _MMAP_CHUNK_SIZE):
+                            md5.update(view[offset:offset + _MMAP_CHUNK_SIZE])
+                            if digests is not None:
+                                digests.update(view[offset:offset + _MMAP_CHUNK_SIZE])
+                            if prehash is not None:
+                                prehash.update(view[offset:offset + _MMAP_CHUNK_SIZE])
+            else:
+                buf = _hash_buffer(_HASH_BUFFER_SIZES[device_class])
+                while (n := f.readinto(buf)) > 0:
+                    md5.update(buf[:n])
+                    if digests is not None:
+                        digests.update(buf[:n])
+                    if prehash is not None:
+                        prehash.update(buf[:n])
+        finally:
+            if advise:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    return (md5, st)
+
+
+def benchmark_hashing(paths: list, repeat: int = 1) -> dict:
+    """
+    Compare the hash readers on local files, grouped by device class.
+
+    Each file is hashed with each reader in turn.  The file is dropped from the page cache first where posix_fadvise
+    is available, so both readers read from the device.  Without it, later passes may be served from cache.
+
+    Args:
+        paths (list): local file paths.  large files give the most meaningful comparison.
+        repeat (int): passes over the files.
+
+    Returns:
+        dict: {device class: {reader: (files, bytes, seconds)}}.
+    """
+    results = {}
+    for _ in range(repeat):
+        for path in paths:
+            for reader in HASH_READERS:
+                try:
+                    if hasattr(os, "posix_fadvise"):
+                        with open(path, "rb") as f:
+                            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+                    start = time.perf_counter()
+                    (_, st) = _md5_local_file(path, reader = reader)
+                    elapsed = time.perf_counter() - start
+                except OSError as e:
+                    log.warning(f"cannot hash {path}: {e}")
+                    break
+                (files, nbytes, seconds) = results.setdefault(_device_class(st.st_dev), {}).get(reader, (0, 0, 0.0))
+                results[_device_class(st.st_dev)][reader] = (files + 1, nbytes + st.st_size, seconds + elapsed)
+    return results
+
+
+class _HashingReader:
+    """
+    Wraps a file opened for an upload, and updates md5 with the data as it is read.  Used by journal update --defer-hash,
+    so the file is hashed in the same read as the upload.  The wrapper is not seekable, so the upload reads the file
+    in order.  The file's read may be a coroutine (aiofiles), in which case read returns one.
+    """
+
+    def __init__(self, f, md5):
+        self._f = f
+        self.md5 = md5
+
+    def read(self, size: int = -1):
+        data = self._f.read(size)
+        if inspect.isawaitable(data):
+            return self._read_async(data)
+        self.md5.update(data)
+        return data
+
+    async def _read_async(self, pending):
+        data = await pending
+        self.md5.update(data)
+        return data
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return False
+
+
+# Per modality name filters, from the include, exclude and max_depth settings of the modality's site_path section:
+#
+# setting    applies to              effect
+# ---------  ----------------------  ------------------------------------------------------------------------
+# exclude    file and directory      matching files are skipped, and matching directories are not entered
+#            names
+# include    file names              only matching files are listed.  directories are always entered
+# max_depth  depth below the root    files deeper than max_depth levels are skipped, and directories at
+#                                    max_depth are not entered.  files directly under the root are at depth 1
+#
+# globs are fnmatch patterns on names (e.g. ".*", "*.tmp"), matched case insensitively like the modality pattern.
+# local walks apply them while descending.  cloud listings cannot prune, so their paths are filtered afterwards.
+
+class NameFilter:
+    """
+    Include and exclude globs on names and a maximum depth, applied by the walker while descending.
+    """
+
+    def __init__(self, include: list = None, exclude: list = None, max_depth: int = None):
+        self.include = include or []
+        self.exclude = exclude or []
+        self.max_depth = max_depth
+        self._include = NameFilter._compile(self.include)
+        self._exclude = NameFilter._compile(self.exclude)
+
+    @classmethod
+    def _compile(cls, globs: list) -> Optional[re.Pattern]:
+        if len(globs) == 0:
+            return None
+        for g in globs:
+            if ("/" in g) or ("\\" in g):
+                raise ValueError(f"include and exclude globs match file and directory names, not paths.  Got {g}")
+        return re.compile("|".join(fnmatch.translate(g) for g in globs), re.IGNORECASE)
+
+    @classmethod
+    def from_config(cls, modality_config: dict) -> Optional[Self]:
+        """
+        a NameFilter from the include, exclude and max_depth settings, or None if none are set.
+        """
+        globs = {}
+        for key in ["include", "exclude"]:
+            value = modality_config.get(key, None)
+            if isinstance(value, str):
+                value = [g.strip() for g in value.split(",")]
+            globs[key] = [g for g in (value or []) if g != ""]
+        max_depth = modality_config.get("max_depth", None)
+        if max_depth is not None:
+            max_depth = int(max_depth)
+            if max_depth < 1:
+                raise ValueError(f"max_depth should be at least 1.  Got {max_depth}")
+        if (len(globs["include"]) == 0) and (len(globs["exclude"]) == 0) and (max_depth is None):
+            return None
+        return cls(globs["include"], globs["exclude"], max_depth)
+
+    def enter_dir(self, name: str, depth: int) -> bool:
+        """
+        whether to list the directory name, at depth levels below the root.
+        """
+        if (self.max_depth is not None) and (depth >= self.max_depth):
+            return False
+        return (self._exclude is None) or (self._exclude.match(name) is None)
+
+    def keep_file(self, name: str, depth: int) -> bool:
+        """
+        whether to list the file name, at depth levels below the root.
+        """
+        if (self.max_depth is not None) and (depth > self.max_depth):
+            return False
+        if (self._exclude is not None) and (self._exclude.match(name) is not None):
+            return False
+        return (self._include is None) or (self._include.match(name) is not None)
+
+    def keep_path(self, relpath: str) -> bool:
+        """
+        whether the walker would list relpath, a posix path relative to the root.  for listings that cannot be pruned.
+        """
+        parts = relpath.split("/")
+        for (depth, name) in enumerate(parts[:-1], start = 1):
+            if not self.enter_dir(name, depth):
+                return False
+        return self.keep_file(parts[-1], len(parts))
+
+    def __repr__(self):
+        return f"<NameFilter include={self.include} exclude={self.exclude} max_depth={self.max_depth}>"
+
+
+# Local walk backends for journal scans, selected per modality with the scan_backend setting:
+#
+# backend  listings and stats                                   best for
+# -------  ---------------------------------------------------  ----------------------------------------------
+# thread   one at a time, in the lister thread                  local disks: served from the inode cache
+# async    up to scan_workers in flight, from an asyncio loop   NAS/NFS/SMB mounts: each listing or stat is a
+#          on a pool of blocking workers                        network round trip, hidden by concurrency
+#
+# Both yield the same entries in the same order.  The async walk queues listings and batches of file stats as
+# directories are listed, and runs the ones nearest in walk order first.
+# The blocking calls run on a thread pool: io_uring has no binding in the standard library.
+
+SCAN_BACKENDS = ["thread", "async"]
+
+class _AsyncWalk:
+    """
+    The walk of FileSystemHelper._walk_local, with directory listings and file stats run concurrently.
+
+    Listings and batches of file stats are queued by walk order (relative path), and up to scan_workers of them run
+    at a time, nearest first.  Iterate in one thread: the event loop runs while the caller iterates, and at most
+    max_ahead directories are listed ahead of the walk.
+    """
+
+    # consecutive files of a directory stat'd in one call on a worker.
+    stat_batch_size = 16
+
+    def __init__(self, root: str, segments: list, dir_index = None, start_after: str = None,
+                 name_filter: NameFilter = None, workers: int = 256, page_size: int = 1000):
+        self.root = root
+        self.segments = segments
+        self.dir_index = dir_index
+        self.start_after = start_after
+        self.name_filter = name_filter
+        self.workers = max(1, workers)
+        self.max_ahead = 4 * self.workers
+        self.page_size = page_size
+        self._loop = None
+        self._executor = None
+        self._jobs = []  # heap of (walk order key, seq, fn, args, future) waiting for a worker
+        self._seq = itertools.count()
+        self._running = 0
+        self._ahead = 0  # directories listed, or being listed, and not yet walked
+        self._needed = None  # the job the walk is waiting for.  it may start past max_ahead
+
+    def __iter__(self):
+        self._loop = asyncio.new_event_loop()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers = self.workers, thread_name_prefix = "scan_async")
+        pages = self._pages()
+        try:
+            while True:
+                try:
+                    page = self._loop.run_until_complete(pages.__anext__())
+                except StopAsyncIteration:
+                    return
+                yield from page
+        finally:
+            self._loop.run_until_complete(pages.aclose())
+            tasks = asyncio.all_tasks(self._loop)
+            if len(tasks) > 0:
+                # listings ahead of a walk that stopped early.
+                for task in tasks:
+                    task.cancel()
+                self._loop.run_until_complete(asyncio.gather(*tasks, return_exceptions = True))
+            self._loop.close()
+            self._executor.shutdown(wait = True, cancel_futures = True)
+
+    def _submit(self, key: str, fn, *args) -> asyncio.Future:
+        future = self._loop.create_future()
+        heapq.heappush(self._jobs, (key, next(self._seq), fn, args, future))
+        return future
+
+    def _dispatch(self):
+        # start queued jobs, nearest in walk order first, while workers are free.
+        while (self._running < self.workers) and (len(self._jobs) > 0):
+            (_, _, fn, args, future) = self._jobs[0]
+            is_listing = fn is FileSystemHelper._list_dir
+            if is_listing and (self._ahead >= self.max_ahead) and (future is not self._needed):
+                return
+            heapq.heappop(self._jobs)
+            if future.cancelled():
+                continue
+            if is_listing:
+                self._ahead += 1
+            self._running += 1
+            self._loop.run_in_executor(self._executor, fn, *args).add_done_callback(functools.partial(self._on_done, future))
+
+    def _on_done(self, future: asyncio.Future, done: asyncio.Future):
+        self._running -= 1
+        if not future.cancelled():
+            if done.cancelled():
+                future.cancel()
+            elif done.exception() is not None:
+                future.set_exception(done.exception())
+            else:
+                future.set_result(done.result())
+        self._dispatch()
+
+    async def _wait(self, future: asyncio.Future):
+        if not future.done():
+            self._needed = future
+            self._dispatch()
+        result = await future
+        self._needed = None
+        return result
+
+    def _node(self, dirpath: str, reldir: str, states: set) -> dict:
+        node = { "path": dirpath, "rel": reldir, "states": states }
+        node["job"] = self._submit(reldir + "/", FileSystemHelper._list_dir, dirpath, self.dir_index is not None)
+        node["task"] = self._loop.create_task(self._list(node))
+        return node
+
+    @staticmethod
+    def _stat_batch(files: list) -> list:
+        return [FileSystemHelper._stat_entry(entry) for (_, entry) in files]
+
+    async def _list(self, node: dict) -> list:
+        """
+        wait for the node's listing, and queue the listings of its subdirectories and the stats of its files.
+        returns its walk items in order: a node for each subdirectory to enter, (relpath, None, None) for each file
+        of a trusted directory, and ([(relpath, DirEntry), ...], stat future) for each batch of consecutive files.
+        """
+        try:
+            (dir_mtime_ns, entries) = await node["job"]
+        except (PermissionError, FileNotFoundError, NotADirectoryError) as e:
+            log.warning(f"cannot list directory {node['path']}: {e}")
+            return []
+        reldir = node["rel"]
+        trusted = self.dir_index.visit(reldir if reldir != "" else ".", dir_mtime_ns, len(entries)) if self.dir_index is not None else False
+
+        items = []
+        batch = []
+        def _end_batch():
+            if len(batch) > 0:
+                items.append((list(batch), self._submit(batch[0][0], _AsyncWalk._stat_batch, list(batch))))
+                batch.clear()
+        for (relpath, entry, next_states) in FileSystemHelper._match_entries(reldir, entries, node["states"], self.segments,
+                                                                            self.start_after, self.name_filter):
+            if next_states is not None:
+                _end_batch()
+                items.append(self._node(entry.path, relpath, next_states))
+            elif trusted:
+                # unchanged directory: size and mtime are filled in from the journal.
+                if entry.is_file():
+                    items.append((relpath, None, None))
+            else:
+                batch.append((relpath, entry))
+                if len(batch) >= _AsyncWalk.stat_batch_size:
+                    _end_batch()
+        _end_batch()
+        self._dispatch()
+        return items
+
+    async def _walk(self, node: dict):
+        await self._wait(node["job"])
+        items = await node["task"]
+        self._ahead -= 1
+        self._dispatch()
+        for item in items:
+            if isinstance(item, dict):
+                async for found in self._walk(item):
+                    yield found
+            elif isinstance(item[1], asyncio.Future):
+                (files, pending) = item
+                metas = await self._wait(pending)
+                for ((relpath, _), meta) in zip(files, metas):
+                    if meta is not None:
+                        yield (relpath,) + meta
+            else:
+                yield item
+
+    async def _pages(self):
+        page = []
+        async for found in self._walk(self._node(self.root, "", {0})):
+            page.append(found)
+            if len(page) >= self.page_size:
+                yield page
+                page = []
+        if len(page) > 0:
+            yield page
+
+
+def benchmark_walk(root: "FileSystemHelper", pattern: str, workers: int = 256, repeat: int = 1, name_filter: NameFilter = None) -> dict:
+    """
+    Compare the scan backends on a local root: list and stat the files matching pattern, without hashing.
+
+    The backends take turns in each pass.  Directory and attribute caches are not dropped, so the first pass may
+    be slower for either backend.  Use repeat to see the warm numbers.
+
+    Returns:
+        dict: {backend: (files, seconds)}, totals over the passes.
+    """
+    glob_pattern = root.convert_pattern(pattern, True)
+    results = {}
+    for _ in range(repeat):
+        for backend in SCAN_BACKENDS:
+            start = time.perf_counter()
+            files = sum(1 for _ in root._walk_local(glob_pattern, name_filter = name_filter, scan_backend = backend, scan_workers = workers))
+            elapsed = time.perf_counter() - start
+            (nfiles, seconds) = results.get(backend, (0, 0.0))
+            results[backend] = (nfiles + files, seconds + elapsed)
+    return results
+
+
 class FileSystemHelper:
     
     # Azure client ways to sign in:
@@ -487,7 +1120,10 @@ class FileSystemHelper:
         
         # calculate for any path.  involves downloading, effectively.    
         # Initialize the MD5 hash object
-        if (curr.exists()):
+        if isinstance(curr, Path):
+            if curr.exists():
+                (md5, _) = _md5_local_file(curr)
+        elif (curr.exists()):
             md5 = hashlib.md5()
 
             # Open the file in binary mode
@@ -604,10 +1240,8 @@ class FileSystemHelper:
                 metadata["create_time_us"] = int(math.floor(stat_result.st_ctime * 1e6)) if stat_result.st_ctime else None
 
             if with_md5:
-                md5 = hashlib.md5()
-                async with aiofiles.open(curr, "rb") as f:
-                    while chunk := await f.read(1024 * 1024):
-                        md5.update(chunk)
+                # one worker thread reads the whole file, instead of a thread round trip per chunk.
+                (md5, _) = await asyncio.to_thread(_md5_local_file, curr)
                 metadata["md5"] = md5.hexdigest()
 
         else:
@@ -859,7 +1493,225 @@ class FileSystemHelper:
         if (count > 0):
             yield paths
         log.info("completed retrieving files.")
-        
+
+
+    @classmethod
+    def _compile_glob_segments(cls, glob_pattern: str) -> list:
+        """
+        Split a glob pattern into per-directory segments for the local walker.
+
+        Args:
+            glob_pattern (str): glob pattern as produced by convert_pattern, e.g. "*/Waveforms/**/*".
+
+        Returns:
+            list: one entry per path segment.  "**" is kept as the string "**", other segments are
+                case insensitive compiled regexes.
+        """
+        segments = []
+        for seg in glob_pattern.split("/"):
+            if seg == "" or seg == ".":
+                continue
+            if seg == "**":
+                # consecutive "**" are equivalent to one.
+                if len(segments) == 0 or segments[-1] != "**":
+                    segments.append("**")
+            else:
+                segments.append(re.compile(fnmatch.translate(seg), re.IGNORECASE))
+        return segments
+
+    @classmethod
+    def _expand_glob_states(cls, segments: list, states: set) -> set:
+        # "**" matches zero directories, so a state sitting on "**" is also a state on the next segment.
+        expanded = set(states)
+        pending = list(states)
+        while len(pending) > 0:
+            i = pending.pop()
+            if i < len(segments) and segments[i] == "**" and (i + 1) not in expanded:
+                expanded.add(i + 1)
+                pending.append(i + 1)
+        return expanded
+
+    def _walk_local(self, glob_pattern: str, dir_index = None, start_after: str = None, name_filter: NameFilter = None,
+                    scan_backend: str = "thread", scan_workers: int = 256):
+        """
+        Walk the local root with os.scandir, yielding (relpath, size, mtime_us) for files matching glob_pattern.
+
+        Type and stat information come from the DirEntry objects, so each file is stat'd once.  Directories
+        that cannot lead to a match are never entered.  Like pathlib's glob, "**" does not descend into
+        symlinked directories while a single segment wildcard does.  Files are yielded in lexicographic
+        order of their relative posix path.
+
+        dir_index (journaldb_ops.DirIndex, optional) is called as visit(reldir, mtime_ns, nentries) for each
+        directory listed ('.' for the root).  If it returns True, files in that directory are not stat'd and
+        are yielded with size and mtime_us set to None.
+
+        If start_after is set, only files with relpath > start_after are yielded, and subtrees that sort entirely
+        before it are not listed.  Used to resume an interrupted walk.
+
+        name_filter (NameFilter, optional) is applied to each name as it is listed: excluded directories are not
+        entered, and excluded files are not stat'd.
+
+        scan_backend selects how listings and stats are run (see SCAN_BACKENDS).  "async" keeps up to scan_workers
+        of them in flight.
+        """
+        if scan_backend not in SCAN_BACKENDS:
+            raise ValueError(f"Unsupported scan backend {scan_backend}.  Expected one of {SCAN_BACKENDS}")
+        segments = FileSystemHelper._compile_glob_segments(glob_pattern)
+        if len(segments) == 0:
+            return
+        if scan_backend == "async":
+            yield from _AsyncWalk(str(self.root), segments, dir_index, start_after, name_filter, workers = scan_workers)
+        else:
+            yield from self._walk_local_dir(str(self.root), "", {0}, segments, dir_index, start_after, name_filter)
+
+    @classmethod
+    def _list_dir(cls, dirpath: str, with_mtime: bool = False) -> tuple:
+        """
+        (mtime_ns or None, entries) of a local directory, with entries as (sort key, is_dir, DirEntry) in walk order.
+        """
+        # stat before listing: a change after this point shows up as a different mtime next time.
+        dir_mtime_ns = os.stat(dirpath).st_mtime_ns if with_mtime else None
+        entries = []
+        with os.scandir(dirpath) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    continue
+                # directories sort as "name/" so the walk order matches sorting on the full relative path.
+                entries.append((entry.name + "/" if is_dir else entry.name, is_dir, entry))
+        entries.sort(key = lambda x: x[0])
+        return (dir_mtime_ns, entries)
+
+    @classmethod
+    def _match_entries(cls, reldir: str, entries: list, states: set, segments: list, start_after: str = None,
+                       name_filter: NameFilter = None):
+        """
+        The entries of a listed directory that the walk continues with, in order.  Yields (relpath, entry, next_states)
+        for a directory to enter, and (relpath, entry, None) for a file to yield.
+        """
+        nsegs = len(segments)
+        # depth of the entries in this directory: 1 for the root's.
+        depth = 1 if reldir == "" else reldir.count("/") + 2
+        states = FileSystemHelper._expand_glob_states(segments, states)
+
+        for (_, is_dir, entry) in entries:
+            relpath = entry.name if reldir == "" else reldir + "/" + entry.name
+
+            if is_dir:
+                # every path under relpath sorts before start_after unless start_after is inside it.
+                if (start_after is not None) and (start_after > relpath + "/") and not start_after.startswith(relpath + "/"):
+                    continue
+                if (name_filter is not None) and not name_filter.enter_dir(entry.name, depth):
+                    continue
+                next_states = set()
+                for i in states:
+                    if i >= nsegs:
+                        continue
+                    if segments[i] == "**":
+                        if not entry.is_symlink():
+                            next_states.add(i)
+                    elif (i < nsegs - 1) and segments[i].match(entry.name):
+                        next_states.add(i + 1)
+                if len(next_states) > 0:
+                    yield (relpath, entry, next_states)
+                continue
+
+            if (start_after is not None) and (relpath <= start_after):
+                continue
+
+            # files only match the last segment
+            if not any((i == nsegs - 1) and (segments[i] != "**") and segments[i].match(entry.name) for i in states):
+                continue
+            if (name_filter is not None) and not name_filter.keep_file(entry.name, depth):
+                continue
+            yield (relpath, entry, None)
+
+    @classmethod
+    def _stat_entry(cls, entry: os.DirEntry) -> Optional[tuple]:
+        """
+        (size, mtime_us) of a regular file's directory entry, or None.
+        """
+        try:
+            info = entry.stat()
+        except OSError as e:
+            log.warning(f"cannot stat {entry.path}: {e}")
+            return None
+        if not stat.S_ISREG(info.st_mode):
+            return None
+        # same conversion as get_metadata so values compare equal to existing journal entries.
+        return (info.st_size, int(math.floor(info.st_mtime * 1e6)) if info.st_mtime else None)
+
+    def _walk_local_dir(self, dirpath: str, reldir: str, states: set, segments: list, dir_index = None, start_after: str = None,
+                        name_filter: NameFilter = None):
+        try:
+            (dir_mtime_ns, entries) = FileSystemHelper._list_dir(dirpath, with_mtime = dir_index is not None)
+        except (PermissionError, FileNotFoundError, NotADirectoryError) as e:
+            log.warning(f"cannot list directory {dirpath}: {e}")
+            return
+        trusted = dir_index.visit(reldir if reldir != "" else ".", dir_mtime_ns, len(entries)) if dir_index is not None else False
+
+        for (relpath, entry, next_states) in FileSystemHelper._match_entries(reldir, entries, states, segments, start_after, name_filter):
+            if next_states is not None:
+                yield from self._walk_local_dir(entry.path, relpath, next_states, segments, dir_index, start_after, name_filter)
+            elif trusted:
+                # unchanged directory: size and mtime are filled in from the journal.
+                if entry.is_file():
+                    yield (relpath, None, None)
+            else:
+                meta = FileSystemHelper._stat_entry(entry)
+                if meta is not None:
+                    yield (relpath,) + meta
+
+    @property
+    def walk_is_sorted(self) -> bool:
+        """
+        True if get_files_meta_iter yields relpaths in ascending string order, i.e. the root is walked locally.
+        """
+        return not (self.is_cloud or (isinstance(self.root, PureWindowsPath) and not isinstance(self.root, WindowsPath)))
+
+    def get_files_meta_iter(self, pattern: str = None, recursive:bool = True, page_size: int = 1000, dir_index = None, start_after: str = None,
+                            name_filter: NameFilter = None, scan_backend: str = "thread", scan_workers: int = 256):
+        """
+        Yields pages of (relpath, size, mtime_us) tuples for files within the specified subpath.
+
+        Local roots are walked with os.scandir, reusing the directory entry type and stat data and pruning
+        subtrees the pattern cannot match.  Files are yielded in ascending relpath order (see walk_is_sorted).
+        Cloud roots use get_files_iter, with size and mtime_us set to None.
+
+        Args:
+            pattern (str, optional): The subpath within the root directory to search for files. Defaults to None.
+            dir_index (optional): directory mtime index for local walks, see _walk_local.
+            start_after (str, optional): for local walks, skip files up to and including this relpath, see _walk_local.
+            name_filter (NameFilter, optional): include/exclude globs and maximum depth.  applied during local walks,
+                and to the listed paths for cloud roots.
+            scan_backend (str, optional): "thread" or "async", for local walks, see _walk_local.
+            scan_workers (int, optional): listings and stats in flight for the async backend.
+
+        Yields:
+            list[tuple]: (relpath, size, mtime_us) with relpath relative to the root directory, in posix format.
+        """
+        if not self.walk_is_sorted:
+            for paths in self.get_files_iter(pattern = pattern, recursive = recursive, page_size = page_size):
+                page = [(p, None, None) for p in paths if (name_filter is None) or name_filter.keep_path(p)]
+                if len(page) > 0:
+                    yield page
+            return
+
+        glob_pattern = self.convert_pattern(pattern, recursive)
+        log.info(f"walking files for {pattern} converted to {glob_pattern}")
+        page = []
+        for item in self._walk_local(glob_pattern, dir_index, start_after, name_filter, scan_backend, scan_workers):
+            page.append(item)
+            if len(page) >= page_size:
+                log.info(f"Found {len(page)} files in {pattern}")
+                yield page
+                page = []
+
+        if len(page) > 0:
+            yield page
+        log.info("completed retrieving files.")
+
 
 
     # copy 1 file from one location to another.
@@ -870,6 +1722,9 @@ class FileSystemHelper:
         Args:
             paths (Union[str, tuple]): a relative path to the root dir, or None if the root is a file.
             dest_path (Union[Self, Path, CloudPath]): The destination path, either a directory or a file path
+            md5 (optional): hashlib object updated with the file's content as it is copied from a local source.
+                not updated for a cloud source.
+            content_md5 (optional): the file's known md5 hex, set as the Content-MD5 of an uploaded azure blob.
 
         Returns:
             None
@@ -891,6 +1746,8 @@ class FileSystemHelper:
         timeout = kwargs.get("timeout", 120)
                 
         lock = kwargs.get("lock", None)
+        md5 = kwargs.get("md5", None)
+        content_md5 = kwargs.get("content_md5", None)
                 
         if relpath is None: 
             # relpath is not specified, treat both src and dest as file paths.
@@ -923,7 +1780,7 @@ class FileSystemHelper:
                     src_blob_client = src_container.get_blob_client(src_file.blob)
                     src_url = src_blob_client.url
                     parsed_url = urlparse(src_url)
-                    internal_url = urlunparse(parsed_url._replace(netloc=self.internal_host))
+                    internal_url = urlunparse(parsed_url._replace(netloc=self.internal_host)) if self.internal_host else src_url
                     log.debug(f"copying within azure from {src_url} via {internal_url} to {dest_blob_client.url}")
                     # now copy from internal url
                     dest_blob_client.start_copy_from_url(internal_url)
@@ -945,19 +1802,38 @@ class FileSystemHelper:
                 blob_serv_client = dest_file.client.service_client
                 container_client = blob_serv_client.get_container_client(dest_file.container)
                 with open(src_file, "rb") as data:
+                    if md5 is not None:
+                        # the length is given so that small files are still uploaded with a single put.
+                        (data, length) = (_HashingReader(data, md5), os.fstat(data.fileno()).st_size)
+                    else:
+                        length = None
+                    # blobs uploaded in blocks get no Content-MD5 from the service, so set the known md5 for verify.
+                    content_settings = ContentSettings(content_md5 = bytes.fromhex(content_md5)) if content_md5 else None
                     try:
                         if nthreads < 1:
-                            container_client.upload_blob(name=dest_relpath, data=data, connection_timeout=timeout, overwrite=True)
+                            container_client.upload_blob(name=dest_relpath, data=data, length=length, connection_timeout=timeout, overwrite=True,
+                                                         content_settings=content_settings)
                         else:
-                            container_client.upload_blob(name=dest_relpath, data=data, connection_timeout=timeout, overwrite=True, max_concurrency=nthreads)
+                            container_client.upload_blob(name=dest_relpath, data=data, length=length, connection_timeout=timeout, overwrite=True,
+                                                         content_settings=content_settings, max_concurrency=nthreads)
 
                     except TypeError as e:
                         log.error(f"uploading file {src_file} to {dest_relpath} with timeout {timeout} container {dest_file.container} exception {e}")
+                    except HttpResponseError as e:
+                        if e.error_code != "Md5Mismatch":
+                            raise
+                        # the file changed since its md5 was journaled.  verify reports it.
+                        log.error(f"uploading file {src_file} to {dest_relpath}: content does not match the journal md5 {content_md5}")
                         
             else:
                 log.debug(f"copying from local {src_file} to local {dest_file}")
                 try:
-                    shutil.copy2(str(src_file), str(dest_file))
+                    if md5 is not None:
+                        with open(src_file, "rb") as src, open(dest_file, "wb") as dst:
+                            shutil.copyfileobj(_HashingReader(src, md5), dst, _HASH_BUFFER_SIZES["other"])
+                        shutil.copystat(str(src_file), str(dest_file))
+                    else:
+                        shutil.copy2(str(src_file), str(dest_file))
                 except shutil.SameFileError:
                     pass
                 except PermissionError as e:
@@ -976,12 +1852,16 @@ class FileSystemHelper:
         Args:
             relpath: relative path string, or (src_rel, dest_rel) tuple.
             dest_path: FileSystemHelper for the destination.
+            md5 (optional): hashlib object updated with the file's content as it is copied.
+            content_md5 (optional): the file's known md5 hex, set as the Content-MD5 of an uploaded azure blob.
         """
         if self.is_cloud:
             raise ValueError("async_copy_file_to only supports a local source path.")
 
         nthreads = kwargs.get("nthreads", 0)
         timeout  = kwargs.get("timeout", 120)
+        md5      = kwargs.get("md5", None)
+        content_md5 = kwargs.get("content_md5", None)
 
         src_rel, dest_rel = relpath if isinstance(relpath, tuple) else (relpath, relpath)
         src_file  = self.root / src_rel
@@ -996,14 +1876,26 @@ class FileSystemHelper:
             upload_kwargs = {"overwrite": True, "connection_timeout": timeout}
             if nthreads > 0:
                 upload_kwargs["max_concurrency"] = nthreads
+            if content_md5:
+                upload_kwargs["content_settings"] = ContentSettings(content_md5 = bytes.fromhex(content_md5))
             async with aiofiles.open(src_file, "rb") as f:
-                await async_container_client.upload_blob(name=blob_name, data=f, **upload_kwargs)
+                if md5 is not None:
+                    upload_kwargs["length"] = (await aiofiles.os.stat(src_file)).st_size
+                    f = _HashingReader(f, md5)
+                try:
+                    await async_container_client.upload_blob(name=blob_name, data=f, **upload_kwargs)
+                except HttpResponseError as e:
+                    if e.error_code != "Md5Mismatch":
+                        raise
+                    log.error(f"uploading file {src_file} to {blob_name}: content does not match the journal md5 {content_md5}")
 
         elif isinstance(dest_file, Path):
             await aiofiles.os.makedirs(dest_file.parent, exist_ok=True)
             async with aiofiles.open(src_file, "rb") as src:
                 async with aiofiles.open(dest_file, "wb") as dst:
                     while chunk := await src.read(1024 * 1024):
+                        if md5 is not None:
+                            md5.update(chunk)
                         await dst.write(chunk)
 
         else:
@@ -1,5 +1,6 @@
 import os
 import time
+import hashlib
 from chorus_upload.storage_helper import FileSystemHelper
 
 from typing import Optional
@@ -15,8 +16,11 @@ from chorus_upload.local_ops import list_files_with_info, convert_local_to_centr
 import chorus_upload.config_helper as config_helper
 import chorus_upload.storage_helper as storage_helper
 import chorus_upload.perf_counter as perf_counter
+from chorus_upload.concurrency import AIMDController, run_adaptive
 
-from chorus_upload.journaldb_ops import JournalDispatcher
+from chorus_upload.journaldb_ops import JournalDispatcher, PENDING_MD5
+from chorus_upload.journaldb_ops import SQLiteDB
+from chorus_upload.journaldb_ops import TuningProfiles
 
 from azure.core.exceptions import ServiceResponseError
 
@@ -136,6 +140,9 @@ def checkout_journal(journal_path, lock_path, local_path, transport_method: str=
     
     # enforced restriction:  lock_path is cloud or None.  local_path is local.
     
+    # the local file may be replaced.
+    SQLiteDB.close(str(local_path.root))
+
     if (not journal_path.is_cloud):
         log.debug(f"journal is a local file: {str(journal_path.root)}. no locking needed.")
         # local, ignore lock, and just copy if needed.
@@ -208,6 +215,9 @@ def checkin_journal(journal_path, lock_path, local_path, transport_method: str="
     # check journal file in.
     # lock_path is cloud or None.  local_path is local.
     
+    # checkpoint the WAL into the local file before it is copied.
+    SQLiteDB.close(str(local_path.root))
+
     if not journal_path.is_cloud:
         log.debug(f"journal is a local file: {str(journal_path.root)}. no unlocking needed.")
         # not cloud, if local path is not the same as journal path, copy back
@@ -280,6 +290,11 @@ class sync_state(Enum):
     MISSING_IN_DB = 6
     MULTIPLE_ACTIVES_IN_DB = 7
 
+def _computed_md5(info: dict) -> Optional[str]:
+    """the md5 computed during the upload of a file scanned with --defer-hash, to write back to the journal.  None otherwise."""
+    return info['md5'] if info.get('md5_computed', False) else None
+
+
 def _upload_and_verify(src_path : FileSystemHelper, 
                        fn : str, info: dict,
                        dated_dest_path : FileSystemHelper,
@@ -295,14 +310,17 @@ def _upload_and_verify(src_path : FileSystemHelper,
     destfn = info['central_path']
     
     lock = kwargs.get("lock", None)
+    # a file scanned with --defer-hash has no md5 yet.  it is computed from the data read for the upload.
+    hasher = hashlib.md5() if (info['md5'] is None) and not src_path.is_cloud else None
         
     if srcfile.exists():
         try:
-            src_path.copy_file_to(relpath=(fn, destfn), dest_path=dated_dest_path, **{'nthreads': threads_per_file, 'lock': lock})
+            src_path.copy_file_to(relpath=(fn, destfn), dest_path=dated_dest_path, **{'nthreads': threads_per_file, 'lock': lock, 'md5': hasher, 'content_md5': info['md5']})
         except ServiceResponseError as e:
             try:
                 log.warning(f"copy failed {fn}, retrying")
-                src_path.copy_file_to(relpath=(fn, destfn), dest_path=dated_dest_path, **{'nthreads': threads_per_file, 'lock': lock})
+                hasher = hashlib.md5() if hasher is not None else None
+                src_path.copy_file_to(relpath=(fn, destfn), dest_path=dated_dest_path, **{'nthreads': threads_per_file, 'lock': lock, 'md5': hasher, 'content_md5': info['md5']})
             except ServiceResponseError as e:                
                 log.error(f"copy failed {fn}, due to {str(e)}. Please rerun 'file upload' when connectivity improves.")
                 state = sync_state.MISSING_DEST
@@ -318,6 +336,9 @@ def _upload_and_verify(src_path : FileSystemHelper,
     file_id = info['file_id']
     size = info['size']
     md5 = info['md5']
+    if (hasher is not None) and (state == sync_state.UNKNOWN):
+        md5 = info['md5'] = hasher.hexdigest()
+        info['md5_computed'] = True
 
     if (state == sync_state.UNKNOWN):
 
@@ -376,7 +397,7 @@ def _thread_upload(src_path : FileSystemHelper, dest_path : FileSystemHelper,
                     #  del_args,
                      step,
                     #  missing_dest, missing_src, matched, mismatched, replaced,  # debug only
-                     perf, nuploads, threads_per_file, verbose = False, *, group_perf=None):
+                     perf, nuploads, threads_per_file, verbose = False, *, group_perf=None, controller=None):
     dated_dest_paths = set()
 
     # Each worker thread gets its own cloned Azure client via thread-local storage.
@@ -393,57 +414,54 @@ def _thread_upload(src_path : FileSystemHelper, dest_path : FileSystemHelper,
         return _upload_and_verify(src_path, fn, info, dated_dest_path,
                                   nthreads=threads_per_file, lock=lock)
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=nuploads) as executor:
-        lock = threading.Lock()
-
-        futures = []
-        for fn, info in files_to_upload.items():
-            future = executor.submit(upload_task, fn, info)
-            futures.append(future)
-    
-        for future in concurrent.futures.as_completed(futures):
-            (fn2, info, state, dated_dest_path,
-            #  del_list, 
-             copy_time, verify_time) = future.result()
+    lock = threading.Lock()
+    # nuploads is the starting point.  the controller adjusts the number of concurrent uploads from the throughput.
+    if controller is None:
+        controller = AIMDController(initial=nuploads, max_threads=2 * nuploads)
+    for (_, future) in run_adaptive(lambda item: upload_task(*item), files_to_upload.items(), controller,
+                                     size_of=lambda item: item[1]['size'], window=2 * nuploads):
+        (fn2, info, state, dated_dest_path,
+        #  del_list, 
+         copy_time, verify_time) = future.result()
             
-            dated_dest_paths.add(dated_dest_path)
-            perf.add_file(info['size'])
-            if group_perf is not None:
-                group_perf.add_file(info['size'])
-
-            if state == sync_state.MISSING_DEST:
-                # missing_dest.append(fn2)
-                log.error(f"missing file at destination {fn2}")
-            elif state == sync_state.MISSING_SRC:
-                # missing_src.append(fn2)
-                log.error(f"file not found {fn2}")
-            elif state == sync_state.MATCHED:
-                # merge the updates for matched.
-                # matched.append(fn2)
-                update_args.append((upload_dt_str, copy_time, verify_time, info['file_id']))
-                # if len(del_list) > 0:
-                    # del_args += [(upload_dt_str, fid) for fid in del_list]
-                    # replaced.append(fn2)
-                if verbose:
-                    log.debug(f"copied {fn2} from {str(src_path.root)} to {str(dated_dest_path.root)}")
-                else:
-                    print(".", end="", flush=True)
-            elif state == sync_state.MISMATCHED:
-                # mismatched.append(fn2)
-                log.error(f"mismatched upload file {fn2} upload failed? fileid {info['file_id']}")            
+        dated_dest_paths.add(dated_dest_path)
+        perf.add_file(info['size'])
+        if group_perf is not None:
+            group_perf.add_file(info['size'])
+
+        if state == sync_state.MISSING_DEST:
+            # missing_dest.append(fn2)
+            log.error(f"missing file at destination {fn2}")
+        elif state == sync_state.MISSING_SRC:
+            # missing_src.append(fn2)
+            log.error(f"file not found {fn2}")
+        elif state == sync_state.MATCHED:
+            # merge the updates for matched.
+            # matched.append(fn2)
+            update_args.append((upload_dt_str, copy_time, verify_time, info['file_id'], _computed_md5(info)))
+            # if len(del_list) > 0:
+                # del_args += [(upload_dt_str, fid) for fid in del_list]
+                # replaced.append(fn2)
+            if verbose:
+                log.debug(f"copied {fn2} from {str(src_path.root)} to {str(dated_dest_path.root)}")
+            else:
+                print(".", end="", flush=True)
+        elif state == sync_state.MISMATCHED:
+            # mismatched.append(fn2)
+            log.error(f"mismatched upload file {fn2} upload failed? fileid {info['file_id']}")            
             
-            # update the journal - likely not parallelizable.
-            if len(update_args) >= step:
-                if verbose:
-                    log.debug(f"UPLOAD updating journal {len(update_args)}")
-                # handle additions and updates
-                JournalDispatcher.mark_as_uploaded_with_duration(databasename, update_args)
-                update_args = []
+        # update the journal - likely not parallelizable.
+        if len(update_args) >= step:
+            if verbose:
+                log.debug(f"UPLOAD updating journal {len(update_args)}")
+            # handle additions and updates
+            JournalDispatcher.mark_as_uploaded_with_duration(databasename, update_args)
+            update_args = []
             
-                # backup intermediate file into the dated dest path.
-                # journal_path.copy_file_to(relpath=journal_fn, dest_path=dated_dest_path)
+            # backup intermediate file into the dated dest path.
+            # journal_path.copy_file_to(relpath=journal_fn, dest_path=dated_dest_path)
                 
-                perf.report()
+            perf.report()
                 
     return (update_args, 
             # del_args, 
@@ -461,6 +479,8 @@ async def _async_upload_and_verify(src_path : FileSystemHelper,
     destfn = info['central_path']
     size = info['size']
     md5 = info['md5']
+    # a file scanned with --defer-hash has no md5 yet.  it is computed from the data read for the upload.
+    hasher = hashlib.md5() if md5 is None else None
 
     # ======= copy
     start = time.time()
@@ -469,12 +489,13 @@ async def _async_upload_and_verify(src_path : FileSystemHelper,
     if await aiofiles.os.path.exists(srcfile):
         try:
             await src_path.async_copy_file_to(relpath=(fn, destfn), dest_path=dated_dest_path,
-                                               nthreads=nthreads)
+                                               nthreads=nthreads, md5=hasher, content_md5=info['md5'])
         except ServiceResponseError as e:
             try:
                 log.warning(f"async copy failed {fn}, due to {str(e)}.  retrying")
+                hasher = hashlib.md5() if hasher is not None else None
                 await src_path.async_copy_file_to(relpath=(fn, destfn), dest_path=dated_dest_path,
-                                                   nthreads=nthreads)
+                                                   nthreads=nthreads, md5=hasher, content_md5=info['md5'])
             except ServiceResponseError as e:
                 log.error(f"async copy failed {fn}, due to {str(e)}. Please rerun 'file upload' when connectivity improves.")
                 state = sync_state.MISSING_DEST
@@ -482,6 +503,9 @@ async def _async_upload_and_verify(src_path : FileSystemHelper,
         state = sync_state.MISSING_SRC
     copy_time = time.time() - start
     verify_time = None
+    if (hasher is not None) and (state == sync_state.UNKNOWN):
+        md5 = info['md5'] = hasher.hexdigest()
+        info['md5_computed'] = True
 
     # ======= verify
     if state == sync_state.UNKNOWN:
@@ -556,7 +580,7 @@ def _async_upload(src_path : FileSystemHelper, dest_path : FileSystemHelper,
                 elif state == sync_state.MISSING_SRC:
                     log.error(f"file not found {fn2}")
                 elif state == sync_state.MATCHED:
-                    update_args.append((upload_dt_str, copy_time, verify_time, info['file_id']))
+                    update_args.append((upload_dt_str, copy_time, verify_time, info['file_id'], _computed_md5(info)))
                     if verbose:
                         log.info(f"copied {fn2} from {str(src_path.root)} to {str(dated_dest_path.root)}")
                     else:
@@ -582,6 +606,88 @@ def _async_upload(src_path : FileSystemHelper, dest_path : FileSystemHelper,
     )
 
 
+def _copy_moved_file(dest_root, client, int_host, fn : str, info: dict, lock = None):
+    state = sync_state.UNKNOWN
+
+    # ======= server side copy from the central path of the file this was moved from.
+    start = time.time()
+    moved_from = info['moved_from']
+    src_dated_path = FileSystemHelper(dest_root.joinpath(moved_from['version']), client=client, internal_host=int_host)
+    dated_dest_path = FileSystemHelper(dest_root.joinpath(info['version']), client=client, internal_host=int_host)
+    destfn = info['central_path']
+    if src_dated_path.root.joinpath(moved_from['central_path']).exists():
+        try:
+            src_dated_path.copy_file_to(relpath=(moved_from['central_path'], destfn), dest_path=dated_dest_path, lock=lock)
+        except Exception as e:
+            log.warning(f"server side copy failed {fn} from {moved_from['central_path']}: {str(e)}")
+            state = sync_state.MISSING_DEST
+    else:
+        state = sync_state.MISSING_SRC
+    copy_time = time.time() - start
+    verify_time = None
+
+    # ======= verify, as for upload
+    if (state == sync_state.UNKNOWN):
+        start = time.time()
+        dest_meta = FileSystemHelper.get_metadata(root = dated_dest_path.root, path = destfn, with_metadata = True, with_md5 = True, local_md5 = info['md5'], lock=lock)
+        verify_time = time.time() - start
+        if (dest_meta is None) or (dest_meta['size'] is None):
+            state = sync_state.MISSING_DEST
+        elif (info['size'] == dest_meta['size']) and (info['md5'] == dest_meta['md5']):
+            state = sync_state.MATCHED
+        else:
+            state = sync_state.MISMATCHED
+
+    return (fn, info, state, dated_dest_path, copy_time, verify_time)
+
+
+def _copy_moved_files(dest_path : FileSystemHelper, files_to_copy: dict,
+                      databasename, upload_dt_str, update_args, step,
+                      perf, nthreads: int, verbose = False):
+    """Copy moved files from their previous central path to the new one, server side.
+
+    A file renamed or relocated at the site is linked to the uploaded file it came from
+    by journal update (MOVED_FROM_ID), so only a copy within the destination is needed.
+    Files that cannot be copied and verified are returned for a regular upload.
+    """
+    dated_dest_paths = set()
+    not_copied = {}
+
+    thread_local = threading.local()
+    orig_client = dest_path.client
+    dest_root = dest_path.root
+    int_host = dest_path.internal_host
+    lock = threading.Lock()
+
+    def copy_task(fn, info):
+        if not hasattr(thread_local, 'client'):
+            thread_local.client = storage_helper._clone_client(orig_client) if orig_client is not None else None
+        return _copy_moved_file(dest_root, thread_local.client, int_host, fn, info, lock=lock)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nthreads) as executor:
+        futures = [executor.submit(copy_task, fn, info) for fn, info in files_to_copy.items()]
+
+        for future in concurrent.futures.as_completed(futures):
+            (fn2, info, state, dated_dest_path, copy_time, verify_time) = future.result()
+
+            if state == sync_state.MATCHED:
+                dated_dest_paths.add(dated_dest_path)
+                perf.add_file(info['size'])
+                update_args.append((upload_dt_str, copy_time, verify_time, info['file_id'], None))
+                if verbose:
+                    log.debug(f"copied moved file {fn2} from {info['moved_from']['central_path']} in {info['moved_from']['version']}")
+            else:
+                log.warning(f"could not copy moved file {fn2} at destination ({state.name}).  uploading instead.")
+                not_copied[fn2] = info
+
+            if len(update_args) >= step:
+                JournalDispatcher.mark_as_uploaded_with_duration(databasename, update_args)
+                update_args = []
+                perf.report()
+
+    return (update_args, perf, dated_dest_paths, not_copied)
+
+
 def _parallel_upload(src_path : FileSystemHelper, dest_path : FileSystemHelper,
                      files_to_upload,
                     #  files_to_mark_deleted,
@@ -589,7 +695,7 @@ def _parallel_upload(src_path : FileSystemHelper, dest_path : FileSystemHelper,
                     #  del_args,
                      step,
                     #  missing_dest, missing_src, matched, mismatched, replaced,  # debug only
-                     perf, nthreads:int, verbose = False):
+                     perf, nthreads:int, verbose = False, *, modalities: list = None):
     """Dispatch file uploads to _async_upload or _thread_upload based on destination cloud type
     and file size group.
 
@@ -600,6 +706,9 @@ def _parallel_upload(src_path : FileSystemHelper, dest_path : FileSystemHelper,
     to a thread pool instead because per-file block-level parallelism is more important than
     task-level concurrency at that size.  For non-Azure destinations (S3, local) the async
     path is unavailable; all groups fall back to _thread_upload automatically.
+
+    Thread groups start from the number of concurrent uploads saved by the last run on this host
+    (see TuningProfiles), and save the number they settle on.
     """
     # Upload size groups and concurrency settings.
     #
@@ -698,6 +807,12 @@ def _parallel_upload(src_path : FileSystemHelper, dest_path : FileSystemHelper,
         elif concur_type == 'thread' or (concur_type == 'async' and not use_async):
             nuploads = min(concurrency, nthreads)
             threads_per_file = max(1, nthreads // nuploads)
+            # threads_per_file stays as configured, so the saved count applies to the same per-file block parallelism.
+            profile_key = (str(dest_path.root), ",".join(sorted(modalities or [])), f"upload_{group_name}")
+            saved = TuningProfiles.load(databasename, *profile_key)
+            controller = AIMDController(initial=saved[0] if saved is not None else nuploads, max_threads=2 * nuploads)
+            if saved is not None:
+                log.info(f"UPLOAD {group_name} group starting at {controller.nthreads} concurrent uploads from the saved tuning profile")
             if concur_type == 'async':
                 log.info(f"UPLOAD {len(group_files)} files in {group_name} group, thread (async unavailable), "
                          f"{nuploads} threads × {threads_per_file} conn/file")
@@ -717,8 +832,11 @@ def _parallel_upload(src_path : FileSystemHelper, dest_path : FileSystemHelper,
                                 step,
                                 # missing_dest, missing_src, matched, mismatched, replaced,
                                 perf, nuploads, connections_per_file, verbose,
-                                group_perf=group_perf)
+                                group_perf=group_perf, controller=controller)
             dated_paths.update(_dated_paths)
+            profile = controller.profile()
+            if profile is not None:
+                TuningProfiles.save(databasename, *profile_key, *profile)
         else:
             raise ValueError(f"Unknown concurrency type {concur_type} for group {group_name}")
 
@@ -826,6 +944,17 @@ def upload_files(src_path : FileSystemHelper, dest_path : FileSystemHelper,
     n_cores = kwargs.get("n_cores", 32)
     nthreads = min(n_cores, min(32, (os.cpu_count() or 1) + 4))
 
+    # moved files are copied from their previous upload, within the destination.
+    files_to_copy = {fn: info for fn, info in files_to_upload.items() if info.get('moved_from', None) is not None}
+    if len(files_to_copy) > 0:
+        log.info(f"UPLOAD copying {len(files_to_copy)} moved files at destination")
+        (update_args, perf, copied_paths, not_copied) = \
+            _copy_moved_files(dest_path, files_to_copy, databasename, upload_dt_str, update_args, step,
+                              perf, nthreads, verbose)
+        for dp in copied_paths:
+            dated_dest_paths[str(dp.root)] = dp
+        files_to_upload = {fn: info for fn, info in files_to_upload.items() if (fn not in files_to_copy) or (fn in not_copied)}
+
     log.info(f"UPLOAD {len(files_to_upload)} files")
     if len(files_to_upload) > 0:
         (update_args, 
@@ -840,7 +969,7 @@ def upload_files(src_path : FileSystemHelper, dest_path : FileSystemHelper,
                             # del_args, 
                             step,
                             # missing_dest, missing_src, matched, mismatched, replaced,
-                            perf, nthreads, verbose)
+                            perf, nthreads, verbose, modalities=modalities)
         for dp in dated_paths:
             dated_dest_paths[str(dp.root)] = dp
     
@@ -885,6 +1014,8 @@ def upload_files(src_path : FileSystemHelper, dest_path : FileSystemHelper,
     # do not do backup the table - this will create really big files.
     # backup_journal(databasename, suffix=upload_dt_str)
     # just copy the journal file to the dated dest path as a backup, and locally sa well
+    # checkpoint the WAL into the journal file first, else the copy misses the recent commits.
+    SQLiteDB.close(databasename)
     for dated_dest_path in dated_dest_paths.values():
         if verbose:
             log.info(f"UPLOAD: backing up journal to {str(dated_dest_path.root)}")
@@ -1016,44 +1147,54 @@ def _async_verify(dated_dest_path: FileSystemHelper,
     return matched, mismatched, missing, needs_download
 
 
+def _multipart_etag_matches(dest_md5: str, digests: tuple) -> bool:
+    """True if dest_md5 is an S3 multipart ETag ("<md5>-<parts>") that matches the journal's block MD5s (see FileDigests)."""
+    if (digests is None) or (digests[1] is None) or ("-" not in dest_md5):
+        return False
+    block_md5 = digests[1]
+    if dest_md5.rsplit("-", 1)[1] != str(len(block_md5) // 16):
+        # uploaded with a different part size than digest_block_mb.
+        return False
+    return storage_helper.multipart_etag(block_md5) == dest_md5
+
+
 def _thread_verify(dated_dest_path: FileSystemHelper,
                    files_to_verify,
                    nthreads: int,
                    **kwargs) -> tuple:
-    """Thread-pool verification. Used for huge files that require blob download+hash."""
+    """Thread-pool verification. Used for huge files that require blob download+hash.
+    with digests ({file_id: digests} from JournalDispatcher.get_digests), S3 multipart ETags are checked against the block MD5s."""
     verbose = kwargs.get("verbose", False)
+    digests = kwargs.pop("digests", None) or {}
     matched = []
     mismatched = []
     missing = []
 
     dtstr = dated_dest_path.root.name
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=nthreads) as executor:
-        lock = threading.Lock()
-        futures = {
-            executor.submit(_get_file_info, dated_dest_path,
-                            (fid, fn, size, md5, modality),
-                            **{**kwargs, "lock": lock}): fn
-            for fid, fn, size, md5, modality in files_to_verify
-        }
-        for future in concurrent.futures.as_completed(futures):
-            dest_meta, dest_md5, fid, fn, size, md5 = future.result()
-
-            if dest_meta is None or dest_meta['size'] is None:
-                missing.append(fn)
-                log.error(f"missing file {fn}")
-            elif size != dest_meta['size']:
-                log.error(f"mismatched file {fid} {fn}: remote size {dest_meta['size']} journal size {size}")
-                mismatched.append(fn)
-            elif md5 is not None and dest_md5 is not None and md5 != dest_md5:
-                log.error(f"mismatched file {fid} {fn} for upload {dtstr}: remote md5 {dest_md5} journal md5 {md5}")
-                mismatched.append(fn)
+    lock = threading.Lock()
+    # nthreads is the starting point.  the controller adjusts the number of concurrent verifications from the throughput.
+    controller = AIMDController(initial=nthreads, max_threads=2 * nthreads)
+    verify_task = lambda file_info: _get_file_info(dated_dest_path, file_info, **{**kwargs, "lock": lock})
+    for (_, future) in run_adaptive(verify_task, files_to_verify, controller,
+                                    size_of=lambda file_info: file_info[2] or 0, window=2 * nthreads):
+        dest_meta, dest_md5, fid, fn, size, md5 = future.result()
+
+        if dest_meta is None or dest_meta['size'] is None:
+            missing.append(fn)
+            log.error(f"missing file {fn}")
+        elif size != dest_meta['size']:
+            log.error(f"mismatched file {fid} {fn}: remote size {dest_meta['size']} journal size {size}")
+            mismatched.append(fn)
+        elif md5 is not None and dest_md5 is not None and md5 != dest_md5 and not _multipart_etag_matches(dest_md5, digests.get(fid, None)):
+            log.error(f"mismatched file {fid} {fn} for upload {dtstr}: remote md5 {dest_md5} journal md5 {md5}")
+            mismatched.append(fn)
+        else:
+            if verbose:
+                log.debug(f"verified {fn} {fid}")
             else:
-                if verbose:
-                    log.debug(f"verified {fn} {fid}")
-                else:
-                    print(".", end="", flush=True)
-                matched.append(fn)
+                print(".", end="", flush=True)
+            matched.append(fn)
 
     return matched, mismatched, missing, []  # no needs_download from thread path
 
@@ -1191,6 +1332,8 @@ def verify_files(dest_path: FileSystemHelper, databasename: str = "journal.db",
     if not os.path.exists(databasename):
         log.error(f"No journal exists for filename {databasename}")
         return
+    # get_digests reads the block md5 columns.
+    JournalDispatcher.upgrade_in_place(databasename)
 
     dtstr = version if version is not None else JournalDispatcher.get_latest_version(databasename)
 
@@ -1210,7 +1353,8 @@ def verify_files(dest_path: FileSystemHelper, databasename: str = "journal.db",
     n_cores = kwargs.get("n_cores", 32)
     nthreads = min(n_cores, min(32, (os.cpu_count() or 1) + 4))
 
-    file_infos = [(fid, filepath, size, md5, modality)
+    # md5s still pending from --defer-hash are unknown, as for a missing md5.
+    file_infos = [(fid, filepath, size, md5 if md5 != PENDING_MD5 else None, modality)
                   for (fid, filepath, _, size, md5, modality, _, version, _) in files_to_verify]
 
     if isinstance(dest_path.client, AzureBlobClient):
@@ -1235,9 +1379,11 @@ def verify_files(dest_path: FileSystemHelper, databasename: str = "journal.db",
         # Non-Azure: single-phase thread verify.  The sync get_metadata path
         # always returns an md5 (S3 etag or locally computed hash), so there
         # is no deferred phase 2.
+        # S3 etags of multipart uploads are not md5s.  they are checked against the block md5s, if the journal has them.
+        digests = JournalDispatcher.get_digests(databasename, [info[0] for info in file_infos])
         log.info(f"VERIFY: {len(file_infos)} files using {nthreads} threads")
         matched, mismatched, missing, _ = _thread_verify(
-            dated_dest_path, file_infos, nthreads, **kwargs)
+            dated_dest_path, file_infos, nthreads, **{**kwargs, "digests": digests})
 
     matched = set(matched)
     mismatched = set(mismatched)
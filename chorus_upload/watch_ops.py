@@ -0,0 +1,360 @@
+import os
+import sys
+import math
+import time
+import errno
+import stat
+import select
+import struct
+import ctypes
+import ctypes.util
+import threading
+import concurrent.futures
+from pathlib import Path
+
+from chorus_upload.storage_helper import FileSystemHelper, FileDigests, NameFilter
+from chorus_upload.journaldb_ops import JournalDispatcher
+from chorus_upload.journaldb_ops import ScanSession
+from chorus_upload.hash_cache import HashCache
+from chorus_upload.local_ops import update_journal, _get_modality_pattern, _update_journal_one_file, Prehash, PathPattern
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Watch mode: keep the journal current from file system events instead of re-walking the tree.
+#
+# 1. a full journal update, as the baseline.
+# 2. inotify watches on every directory under each modality root.  changed paths collect into a change set.
+# 3. every `interval` seconds, the changed paths are stat'd, classified against their active journal entries
+#    (same rules as a full update), and applied with insert_journal_entries / inactivate_journal_entries.
+# 4. every `rescan_interval` seconds, and whenever events may have been lost, a full journal update.
+#
+# event                              change set
+# ---------------------------------  -------------------------------------------------------------------
+# file closed after write, touched   path
+# file moved in/out, deleted         path (deletions only applied in full/snapshot journaling mode)
+# directory created or moved in      watch added, all files under it
+# directory moved out                full rescan - files under the old path are not reported one by one
+# event queue overflow               full rescan
+#
+# inotify only: fanotify needs CAP_SYS_ADMIN, which the upload host should not need.
+
+# from <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+_EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+class Inotify:
+    """
+    Minimal inotify binding (ctypes, Linux only), with recursive watches.
+    """
+
+    def __init__(self):
+        if not sys.platform.startswith("linux"):
+            raise ValueError("journal watch requires Linux inotify")
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"inotify_init1: {os.strerror(err)}")
+        self.dirs = {}  # wd to directory path
+
+    def add_watch(self, dirpath: str) -> bool:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(dirpath), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                raise OSError(err, "inotify watch limit reached.  raise fs.inotify.max_user_watches")
+            # directory removed before it could be watched
+            log.debug(f"cannot watch {dirpath}: {os.strerror(err)}")
+            return False
+        self.dirs[wd] = dirpath
+        return True
+
+    def add_tree(self, dirpath: str) -> list:
+        """
+        watch dirpath and all directories under it.  returns the files found under it.
+        """
+        files = []
+        for (curdir, subdirs, filenames) in os.walk(dirpath):
+            if not self.add_watch(curdir):
+                subdirs.clear()
+                continue
+            files.extend(os.path.join(curdir, fn) for fn in filenames)
+        return files
+
+    def read_events(self, timeout: float) -> list:
+        """
+        wait up to timeout seconds.  returns list of (mask, path).  path is None for IN_Q_OVERFLOW.
+        """
+        (ready, _, _) = select.select([self.fd], [], [], max(0, timeout))
+        if len(ready) == 0:
+            return []
+        try:
+            buf = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(buf):
+            (wd, mask, cookie, namelen) = _EVENT_HEADER.unpack_from(buf, offset)
+            offset += _EVENT_HEADER.size
+            name = os.fsdecode(buf[offset:offset + namelen].rstrip(b"\0"))
+            offset += namelen
+
+            if mask & IN_Q_OVERFLOW:
+                events.append((mask, None))
+                continue
+            dirpath = self.dirs.get(wd, None)
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            if dirpath is None:
+                continue
+            events.append((mask, os.path.join(dirpath, name) if name else dirpath))
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def _apply_changes(root: FileSystemHelper, modalities: list, relpaths: set,
+                   databasename: str, journaling_mode: str, version: str,
+                   hash_cache: HashCache = None, prehash: Prehash = None, digests: tuple = None, nthreads: int = 1,
+                   verbose: bool = False, modality_configs: dict = {}):
+    """
+    classify changed paths against their active journal entries and update the journal.  returns (inserted, inactivated).
+    """
+    delete_missing = (journaling_mode == "full") or (journaling_mode == "snapshot")
+    curtimestamp = int(math.floor(time.time() * 1e6))
+    total_inserted = 0
+    total_inactivated = 0
+
+    for modality in modalities:
+        pattern = _get_modality_pattern(modality, modality_configs)
+        version_in_pattern = ("{version:w}" in pattern) or ("{version}" in pattern)
+        compiled_pattern = PathPattern(pattern)
+        # same include/exclude globs and max_depth as the walk.  the watches themselves cover the whole root.
+        name_filter = NameFilter.from_config(modality_configs.get(modality, {}))
+        paths = sorted(p for p in relpaths if (compiled_pattern.named(p) is not None) and
+                       ((name_filter is None) or name_filter.keep_path(p)))
+        if len(paths) == 0:
+            continue
+
+        with ScanSession(databasename) as session:
+            session.add(paths)
+            known = {}
+            for (fpath, fid, size, mtime, md5, upload, ver, prehash_value) in JournalDispatcher.get_scanned_active_files(session, modality):
+                known.setdefault(fpath, []).append((fid, size, mtime, md5, upload, ver, prehash_value))
+
+        lock = threading.Lock()
+        def _scan_one(relpath):
+            try:
+                st = os.stat(os.path.join(str(root.root), relpath))
+            except OSError:
+                return None
+            if not stat.S_ISREG(st.st_mode):
+                return None
+            return _update_journal_one_file(root, relpath, modality, curtimestamp, known, compiled_pattern,
+                                            None if version_in_pattern else version,
+                                            filesize = st.st_size, modtimestamp = int(math.floor(st.st_mtime * 1e6)),
+                                            hash_cache = hash_cache, prehash = prehash, digests = digests, **{'lock': lock})
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=nthreads) as executor:
+            results = list(executor.map(_scan_one, paths))
+
+        insert_args = []
+        del_args = []
+        for (relpath, myargs) in zip(paths, results):
+            rows = known.get(relpath, None)
+            if myargs is None:
+                # gone from disk
+                if delete_missing and (rows is not None):
+                    del_args.extend(("DELETED", v[0]) for v in rows)
+                    if verbose:
+                        log.debug(f"DELETED  {relpath}")
+                continue
+
+            status = myargs[8]
+            if verbose:
+                log.debug(f"{status} {relpath}")
+            if status == "KEEP":
+                continue
+            elif status == "ADDED":
+                insert_args.append(myargs)
+                continue
+            elif status in ["MOVED", "UPDATED"]:
+                insert_args.append(myargs)
+            else:
+                log.error(f"{status} for {relpath}.  see journal update for details")
+
+            if rows is not None:
+                del_args.extend(("OUTDATED", v[0]) for v in rows)
+
+        if len(del_args) > 0:
+            total_inactivated += JournalDispatcher.inactivate_journal_entries(databasename, curtimestamp, del_args)
+        if len(insert_args) > 0:
+            JournalDispatcher.insert_journal_entries(databasename, insert_args)
+            total_inserted += len(insert_args)
+        if delete_missing:
+            moved = JournalDispatcher.mark_moved_files(databasename, modality, curtimestamp)
+            if moved > 0:
+                log.info(f"found {moved} moved files for modality {modality}")
+
+    return (total_inserted, total_inactivated)
+
+
+def watch_journal(roots: dict, databasename: str,
+                  journaling_mode: str = "append",
+                  version: str = None,
+                  amend: bool = False,
+                  interval: float = 10.0,
+                  rescan_interval: float = 86400.0,
+                  **kwargs):
+    """
+    Keep the journal up to date from inotify events until interrupted (Ctrl-C).
+
+    Args:
+        roots (dict): modality to FileSystemHelper.  roots must be local directories.
+        databasename (str): The name of the journal database.
+        journaling_mode (str): "append", "full" or "snapshot", as for journal update.
+        version (str): The journal version for all changes.
+        amend (bool): Whether the baseline update amends an existing version.
+        interval (float): seconds between applying collected changes.
+        rescan_interval (float): seconds between full journal updates.  0 disables the periodic rescan.
+    """
+    if version is None:
+        raise ValueError("version should have been set by in the _watch_journal function in __main__.py")
+    for (mod, root) in roots.items():
+        if root.is_cloud:
+            raise ValueError(f"journal watch requires a local directory.  {mod} is at {str(root.root)}")
+
+    verbose = kwargs.get("verbose", False)
+    modality_configs = kwargs.get("modality_configs", {})
+    n_cores = kwargs.get("n_cores", 32)
+    nthreads = min(n_cores, min(32, (os.cpu_count() or 1) + 4))
+    hash_cache_config = kwargs.pop("hash_cache", None)
+    # prehash_mb and the digests settings stay in kwargs for the full updates.
+    prehash = Prehash.from_config(kwargs.get("prehash_mb", None))
+    digests = FileDigests.parse_config(kwargs.get("digests", None), kwargs.get("digest_block_mb", None) or 8)
+
+    # modalities that share a root share its watches.
+    root_dirs = {}
+    for (mod, root) in roots.items():
+        root_dirs.setdefault(os.path.abspath(str(root.root)), (root, []))[1].append(mod)
+
+    def _rescan(amend_version):
+        for (mod, root) in roots.items():
+            log.info(f"WATCH full update of {mod} in {str(root.root)}")
+            update_journal(root, [mod], databasename, journaling_mode = journaling_mode,
+                           version = version, amend = amend_version,
+                           hash_cache = hash_cache_config, **kwargs)
+            amend_version = True
+
+    # watches first, so nothing changed during the baseline update is missed.
+    inotify = Inotify()
+    try:
+        for rootdir in root_dirs.keys():
+            inotify.add_tree(rootdir)
+        log.info(f"WATCH watching {len(inotify.dirs)} directories under {len(root_dirs)} roots")
+        # events from the baseline update are re-checked against the updated journal, and come out as KEEP.
+        _rescan(amend)
+
+        changes = {rootdir: set() for rootdir in root_dirs.keys()}
+        rescan_needed = False
+        first_change = None
+        last_rescan = time.time()
+
+        def _add_change(fullpath):
+            for rootdir in root_dirs.keys():
+                if fullpath.startswith(rootdir + os.sep):
+                    changes[rootdir].add(Path(os.path.relpath(fullpath, rootdir)).as_posix())
+
+        hash_cache = HashCache.from_config(hash_cache_config)
+        try:
+            while True:
+                now = time.time()
+                timeout = interval if first_change is None else max(0, first_change + interval - now)
+                if rescan_interval > 0:
+                    timeout = min(timeout, max(0, last_rescan + rescan_interval - now))
+                events = inotify.read_events(timeout)
+
+                for (mask, fullpath) in events:
+                    if fullpath is None:
+                        log.warning("WATCH event queue overflowed.  full update scheduled")
+                        rescan_needed = True
+                    elif mask & IN_ISDIR:
+                        if mask & (IN_CREATE | IN_MOVED_TO):
+                            for fn in inotify.add_tree(fullpath):
+                                _add_change(fn)
+                        elif mask & IN_MOVED_FROM:
+                            rescan_needed = True
+                    elif mask & (IN_CLOSE_WRITE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE):
+                        _add_change(fullpath)
+                    elif mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                        if os.path.abspath(fullpath) in root_dirs.keys():
+                            log.error(f"WATCH root {fullpath} was removed or moved.  stopping")
+                            return
+
+                    if (first_change is None) and any(len(c) > 0 for c in changes.values()):
+                        first_change = time.time()
+
+                now = time.time()
+                if rescan_needed or ((rescan_interval > 0) and (now - last_rescan >= rescan_interval)):
+                    # a full update covers the pending changes as well.
+                    for c in changes.values():
+                        c.clear()
+                    if hash_cache is not None:
+                        hash_cache.close()
+                    _rescan(True)
+                    hash_cache = HashCache.from_config(hash_cache_config)
+                    rescan_needed = False
+                    first_change = None
+                    last_rescan = time.time()
+                elif (first_change is not None) and (now - first_change >= interval):
+                    _apply_pending(root_dirs, changes, databasename, journaling_mode, version,
+                                   hash_cache, prehash, digests, nthreads, verbose, modality_configs)
+                    first_change = None
+        except KeyboardInterrupt:
+            log.info("WATCH stopping")
+        finally:
+            # changes collected since the last apply.
+            _apply_pending(root_dirs, changes, databasename, journaling_mode, version,
+                           hash_cache, prehash, digests, nthreads, verbose, modality_configs)
+            if hash_cache is not None:
+                hash_cache.close()
+    finally:
+        inotify.close()
+
+
+def _apply_pending(root_dirs: dict, changes: dict, databasename: str, journaling_mode: str, version: str,
+                   hash_cache: HashCache, prehash: Prehash, digests: tuple, nthreads: int, verbose: bool, modality_configs: dict):
+    for (rootdir, (root, mods)) in root_dirs.items():
+        relpaths = changes[rootdir]
+        if len(relpaths) == 0:
+            continue
+        start = time.time()
+        (inserted, inactivated) = _apply_changes(root, mods, relpaths, databasename, journaling_mode, version,
+                                                 hash_cache = hash_cache, prehash = prehash, digests = digests, nthreads = nthreads,
+                                                 verbose = verbose, modality_configs = modality_configs)
+        log.info(f"WATCH {len(relpaths)} changed paths in {rootdir}: added {inserted}, inactivated {inactivated} in {time.time() - start:.2f} s")
+        relpaths.clear()